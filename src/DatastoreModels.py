@@ -1,5 +1,86 @@
+import zlib
 from google.appengine.ext import db
 
+# Long free text (work orders, customer comments, vehicle notes) is stored zlib
+# compressed (see CompressedTextProperty.)
+# Turning this off only changes how new values are written; values already
+# stored compressed can always be read.
+TEXT_COMPRESSION = True
+COMPRESSION_THRESHOLD = 256     # shorter text is stored as it is
+
+class PackedText(object):
+    """ A compressed text value as stored in the datastore: a Blob made of a
+        three byte header, 'ZT' and a format version, followed by the payload.
+        Version 1 is zlib compressed UTF-8.  Nothing is decompressed until
+        unpack() is first called.
+    """
+    MAGIC = 'ZT'
+    ZLIB_V1 = '\x01'
+    
+    def __init__(self, blob):
+        self.blob = blob
+        self.__text = None
+        
+    def pack(text):
+        """ Return text as a compressed Blob, or None if compressing it does
+            not make it any smaller.
+        """
+        data = text.encode('utf-8')
+        blob = PackedText.MAGIC + PackedText.ZLIB_V1 + zlib.compress(data)
+        if len(blob) >= len(data):
+            return None
+        return db.Blob(blob)
+    pack = staticmethod(pack)
+    
+    def unpack(self):
+        if self.__text is None:
+            if self.blob[:2] != PackedText.MAGIC or self.blob[2:3] != PackedText.ZLIB_V1:
+                raise db.BadValueError('Unknown packed text format %r' % self.blob[:3])
+            self.__text = db.Text(zlib.decompress(self.blob[3:]), 'utf-8')
+        return self.__text
+
+def unpackText(value):
+    """ The text of a CompressedTextProperty value (which may not be packed.) """
+    if isinstance(value, PackedText):
+        return value.unpack()
+    return value
+
+class CompressedTextProperty(db.Property):
+    """ A TextProperty whose long values are stored as PackedText blobs.  An
+        entity read from the datastore holds a PackedText for such a value,
+        so only the fields passed through unpackText() are ever decompressed,
+        and copying the value to another entity does not decompress it at
+        all.  Short values, and values written while TEXT_COMPRESSION is off,
+        are stored as plain Text.
+    """
+    def __init__(self, verbose_name=None, **kwds):
+        kwds['indexed'] = False
+        super(CompressedTextProperty, self).__init__(verbose_name, **kwds)
+        
+    def validate(self, value):
+        if isinstance(value, db.Blob):
+            value = PackedText(value)
+        if value is not None and not isinstance(value, (basestring, PackedText)):
+            raise db.BadValueError('Property %s must be a string' % self.name)
+        return super(CompressedTextProperty, self).validate(value)
+    
+    def get_value_for_datastore(self, model_instance):
+        value = super(CompressedTextProperty, self).get_value_for_datastore(model_instance)
+        if value is None:
+            return None
+        if isinstance(value, PackedText):
+            return value.blob
+        if TEXT_COMPRESSION and len(value) >= COMPRESSION_THRESHOLD:
+            blob = PackedText.pack(value)
+            if blob is not None:
+                return blob
+        return db.Text(value)
+    
+    def make_value_from_datastore(self, value):
+        if isinstance(value, db.Blob):
+            return PackedText(value)
+        return value
+
 class CustomerEnt(db.Model):
     """ Datastore model for Customer """
     first_name = db.StringProperty(verbose_name = "First Name", required=False)
@@ -12,7 +93,15 @@ class CustomerEnt(db.Model):
     phone1 = db.StringProperty(verbose_name = "Primary Phone", required=True)
     phone2 = db.StringProperty(verbose_name = "Secondary Phone", required=False)
     email = db.StringProperty(verbose_name = "Email Address", required=False)
-    comments = db.TextProperty(verbose_name = "Comments", required=False) 
+    comments = CompressedTextProperty(verbose_name = "Comments", required=False) 
+    # Lowercased prefixes of the words in first_name and last_name, maintained
+    # by MaintAppModel.saveCustomerInfo for partial name searches.
+    name_prefixes = db.StringListProperty()
+    # Digits-only forms of phone1 and phone2 (see MaintAppModel.normalizePhone)
+    # so a caller can be found however either number was typed in.
+    phone_digits = db.StringListProperty()
+    # Bumped on every save (see MaintAppModel.bumpVersion.)
+    version = db.IntegerProperty(default=0, indexed=False)
 
 class VehicleEnt(db.Model):
     """ Datastore model for Vehicle """
@@ -21,8 +110,13 @@ class VehicleEnt(db.Model):
     year = db.IntegerProperty(verbose_name = "Year", required=True)
     license = db.StringProperty(verbose_name = "License Plate Number", required=True)
     vin = db.StringProperty(verbose_name = "VIN", required=False)
-    notes = db.TextProperty(verbose_name = "Other Characteristics", required=False) 
+    notes = CompressedTextProperty(verbose_name = "Other Characteristics", required=False) 
     customer = db.ReferenceProperty(CustomerEnt)
+    # Normalized license plate and VIN (see MaintAppModel.normalizePlate) so a
+    # walk-in can be found from either one with a single equality query.
+    plate_codes = db.StringListProperty()
+    # Bumped on every save (see MaintAppModel.bumpVersion.)
+    version = db.IntegerProperty(default=0, indexed=False)
 
 class WorkorderEnt(db.Model):
     """ Datastore model for Workorder """
@@ -30,9 +124,52 @@ class WorkorderEnt(db.Model):
     mileage = db.IntegerProperty(verbose_name = "Initial Mileage", required=True)
     status = db.IntegerProperty(verbose_name = "Work Order Status", required=True, choices=set([1,2,3]))
     date_created = db.DateTimeProperty(verbose_name = "Date Opened", required=True, auto_now_add=True)
-    customer_request = db.TextProperty(verbose_name = "Customer Work Request", required=True) 
     mechanic =  db.StringProperty(verbose_name = "Responsible Mechanic", required =True)
-    task_list = db.TextProperty(verbose_name = "Mechanic Task List", required=False)
-    work_performed = db.TextProperty(verbose_name = "Mechanic Work Record", required=False)
-    notes = db.TextProperty(verbose_name = "Mechanic Notes", required=False) 
     date_closed = db.DateTimeProperty(verbose_name = "Date Closed", required=False)
+    # The text of the work order lives in WorkorderDetailEnt.  These are only
+    # read for work orders saved before that (see
+    # MaintAppMigrations.moveWorkorderText) and are left empty otherwise.
+    customer_request = db.TextProperty(required=False)
+    task_list = db.TextProperty(required=False)
+    work_performed = db.TextProperty(required=False)
+    notes = db.TextProperty(required=False)
+
+class WorkorderDetailEnt(db.Model):
+    """ The bulky free text of a work order, kept out of WorkorderEnt so that
+        lists and queues of work orders do not read it.  There is one per work
+        order, a child of the WorkorderEnt with key name 'detail', so the two
+        are saved together in one transaction.
+    """
+    customer_request = CompressedTextProperty(verbose_name = "Customer Work Request", required=True) 
+    task_list = CompressedTextProperty(verbose_name = "Mechanic Task List", required=False)
+    work_performed = CompressedTextProperty(verbose_name = "Mechanic Work Record", required=False)
+    notes = CompressedTextProperty(verbose_name = "Mechanic Notes", required=False) 
+    
+    KEY_NAME = 'detail'
+    
+    def keyFor(workorder_key):
+        """ Key of the detail entity of the work order with workorder_key. """
+        return db.Key.from_path('WorkorderDetailEnt', WorkorderDetailEnt.KEY_NAME,
+                                parent=workorder_key)
+    keyFor = staticmethod(keyFor)
+
+class ShopBoardEnt(db.Model):
+    """ Denormalized summary of the work orders of one status listed in the
+        side panel.  There is one instance per status listed (see keyFor),
+        each its own entity group, kept up to date by
+        MaintAppModel.saveWorkorder in the transaction that saves the work
+        order.  Each entry is
+        'workorder id<TAB>vehicle id<TAB>vehicle label<TAB>mechanic',
+        newest change first.
+    """
+    workorders = db.ListProperty(db.Text)
+    # Bumped on every change to the list (see MaintAppModel.bumpVersion.)
+    version = db.IntegerProperty(default=0, indexed=False)
+    
+    # The single board kept for both lists before they were split by status.
+    OLD_KEY_NAME = 'shopboard'
+    
+    def keyFor(status):
+        """ Key of the board of the work orders with status. """
+        return db.Key.from_path('ShopBoardEnt', 'status%d' % status)
+    keyFor = staticmethod(keyFor)
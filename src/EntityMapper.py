@@ -0,0 +1,217 @@
+'''
+Converters between the datastore entities of DatastoreModels and the light
+weight objects of MaintAppObjects.
+
+An EntityMapper is built once, at import, from the property definitions of
+a model class and the FIELDS of a transfer object class.  Every field of the
+object that is also a property of the model is copied across, through a
+conversion where the two sides store it differently (a vehicle's year is a
+string in the forms and an integer in the datastore.)  Fields holding the id
+of another record are read with a key function instead, so a reference is
+never dereferenced just to get its id.
+
+Converting entities to objects is planned once per set of fields asked for
+and the plan cached on the mapper: tuples pairing the slot of each field with
+the property it is read from (and the conversion or key function, if any),
+worked through by a plain getattr and set loop.  The objects are filled in
+through their slots directly, so neither __init__ nor the change tracking of
+MaintAppObjects.TransferObject is run for them; they come out clean.  An object with a version slot also gets the version of the entity,
+which is never written back: the Model bumps it on save.
+'''
+
+from datetime import datetime
+from DatastoreModels import unpackText
+
+
+def keyString(key):
+    """ The id of the record with db.Key key, or "-1" (no record) for None. """
+    if key is None:
+        return "-1"
+    return str(key)
+
+
+def comparable(value):
+    """ value as it is compared with another: a blank string is the same as
+        None, and times only count to the second, which is all the forms show.
+    """
+    if value == "":
+        return None
+    if isinstance(value, datetime):
+        return value.replace(microsecond=0)
+    return value
+
+
+def applyChanges(entity, source, fields, convert={}):
+    """ Copy the given fields of the transfer object source onto entity,
+        leaving alone the ones that already hold the same value (see
+        comparable.)  convert maps a field name to the function turning the
+        source value into the stored one.  Returns the list of the fields
+        that were set.
+    """
+    changed = []
+    for field in fields:
+        value = getattr(source, field)
+        if field in convert:
+            value = convert[field](value)
+        if comparable(unpackText(getattr(entity, field))) != comparable(value):
+            setattr(entity, field, value)
+            changed.append(field)
+    return changed
+
+
+class EntityMapper(object):
+    """ Maps entities of model_class to objects of object_class and back.
+
+        keys maps the object fields holding the id of another record to a
+        function returning that record's db.Key (or None) for an entity.
+        load and store map a field to the conversion applied when it is read
+        from, and written to, an entity.  Fields in exclude are not mapped.
+        Fields in lazy are left unset by a full conversion, for the object
+        to load when they are first used (see MaintAppObjects.Workorder.)
+    """
+
+    def __init__(self, model_class, object_class, keys={}, load={}, store={},
+                 exclude=(), lazy=()):
+        properties = model_class.properties()
+        self.modelClass = model_class
+        self.objectClass = object_class
+        self.fields = tuple([f for f in object_class.FIELDS
+                             if f in properties and f not in keys and f not in exclude])
+        self.keys = keys
+        self.load = load
+        self.store = store
+        self.lazy = lazy
+        self.versioned = ('version' in properties and
+                          'version' in getattr(object_class, '__slots__', ()))
+        self.__converters = {}
+        return None
+
+    def toObject(self, entity, fields=None, **values):
+        """ The object for entity, or None if entity is None.  With fields,
+            only those fields are read (e.g. from a projection query) and the
+            others are None.  Any values given are set on the object as is.
+        """
+        if entity is None:
+            return None
+        obj = self.__converter(fields)(entity)
+        for name, value in values.items():
+            object.__setattr__(obj, name, value)
+        return obj
+
+    def toObjects(self, entities, fields=None, **values):
+        """ toObject for a list of entities, leaving out the ones that are
+            None (e.g. missing from a batched get.)
+        """
+        convert = self.__converter(fields)
+        result = [convert(entity) for entity in entities if entity is not None]
+        if values:
+            items = values.items()
+            for obj in result:
+                for name, value in items:
+                    object.__setattr__(obj, name, value)
+        return result
+
+    def newEntity(self, obj, **extra):
+        """ An unsaved entity holding the mapped fields of obj.  extra is
+            passed on to the model constructor (parent, references, ...)
+        """
+        values = {}
+        for field in self.fields:
+            value = getattr(obj, field)
+            if field in self.store:
+                value = self.store[field](value)
+            values[field] = value
+        values.update(extra)
+        return self.modelClass(**values)
+
+    def updateEntity(self, entity, obj, fields):
+        """ Copy those of the given fields of obj that are mapped onto entity
+            where they differ.  Returns the list of the fields that were set.
+        """
+        return applyChanges(entity, obj, [f for f in self.fields if f in fields],
+                            self.store)
+
+    def differingFields(self, obj, other, fields):
+        """ Those of the given fields that differ between the objects obj and
+            other once both values are converted as they would be stored (and
+            made comparable.)  A value the conversion rejects, such as a
+            mileage of "45,000", is compared as it is.
+        """
+        result = []
+        for field in fields:
+            if self.__storedValue(field, getattr(obj, field)) != \
+               self.__storedValue(field, getattr(other, field)):
+                result.append(field)
+        return result
+
+    def __storedValue(self, field, value):
+        if field in self.store and value not in (None, ""):
+            try:
+                value = self.store[field](value)
+            except (TypeError, ValueError):
+                pass
+        return comparable(value)
+
+    def __converter(self, fields):
+        if fields is not None:
+            fields = frozenset(fields)
+        convert = self.__converters.get(fields)
+        if convert is None:
+            convert = self.__plan(fields)
+            self.__converters[fields] = convert
+        return convert
+
+    def __plan(self, fields):
+        """ The function converting an entity to an object, reading the
+            given fields (all of them for None.)  Which slot each field goes
+            to, and how it is read, is worked out here once.
+        """
+        cls = self.objectClass
+
+        def slot(name):
+            return getattr(cls, name).__set__
+
+        copied = []     # (slot setter, property) copied as they are
+        loaded = []     # (slot setter, property, conversion)
+        keyed = []      # (slot setter, key function) for ids of other records
+        blank = []      # slot setters of the fields left None
+        for field in cls.FIELDS:
+            if fields is not None and field not in fields:
+                blank.append(slot(field))
+            elif field in self.keys:
+                keyed.append((slot(field), self.keys[field]))
+            elif field in self.fields:
+                if field in self.load:
+                    loaded.append((slot(field), field, self.load[field]))
+                else:
+                    copied.append((slot(field), field))
+            elif fields is not None or field not in self.lazy:
+                blank.append(slot(field))
+        if self.versioned:
+            if fields is None or 'version' in fields:
+                copied.append((slot('version'), 'version'))
+            else:
+                blank.append(slot('version'))
+        copied = tuple(copied)
+        loaded = tuple(loaded)
+        keyed = tuple(keyed)
+        blank = tuple(blank)
+        setId = slot('id')
+        setChanged = slot('_changed')
+        new = object.__new__
+
+        def convert(entity):
+            obj = new(cls)
+            setId(obj, str(entity.key()))
+            for put, name in copied:
+                put(obj, getattr(entity, name))
+            for put, name, load in loaded:
+                put(obj, load(getattr(entity, name)))
+            for put, key in keyed:
+                put(obj, keyString(key(entity)))
+            for put in blank:
+                put(obj, None)
+            setChanged(obj, set())
+            return obj
+
+        return convert
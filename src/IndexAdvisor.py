@@ -0,0 +1,296 @@
+'''
+Composite index advisor for customer searches.
+
+Every customer search is "equality filters on some set of CustomerEnt
+properties, ORDER BY last_name, first_name".  Left alone, the dev server adds
+one composite index per combination of fields anybody ever searched on, and
+every CustomerEnt put() has to write a row into each of them.
+
+This module does two things:
+
+  - CustomerSearchPlanner decides, for a given set of equality filters,
+    whether the indexes in index.yaml can serve the search in sorted order.
+    A search is servable if an index matches it exactly, or if it only filters
+    on properties that each have a (property, last_name, first_name) index:
+    the datastore merge-joins those indexes and still returns the results in
+    order.  Anything else is run without the ORDER BY (the built-in single
+    property indexes are merge-joined) and MaintAppModel sorts the page in
+    memory.
+
+  - proposeIndexes replays a log of search patterns and greedily picks the
+    small set of indexes that serves the most searches within a budget.
+    Run it against the application logs:
+
+        python IndexAdvisor.py [--budget N] [--check index.yaml] logfile...
+
+    MaintAppModel logs a "customer search pattern: prop,prop" line for every
+    search.  The proposed CustomerEnt indexes are printed in index.yaml
+    format; a coverage report goes to stderr.
+
+The module only uses the standard library so it can be run outside the App
+Engine SDK.
+'''
+
+import sys
+
+KIND = 'CustomerEnt'
+SORT_ORDER = ('last_name', 'first_name')
+PATTERN_MARKER = 'customer search pattern:'
+DEFAULT_BUDGET = 10
+
+
+def remainingSort(equalities):
+    """ Sort properties left once the properties filtered for equality are
+        dropped (the datastore ignores sorting on a property whose value is
+        fixed by the query.)
+    """
+    return tuple([p for p in SORT_ORDER if p not in equalities])
+
+
+def exactIndex(equalities):
+    """ The index that serves exactly this set of equality filters in sorted
+        order: the other properties, then the filtered name properties, then
+        whatever is left to sort on.  Returns None if the built-in indexes are
+        enough (both name properties are filtered, so there is nothing to sort.)
+    """
+    sort = remainingSort(equalities)
+    if not sort:
+        return None
+    others = [p for p in equalities if p not in SORT_ORDER]
+    others.sort()
+    names = [p for p in SORT_ORDER if p in equalities]
+    return tuple(others + names) + sort
+
+
+def mergeIndex(prop):
+    """ The merge-join friendly index for one property. """
+    return (prop,) + SORT_ORDER
+
+
+def readIndexYaml(path, kind=KIND):
+    """ Return the property lists of the composite indexes for kind in an
+        index.yaml file.  Only the subset of YAML used by index.yaml is
+        understood.
+    """
+    indexes = []
+    current = None
+    currentKind = None
+    for line in open(path):
+        line = line.split('#', 1)[0].strip()
+        if line.startswith('- kind:'):
+            if currentKind == kind:
+                indexes.append(tuple(current))
+            currentKind = line[len('- kind:'):].strip()
+            current = []
+        elif line.startswith('- name:') and current is not None:
+            current.append(line[len('- name:'):].strip())
+    if currentKind == kind:
+        indexes.append(tuple(current))
+    return indexes
+
+
+class CustomerSearchPlanner(object):
+    """ Decides which customer searches can be sorted by the datastore. """
+
+    def __init__(self, indexes):
+        self.__indexes = set([tuple(index) for index in indexes])
+        self.__mergeable = set()
+        for index in self.__indexes:
+            if len(index) == 3 and index[1:] == SORT_ORDER:
+                self.__mergeable.add(index[0])
+        self.__plans = {}
+        return None
+
+    def fromIndexFile(path):
+        """ Planner for the CustomerEnt indexes in an index.yaml file.  A
+            missing file gives a planner that sorts everything in memory.
+        """
+        try:
+            indexes = readIndexYaml(path)
+        except IOError:
+            indexes = []
+        return CustomerSearchPlanner(indexes)
+    fromIndexFile = staticmethod(fromIndexFile)
+
+    def isOrdered(self, equalities):
+        """ True if a search with equality filters on the given properties can
+            include ORDER BY last_name, first_name.
+        """
+        key = frozenset(equalities)
+        ordered = self.__plans.get(key)
+        if ordered is None:
+            ordered = self.__plan(key)
+            self.__plans[key] = ordered
+        return ordered
+
+    def __plan(self, key):
+        if not remainingSort(key):
+            return True
+        sort = remainingSort(key)
+        for index in self.__indexes:
+            # The equality properties may come in any order ahead of the sort.
+            if len(index) == len(key) + len(sort) and \
+               index[len(key):] == sort and frozenset(index[:len(key)]) == key:
+                return True
+        # Merge join of (property, last_name, first_name) indexes.  Filters on
+        # the name properties change the sort, so those need an exact index.
+        for prop in key:
+            if prop in SORT_ORDER or prop not in self.__mergeable:
+                return False
+        return len(key) > 0
+
+
+def parsePatternLog(lines):
+    """ Count the search patterns in log lines.  Returns a dictionary mapping
+        frozensets of property names to the number of searches.
+    """
+    counts = {}
+    for line in lines:
+        pos = line.find(PATTERN_MARKER)
+        if pos < 0:
+            continue
+        text = line[pos + len(PATTERN_MARKER):].strip()
+        props = frozenset([p.strip() for p in text.split(',') if p.strip()])
+        counts[props] = counts.get(props, 0) + 1
+    return counts
+
+
+def proposeIndexes(patternCounts, budget=DEFAULT_BUDGET):
+    """ Pick at most budget indexes serving as many of the searches in
+        patternCounts (see parsePatternLog) as possible in sorted order.
+        Candidates are the exact index of every pattern plus the merge-join
+        index of every property; each round adds the candidate that makes the
+        most additional searches sortable.  Returns the list of indexes.
+    """
+    candidates = set()
+    for pattern in patternCounts:
+        index = exactIndex(pattern)
+        if index is not None:
+            candidates.add(index)
+        for prop in pattern:
+            if prop not in SORT_ORDER:
+                candidates.add(mergeIndex(prop))
+
+    chosen = []
+    covered = coveredSearches(chosen, patternCounts)
+    while len(chosen) < budget and candidates:
+        best = None
+        bestCovered = covered
+        ranked = list(candidates)
+        ranked.sort()
+        for candidate in ranked:
+            total = coveredSearches(chosen + [candidate], patternCounts)
+            if total > bestCovered:
+                best = candidate
+                bestCovered = total
+        if best is None:
+            # No single index helps; a merge-join index may only pay off
+            # together with another one, so add the most used property's.
+            best = _mostUsedMergeIndex(candidates, patternCounts)
+            if best is None:
+                break
+        chosen.append(best)
+        candidates.discard(best)
+        covered = coveredSearches(chosen, patternCounts)
+    return _pruneUnused(chosen, patternCounts)
+
+
+def coveredSearches(indexes, patternCounts):
+    """ Number of searches that indexes can serve in sorted order. """
+    planner = CustomerSearchPlanner(indexes)
+    total = 0
+    for pattern, count in patternCounts.items():
+        if planner.isOrdered(pattern):
+            total += count
+    return total
+
+
+def _mostUsedMergeIndex(candidates, patternCounts):
+    usage = {}
+    for pattern, count in patternCounts.items():
+        for prop in pattern:
+            if mergeIndex(prop) in candidates:
+                usage[prop] = usage.get(prop, 0) + count
+    if not usage:
+        return None
+    ranked = [(count, prop) for prop, count in usage.items()]
+    ranked.sort()
+    return mergeIndex(ranked[-1][1])
+
+
+def _pruneUnused(indexes, patternCounts):
+    """ Drop indexes that can be removed without losing coverage. """
+    result = list(indexes)
+    total = coveredSearches(result, patternCounts)
+    for index in list(result):
+        trial = [i for i in result if i != index]
+        if coveredSearches(trial, patternCounts) == total:
+            result = trial
+    return result
+
+
+def formatIndexYaml(indexes, kind=KIND):
+    lines = []
+    for index in indexes:
+        lines.append('- kind: %s' % kind)
+        lines.append('  properties:')
+        for prop in index:
+            lines.append('  - name: %s' % prop)
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def formatReport(indexes, patternCounts):
+    planner = CustomerSearchPlanner(indexes)
+    total = 0
+    sortedTotal = 0
+    lines = []
+    ranked = [(count, pattern) for pattern, count in patternCounts.items()]
+    ranked.sort()
+    ranked.reverse()
+    for count, pattern in ranked:
+        total += count
+        if planner.isOrdered(pattern):
+            how = 'index'
+            sortedTotal += count
+        else:
+            how = 'in-memory sort'
+        names = list(pattern)
+        names.sort()
+        lines.append('%6d  %-50s %s' % (count, ','.join(names) or '(no filters)', how))
+    lines.append('%d composite indexes; %d of %d searches sorted by the datastore' %
+                 (len(indexes), sortedTotal, total))
+    return '\n'.join(lines)
+
+
+def main(args):
+    budget = DEFAULT_BUDGET
+    check = None
+    files = []
+    while args:
+        arg = args.pop(0)
+        if arg == '--budget':
+            budget = int(args.pop(0))
+        elif arg == '--check':
+            check = args.pop(0)
+        else:
+            files.append(arg)
+    lines = []
+    if files:
+        for name in files:
+            lines.extend(open(name).readlines())
+    else:
+        lines = sys.stdin.readlines()
+    counts = parsePatternLog(lines)
+
+    if check is not None:
+        sys.stderr.write('Coverage of %s:\n%s\n\n' %
+                         (check, formatReport(readIndexYaml(check), counts)))
+    indexes = proposeIndexes(counts, budget)
+    sys.stdout.write(formatIndexYaml(indexes))
+    sys.stderr.write('Proposed:\n%s\n' % formatReport(indexes, counts))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
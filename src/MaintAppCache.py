@@ -0,0 +1,178 @@
+'''
+Caches used by MaintAppModel to cut down on datastore traffic.
+
+RequestIdentityMap holds every entity read while serving a single request so
+that the Controller can ask the Model for the same customer, vehicle or work
+order as many times as it likes during one button press and the datastore is
+still only read once per entity.  The map is thrown away at the end of the
+request (see MaintAppModel.beginRequest/endRequest) so nothing stale survives
+into the next request.
+
+ObjectCache is the longer lived layer behind it: a memcache read-through cache
+of the Customer, Vehicle and Workorder objects (and the vehicle and work order
+lists) handed to the Controller.  The Model's save methods mark the entry of
+the underlying record invalidated whenever it changes.  The value loaded
+after that is cached with a compare-and-set against the mark, so a request
+that read the record just before a save cannot put the old value back, and
+the first request after the save can cache the new one (see ObjectCache.add.)
+'''
+
+from google.appengine.ext import db
+from google.appengine.api import memcache
+
+
+class RequestIdentityMap(object):
+    """ Identity map / unit of work for a single request.  Entities are keyed
+        by the string form of their datastore key.  Missing entities are
+        remembered as None so repeated lookups of a bad id do not go back to
+        the datastore either.  Query results are remembered as lists of keys
+        under a caller supplied signature and are dropped whenever something
+        is written during the request.
+    """
+
+    def __init__(self):
+        self.__entities = {}
+        self.__queries = {}
+        self.hits = 0       # lookups answered from the map
+        self.gets = 0       # entities read from the datastore
+        self.queries = 0    # queries actually run against the datastore
+        return None
+
+    def getEntities(self, keys):
+        """ Return the entities for the list of db.Key objects, in the same
+            order, with None for keys that do not exist.  Keys not yet in the
+            map are read with a single batched get.
+        """
+        missing = []
+        for key in keys:
+            if str(key) in self.__entities:
+                self.hits += 1
+            else:
+                missing.append(key)
+        if missing:
+            self.gets += len(missing)
+            for key, entity in zip(missing, db.get(missing)):
+                self.__entities[str(key)] = entity
+        return [self.__entities[str(key)] for key in keys]
+
+    def getEntity(self, key):
+        return self.getEntities([key])[0]
+
+    def query(self, signature, runQuery):
+        """ Return the entities produced by runQuery(), a callable returning a
+            list of entities.  The first call for a given signature runs the
+            query and records the resulting keys; later calls in the same
+            request are served from the map.
+        """
+        if signature in self.__queries:
+            self.hits += 1
+            return self.getEntities(self.__queries[signature])
+        self.queries += 1
+        entities = runQuery()
+        for entity in entities:
+            self.__entities[str(entity.key())] = entity
+        self.__queries[signature] = [entity.key() for entity in entities]
+        return entities
+
+    def store(self, entity):
+        """ Record an entity that has just been written so later reads in the
+            request see the saved values.  Any remembered query might now have
+            a different result, so they are all forgotten.
+        """
+        self.__entities[str(entity.key())] = entity
+        self.__queries.clear()
+        return None
+
+    def discard(self, keys):
+        """ Record that the entities for the list of db.Key objects have just
+            been deleted, and forget the remembered queries, as store() does.
+        """
+        for key in keys:
+            self.__entities[str(key)] = None
+        self.__queries.clear()
+        return None
+
+    def getStats(self):
+        return {'hits': self.hits, 'gets': self.gets, 'queries': self.queries}
+
+
+class ObjectCache(object):
+    """ Memcache read-through cache for the light weight objects defined in
+        MaintAppObjects.  Values are stored under '<prefix><kind>:<id>' where
+        kind names what is cached ('Customer', 'VehicleList', ...) and id is
+        the datastore key string the value was loaded for.  Bump KEY_PREFIX
+        whenever the pickled layout of the cached objects changes so old
+        entries are simply never read again.
+    """
+    KEY_PREFIX = 'mas5:'
+    EXPIRY = 3600   # seconds; bounds staleness if an invalidation is ever lost
+    # Stored in place of the value by invalidate().
+    INVALIDATED = 'invalidated'
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        # gets() remembers the compare-and-set ids on the client, so each
+        # cache (one per Model, so per thread) has a client of its own.
+        self.__client = memcache.Client()
+        # Cache keys last found invalidated by get(), for add() to replace.
+        self.__invalidated = set()
+        return None
+
+    def __cacheKey(self, kind, ident):
+        return '%s%s:%s' % (ObjectCache.KEY_PREFIX, kind, ident)
+
+    def get(self, kind, ident):
+        """ Return the cached value or None if it is not in memcache or has
+            been invalidated.
+        """
+        cacheKey = self.__cacheKey(kind, ident)
+        value = self.__client.gets(cacheKey)
+        if value == ObjectCache.INVALIDATED:
+            self.__invalidated.add(cacheKey)
+            value = None
+        else:
+            self.__invalidated.discard(cacheKey)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def add(self, kind, ident, value):
+        """ Cache a value loaded from the datastore after get() missed.
+            Where get() found the entry invalidated, the value replaces the
+            mark only if the mark has not changed since (memcache cas), and
+            otherwise only if the entry is still missing (memcache add.)
+            Either way nothing is stored if the entry was invalidated while
+            the value was being loaded: the value may have been read before
+            the save.  Returns True if the value was stored.
+        """
+        cacheKey = self.__cacheKey(kind, ident)
+        if cacheKey in self.__invalidated:
+            self.__invalidated.discard(cacheKey)
+            return self.__client.cas(cacheKey, value, time=ObjectCache.EXPIRY)
+        return self.__client.add(cacheKey, value, time=ObjectCache.EXPIRY)
+
+    def invalidate(self, entries):
+        """ Mark the cached values for a list of (kind, id) pairs
+            invalidated.  A value loaded before the mark cannot replace it
+            (see add), one loaded after it can straight away.
+        """
+        cacheKeys = [self.__cacheKey(kind, ident) for kind, ident in entries
+                     if ident is not None]
+        if cacheKeys:
+            self.__client.set_multi(dict.fromkeys(cacheKeys, ObjectCache.INVALIDATED),
+                                    time=ObjectCache.EXPIRY)
+        return None
+
+    def getStats(self):
+        """ Return hit/miss counters for this cache along with the hit ratio
+            (0.0 when nothing has been looked up yet.)
+        """
+        lookups = self.hits + self.misses
+        if lookups:
+            ratio = float(self.hits) / lookups
+        else:
+            ratio = 0.0
+        return {'hits': self.hits, 'misses': self.misses, 'hit_ratio': ratio}
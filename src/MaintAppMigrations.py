@@ -0,0 +1,147 @@
+'''
+Data migrations for the Maintenance Records System datastore.
+
+Each migration processes one batch of entities per call and returns the cursor
+to pass to the next call (None once every entity has been processed), so a
+migration can be driven from a request handler or the remote API shell
+without running into request deadlines:
+
+    cursor = None
+    while True:
+        cursor = backfillCustomerIndexes(cursor)
+        if cursor is None:
+            break
+'''
+
+from google.appengine.ext import db
+from DatastoreModels import CustomerEnt, VehicleEnt, WorkorderEnt, WorkorderDetailEnt
+from DatastoreModels import ShopBoardEnt
+from MaintAppObjects import Workorder
+from MaintAppModel import MaintAppModel, workorderDetail, referenceKey
+from MaintAppModel import updateCustomerIndexFields, updateVehicleIndexFields
+
+BATCH_SIZE = 100
+MOVE_BATCH_SIZE = 10    # each vehicle moved is a transaction plus a query
+
+
+def backfillCustomerIndexes(cursor=None, batch_size=BATCH_SIZE):
+    """ Recompute the derived search properties (see
+        MaintAppModel.updateCustomerIndexFields) of one batch of customers
+        saved before those properties existed.
+    """
+    query = CustomerEnt.all()
+    if cursor:
+        query.with_cursor(cursor)
+    customers = query.fetch(batch_size)
+    for customer in customers:
+        updateCustomerIndexFields(customer)
+    db.put(customers)
+    if len(customers) < batch_size:
+        return None
+    return query.cursor()
+
+
+def backfillVehicleIndexes(cursor=None, batch_size=BATCH_SIZE):
+    """ Recompute the derived search properties (see
+        MaintAppModel.updateVehicleIndexFields) of one batch of vehicles
+        saved before those properties existed.
+    """
+    query = VehicleEnt.all()
+    if cursor:
+        query.with_cursor(cursor)
+    vehicles = query.fetch(batch_size)
+    for vehicle in vehicles:
+        updateVehicleIndexFields(vehicle)
+    db.put(vehicles)
+    if len(vehicles) < batch_size:
+        return None
+    return query.cursor()
+
+
+def moveVehiclesIntoCustomerGroups(cursor=None, batch_size=MOVE_BATCH_SIZE):
+    """ Move one batch of vehicles saved before vehicles and work orders were
+        kept in their customer's entity group into that group, together with
+        their work orders (see MaintAppModel.regroupVehicle.)  Moved vehicles
+        get new keys under their customer, and those sort ahead of the root
+        VehicleEnt keys this query walks, so the cursor never sees a vehicle
+        twice.  Once this returns None, MaintAppModel.LEGACY_REFERENCE_LOOKUPS
+        can be turned off.
+    """
+    query = VehicleEnt.all()
+    if cursor:
+        query.with_cursor(cursor)
+    vehicles = query.fetch(batch_size)
+    model = MaintAppModel()
+    for vehicle in vehicles:
+        if vehicle.key().parent() is None:
+            model.regroupVehicle(str(vehicle.key()))
+    if len(vehicles) < batch_size:
+        return None
+    return query.cursor()
+
+
+def deleteOrphanedWorkorders(cursor=None, batch_size=BATCH_SIZE):
+    """ Delete the work orders, and their text, in one batch whose vehicle no
+        longer exists: the originals a vehicle move could not delete (see
+        MaintAppModel.__deleteWorkorders.)  Deleting is idempotent, so an
+        interrupted batch can simply be run again.
+    """
+    query = WorkorderEnt.all()
+    if cursor:
+        query.with_cursor(cursor)
+    workorders = query.fetch(batch_size)
+    vehicle_keys = [referenceKey(ent, WorkorderEnt.vehicle) for ent in workorders]
+    vehicles = db.get([key for key in vehicle_keys if key is not None])
+    existing = set([vehicle.key() for vehicle in vehicles if vehicle is not None])
+    orphans = [ent.key() for ent, key in zip(workorders, vehicle_keys)
+               if key not in existing]
+    if orphans:
+        db.delete(orphans + [WorkorderDetailEnt.keyFor(key) for key in orphans])
+    if len(workorders) < batch_size:
+        return None
+    return query.cursor()
+
+
+def moveWorkorderText(cursor=None, batch_size=BATCH_SIZE):
+    """ Move the text fields of one batch of work orders saved before they
+        were split out of WorkorderEnt into a WorkorderDetailEnt for each.
+        The details are written before the text is cleared from the work
+        orders, and a work order that already has a detail entity only has
+        its text cleared, so an interrupted batch can simply be run again.
+    """
+    query = WorkorderEnt.all()
+    if cursor:
+        query.with_cursor(cursor)
+    workorders = query.fetch(batch_size)
+    inline = [ent for ent in workorders if ent.customer_request is not None]
+    if inline:
+        existing = db.get([WorkorderDetailEnt.keyFor(ent.key()) for ent in inline])
+        details = []
+        for ent, detail_ent in zip(inline, existing):
+            if detail_ent is None:
+                details.append(WorkorderDetailEnt(parent=ent.key(),
+                                                  key_name=WorkorderDetailEnt.KEY_NAME,
+                                                  **workorderDetail(ent)))
+        if details:
+            db.put(details)
+        for ent in inline:
+            for field in Workorder.DETAIL_FIELDS:
+                setattr(ent, field, None)
+        db.put(inline)
+    if len(workorders) < batch_size:
+        return None
+    return query.cursor()
+
+
+def rebuildShopBoard(cursor=None):
+    """ Build the shop boards from the work order queues (see
+        MaintAppModel.rebuildShopBoard) and delete the single board kept
+        before the lists were split by status.  Requests only read the
+        boards and saves only update them, so run this once after deploying
+        and again whenever the boards need repairing.  The queues are read
+        no further than MaintAppModel.SHOP_BOARD_LIMIT work orders each, so
+        it is all done in one call.
+    """
+    MaintAppModel().rebuildShopBoard()
+    db.delete(db.Key.from_path(ShopBoardEnt.kind(), ShopBoardEnt.OLD_KEY_NAME))
+    return None
@@ -9,98 +9,316 @@ Created on May 27, 2009
 
 import os
 import re
+import logging
+import time
 import datetime
+import threading
 from google.appengine.ext import db
 from google.appengine.api import apiproxy_stub_map 
 from google.appengine.api import datastore_file_stub 
-from MaintAppObjects import Customer, Vehicle, Workorder 
-from DatastoreModels import CustomerEnt, VehicleEnt, WorkorderEnt
+from google.appengine.api import memcache
+from google.appengine.api.memcache import memcache_stub
+from MaintAppObjects import Customer, Vehicle, Workorder, WorkorderSummary
+from DatastoreModels import CustomerEnt, VehicleEnt, WorkorderEnt, WorkorderDetailEnt
+from DatastoreModels import ShopBoardEnt, unpackText
+import DatastoreModels
+from MaintAppCache import RequestIdentityMap, ObjectCache
+from IndexAdvisor import CustomerSearchPlanner, PATTERN_MARKER
+from EntityMapper import EntityMapper
+import MaintAppValidation
+from MaintAppValidation import CUSTOMER_RULES, VEHICLE_RULES, WORKORDER_RULES
 
 APP_ID = u'auto-repair-shop'
 os.environ['APPLICATION_ID'] = APP_ID  
 
 #================================================================
 class ValidationErrors(Exception):
-    def __init__(self, errTxt, badFldLst):
+    """ Raised when a record fails validation.  errors is the list of
+        MaintAppValidation.FieldErrors behind errTxt and badFldLst.
+    """
+    def __init__(self, errTxt, badFldLst, errors=()):
         self.errTxt = errTxt
         self.badFldLst = badFldLst
+        self.errors = list(errors)
     def __str__(self):
         return self.errTxt
     def getFieldsWithErrors(self):
         return self.badFldLst
 #================================================================
 
-def isState(s):
-    #states, DX, possesions, territories and military bases
-    states =  ("WA", "VA", "DE", "DC", "WI", "WV", "HI", "AE", "FL", "FM", "WY", "NH", "NJ", "NM", "TX", "LA", "NC", "ND", "NE", "TN", "NY", "PA", "CA", "NV", "AA", "PW", "GU", "CO", "VI", "AK", "AL", "AP", "AS", "AR", "VT", "IL", "GA", "IN", "IA", "OK", "AZ", "ID", "CT", "ME", "MD", "MA", "OH", "UT", "MO", "MN", "MI", "MH", "RI", "KS", "MT", "MP", "MS", "PR", "SC", "KY", "OR", "SD")
-    if s in states:
-       return (True,"")
-    return (False,"Illegal State Name")
-   
-def isPhone(s):
+def referenceKey(entity, reference_property):
+    """ Return the db.Key stored in a ReferenceProperty of entity without
+        dereferencing it.  Reading entity.<reference> directly fetches the
+        whole referenced entity from the datastore, which turns every list
+        of N entities into N+1 round trips when all we want is the id.
+    """
+    return reference_property.get_value_for_datastore(entity)
+
+def vehicleOwnerKey(vehicle_ent):
+    """ Key of the customer owning vehicle_ent.  Vehicles are kept in their
+        owner's entity group, so this is normally just the parent key; vehicles
+        saved before that (see MaintAppMigrations.moveVehiclesIntoCustomerGroups)
+        fall back to the customer reference.
+    """
+    parent = vehicle_ent.key().parent()
+    if parent is not None:
+        return parent
+    return referenceKey(vehicle_ent, VehicleEnt.customer)
+
+def cloneEntity(entity, parent, **overrides):
+    """ Return an unsaved copy of entity created under the given parent key,
+        with the property values in overrides replacing the copied ones (a
+        key in overrides gives the copy that key; pass None for parent then.)
+        Keys are immutable, so this is how an entity moves to another entity
+        group.
+    """
+    values = {}
+    for name, prop in entity.properties().items():
+        values[name] = prop.get_value_for_datastore(entity)
+    values.update(overrides)
+    return entity.__class__(parent=parent, **values)
+
+def workorderDetail(entity):
+    """ Dictionary of the Workorder.DETAIL_FIELDS of a WorkorderDetailEnt (or
+        of a WorkorderEnt saved before the text moved out of it.)  Compressed
+        text is left packed: a Workorder decompresses each field the first
+        time it is read, and an entity given these values stores them as
+        they are.
+    """
+    detail = {}
+    for field in Workorder.DETAIL_FIELDS:
+        detail[field] = getattr(entity, field)
+    return detail
+
+def loadWorkorderDetail(workorder_id):
+    """ Read the text fields of a work order; Workorder uses this to load them
+        on first use.  The work order is read in the same batched get in case
+        its text has not been moved to a WorkorderDetailEnt yet.
+    """
+    try:
+        key = db.Key(workorder_id)
+    except Exception:
+        return {}
+    detail_ent, workorder_ent = db.get([WorkorderDetailEnt.keyFor(key), key])
+    if detail_ent is not None:
+        return workorderDetail(detail_ent)
+    if workorder_ent is not None:
+        return workorderDetail(workorder_ent)
+    return {}
+
+Workorder.detailLoader = staticmethod(loadWorkorderDetail)
+
+# Converters between the entities and the objects handed to the Controller.
+customerMapper = EntityMapper(CustomerEnt, Customer, load={'comments': unpackText})
+vehicleMapper = EntityMapper(VehicleEnt, Vehicle,
+                             keys={'customer_id': vehicleOwnerKey},
+                             load={'year': str, 'notes': unpackText},
+                             store={'year': int})
+workorderMapper = EntityMapper(WorkorderEnt, Workorder,
+                               keys={'vehicle_id': lambda ent: referenceKey(ent, WorkorderEnt.vehicle)},
+                               store={'mileage': int},
+                               exclude=Workorder.DETAIL_FIELDS,
+                               lazy=Workorder.DETAIL_FIELDS)
+detailMapper = EntityMapper(WorkorderDetailEnt, Workorder)
+objectMappers = {Customer: customerMapper, Vehicle: vehicleMapper,
+                 Workorder: workorderMapper}
+
+def vehicleLabel(vehicle_ent):
+    """ Short description of a vehicle used to label work order lists. """
+    return "%s %s %s" % (vehicle_ent.year, vehicle_ent.make, vehicle_ent.model)
+
+def resolveReferences(entities, reference_property):
+    """ Fetch the entities referenced by reference_property for every entity
+        in the list with a single batched get.  Returns a dictionary mapping
+        str(key) of each referenced entity to the entity (missing ones are
+        left out.)
+    """
+    keys = []
+    seen = set()
+    for entity in entities:
+        key = referenceKey(entity, reference_property)
+        if key is not None and key not in seen:
+            seen.add(key)
+            keys.append(key)
+    result = {}
+    if keys:
+        for parent in db.get(keys):
+            if parent is not None:
+                result[str(parent.key())] = parent
+    return result
+
+# Customer fields that may be used as search criteria, in the order their
+# filters appear in the search query.
+CUSTOMER_SEARCH_FIELDS = ('first_name', 'last_name', 'address1', 'city',
+                          'state', 'zip', 'phone1', 'email')
+
+# Name prefixes longer than this are not indexed; longer search words are
+# matched on their first MAX_PREFIX_LENGTH characters and then checked in memory.
+MAX_PREFIX_LENGTH = 12
+# Runs of letters and digits in any alphabet (u"Jos\xe9", u"M\xfcller".)
+_nameWordPat = re.compile(r'[^\W_]+', re.UNICODE)
+
+def splitNameWords(text):
+    """ The lowercased words of text, which is decoded from UTF-8 if it is
+        a byte string.
+    """
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return _nameWordPat.findall(text.lower())
+
+def nameWords(name):
+    """ Split a name into lowercased words.  Punctuation separates words, and
+        the word with the punctuation removed is included too, so "O'Brien"
+        gives ['o', 'brien', 'obrien'].
+    """
+    if not name:
+        return []
+    words = splitNameWords(name)
+    joined = "".join(words)
+    if len(words) > 1 and joined not in words:
+        words.append(joined)
+    return words
+
+def namePrefixes(*names):
+    """ Return the sorted list of distinct prefixes (up to MAX_PREFIX_LENGTH
+        characters) of every word in the given names.
+    """
+    prefixes = set()
+    for name in names:
+        for word in nameWords(name):
+            for length in range(1, min(len(word), MAX_PREFIX_LENGTH) + 1):
+                prefixes.add(word[:length])
+    prefixes = list(prefixes)
+    prefixes.sort()
+    return prefixes
+
+_nonDigitPat = re.compile(r'\D')
+
+def normalizePhone(phone):
+    """ Reduce a phone number in any of the formats isPhone accepts to its
+        digits: "(408) 555-1212", "408.555.1212" and "1-408-555-1212 x5" all
+        become "4085551212".  A leading US country code and any extension are
+        dropped.  Returns "" if there are no digits at all.
+    """
+    if not phone:
+        return ""
+    digits = _nonDigitPat.sub("", phone)
+    if len(digits) > 10 and digits[0] == "1":
+        digits = digits[1:]
+    return digits[:10]
+
+def updateCustomerIndexFields(customer_ent):
+    """ Recompute the derived search properties of a CustomerEnt from its
+        regular fields.  Called on every save and by the backfill migration.
+    """
+    customer_ent.name_prefixes = namePrefixes(customer_ent.first_name,
+                                              customer_ent.last_name)
+    phones = []
+    for phone in (customer_ent.phone1, customer_ent.phone2):
+        digits = normalizePhone(phone)
+        if digits and digits not in phones:
+            phones.append(digits)
+    customer_ent.phone_digits = phones
+    return None
+
+def bumpVersion(entity):
+    """ Count a save of entity in its version property.  Anything built from
+        a record can be keyed by the record's id and version (see
+        MaintAppView.FragmentCache) and is then never found again once the
+        record has changed.
+    """
+    entity.version = (entity.version or 0) + 1
+    return None
+
+_nonAlnumPat = re.compile(r'[^A-Z0-9]')
+
+def normalizePlate(text):
+    """ Reduce a license plate or VIN to upper case letters and digits so
+        "ab 1234", "AB-1234" and "AB1234" all match.
     """
-    Since phone num info is so variable little validation is done
-    More specific validation could be done if there is separate fields for extension and location (home, work, other)
+    if not text:
+        return ""
+    return _nonAlnumPat.sub("", text.upper())
+
+def updateVehicleIndexFields(vehicle_ent):
+    """ Recompute the derived search properties of a VehicleEnt from its
+        regular fields.  Called on every save and by the backfill migration.
     """
-    #  return (True, "")
-    # after Example 7.16. Parsing Phone Numbers (Final Version), Diving into PYTHON
-    # note that we are allowing extra characters here because phone#s come in a myriad of formats
-    phonePat = re.compile(r'''
-                # don't match beginning of string, number can start anywhere
-    (\d{3})     # area code is 3 digits (e.g. '800')
-    \D*         # optional separator is any number of non-digits
-    (\d{3})     # trunk is 3 digits (e.g. '555')
-    \D*         # optional separator
-    (\d{4})     # rest of number is 4 digits (e.g. '1212')
-    \D*         # optional separator
-    (\d*)       # extension is optional and can be any number of digits
-                #$ end of string
-    ''', re.VERBOSE)
-    res = phonePat.search(s)
-    if res == None:
-       return  (False, "invalid phone number format")
-    parts = res.groups()
-    if (len(parts) < 3) | (len(parts) > 5): 
-       return (False, "invalid phone number format")
-    return (True, "")
-    
-
-def isZip(s):
-    aLen = len(s)
-    if (aLen == 5) | (aLen == 9):
-       if s.isdigit():
-          return (True,"")
-       else:
-          return (False,"bad zip code")
-    elif aLen != 10:
-         return (False,"bad zip code")
-    elif (s[:5].isdigit())  &  \
-       (s[5] == '-') & \
-       (s[6:].isdigit()):
-            return (True,"") 
-    return (False,"bad zip code")
-    
-def lenOK(s,minLen, maxLen):
-    if s == None:
-       return (False,"needs to have a length between %i and %i" % ( minLen, maxLen))
-    aLen = len(s)
-    if (aLen >= minLen) & (aLen <= maxLen): 
-       return (True, "")
-    else:
-       return (False, "needs to have a length between %i and %i" % ( minLen, maxLen))
-   
-def isMissing(s):
-       return (s == None) | (s == '')
+    codes = []
+    for code in (normalizePlate(vehicle_ent.license), normalizePlate(vehicle_ent.vin)):
+        if code and code not in codes:
+            codes.append(code)
+    vehicle_ent.plate_codes = codes
+    return None
+
+# Decides from the indexes deployed with the application which customer
+# searches the datastore can sort (see IndexAdvisor.)
+customerSearchPlanner = CustomerSearchPlanner.fromIndexFile(
+    os.path.join(os.path.dirname(__file__), 'index.yaml'))
+
+# Compiled customer search queries, one per combination of search conditions.
+# GqlQuery objects carry their bound values and cursor, so each thread keeps
+# its own set.
+_customerSearchQueries = threading.local()
+
+def compiledCustomerSearch(conditions, ordered=True):
+    """ Return the db.GqlQuery searching customers on conditions, a tuple of
+        (property name, parameter name) pairs each compared for equality
+        against the named parameter.  When ordered is False the ORDER BY
+        last_name, first_name clause is left off.  The query string is parsed
+        only the first time a combination is used and the user's input never
+        becomes part of the GQL text.
+    """
+    queries = getattr(_customerSearchQueries, 'queries', None)
+    if queries is None:
+        queries = _customerSearchQueries.queries = {}
+    query = queries.get((conditions, ordered))
+    if query is None:
+        query_string = ""
+        if conditions:
+            query_string = "WHERE " + \
+                " AND ".join(["%s = :%s" % condition for condition in conditions]) + " "
+        if ordered:
+            query_string += "ORDER BY last_name, first_name"
+        query = CustomerEnt.gql(query_string)
+        queries[(conditions, ordered)] = query
+    return query
 
 class MaintAppModel(object):
-    requiredCust = ('last_name', 'address1', 'city', 'state', 'zip', 'phone1')
     OK, MISSING, INVALID = (0,1,2)
+    STATUS_PAGE_SIZE = 15   # work orders per page of the open/completed lists
+    STATUS_PAGE_LIMIT = 50  # hard cap on any one page
+    SHOP_BOARD_STATUSES = (Workorder.OPEN, Workorder.COMPLETED)  # a board each
+    SHOP_BOARD_CACHE_ID = 'shopboard'   # both boards are cached together
+    SHOP_BOARD_LIMIT = 200  # entries kept per shop board list
+    SEARCH_PAGE_SIZE = 20   # customers per page of search results
+    UNORDERED_SEARCH_LIMIT = 100    # customers read by a search sorted in memory
+    WORKORDER_PAGE_SIZE = 10    # work order history tabs per page
+    MOVE_BATCH_SIZE = 100   # work orders copied per transaction when moving a vehicle
+    DELETE_ATTEMPTS = 3     # tries at each batch of work orders left behind by a move
+    # Cached lists and the cached tab summaries of the same lists.
+    TAB_SUMMARY_KINDS = {'VehicleList': 'VehicleTabs',
+                         'WorkorderList': 'WorkorderTabs'}
+    # Vehicles and work orders are children of their customer / vehicle.  While
+    # entities saved before that are still around, the list methods also run
+    # the old reference queries; turn this off once
+    # MaintAppMigrations.moveVehiclesIntoCustomerGroups has finished.
+    LEGACY_REFERENCE_LOOKUPS = True
     
     def __init__(self):
          self.__valid = True
          self.missing = []
          self.errTxt = ""
          self.invFld = []
+         self.errors = []
+         # Names of the fields written by the last save call: all of them
+         # for a new record, none if the save found nothing to change.
+         self.changedFields = []
+         # True if the last customer search found more matches than it
+         # could sort in memory (see searchCustomersPage.)
+         self.searchTruncated = False
+         self.__identityMap = RequestIdentityMap()
+         self.__objectCache = ObjectCache()
          return
 
     
@@ -112,55 +330,89 @@ class MaintAppModel(object):
             the UI and the setup of the database.
         """
         pass
-     
-     #---------------------------- customer -----------------------------------------------
-    def chk_id(self,id):
-        return True
     
-    def chk_first_name(self,first_name):
-        status, msg = lenOK(first_name,1,50)
-        return status
-    
-    def chk_last_name(self,last_name):
-        status, msg = lenOK(last_name,1,50)
-        return status
-    
-    def chk_address1(self,address):
-        status, msg = lenOK(address,1,50)
-        return status
- 
-    def chk_address2(self,address):
-          status, msg = lenOK(address,1,50)
-          return status
-      
-    def chk_city(self,city):
-          status, msg = lenOK(city,1,50)
-          return status
-  
-    def chk_state(self,state):
-        status, msg = isState(state)
-        return status
-    
-    def chk_zip(self,zip):
-        status, msg = isZip(zip)
-        return status
-        
-    def chk_phone1(self,phone):
-        status, msg = isPhone(phone)
-        return status
-        
-    def chk_phone2(self,phone):
-        status, msg = isPhone(phone)
-        return status
-    
-    def chk_email(self,email):
-        status,msg = lenOK(email,1,50)
-        return status
-    
-    def chk_comments(self, comments):
-        status, msg = lenOK(comments,1,999)
-        return status
+    def beginRequest(self):
+        """ Start a new unit of work.  Everything read from the datastore from
+            here until endRequest() is kept in the request identity map, so each
+            entity is read at most once no matter how many times the Controller
+            asks for it while handling one button press.  Validation results
+            left over from a previous request are discarded as well.
+        """
+        self.__identityMap = RequestIdentityMap()
+        self.missing = []
+        self.errTxt = ""
+        self.invFld = []
+        self.errors = []
+        self.changedFields = []
+        self.searchTruncated = False
+        return None
+    
+    def endRequest(self):
+        """ Flush the request identity map.  Returns the counters for the
+            request that just finished (see getRequestStats.)
+        """
+        stats = self.getRequestStats()
+        self.__identityMap = RequestIdentityMap()
+        return stats
+    
+    def getRequestStats(self):
+        """ Return a dictionary with the number of lookups answered from the
+            identity map ('hits'), the number of entities read from the
+            datastore ('gets') and the number of queries run ('queries') since
+            the current request began.
+        """
+        return self.__identityMap.getStats()
+    
+    def getCacheStats(self):
+        """ Return the memcache hit/miss counters and hit ratio accumulated by
+            this model instance.
+        """
+        return self.__objectCache.getStats()
+    
+    def __readThrough(self, kind, ident, load):
+        """ Return the object cached in memcache under (kind, ident).  On a
+            miss, build it with load() and cache it unless load() returned None
+            or the entry was invalidated while it was being loaded (see
+            ObjectCache.add.)
+        """
+        value = self.__objectCache.get(kind, ident)
+        if value is None:
+            value = load()
+            if value is not None:
+                self.__objectCache.add(kind, ident, value)
+        return value
+    
+    def __invalidate(self, entries):
+        """ Delete the cached values for a list of (kind, id) pairs, along with
+            the tab summaries of any cached lists among them.
+        """
+        entries = list(entries)
+        for kind, ident in entries[:]:
+            if kind in MaintAppModel.TAB_SUMMARY_KINDS:
+                entries.append((MaintAppModel.TAB_SUMMARY_KINDS[kind], ident))
+        self.__objectCache.invalidate(entries)
+        return None
+    
+    def __getEntity(self, entity_id, model_class):
+        """ Look up the entity whose key is the string entity_id through the
+            request identity map.  Return None if the id is malformed, the
+            entity does not exist or it is not of the kind model_class.
+        """
+        try:
+            key = db.Key(entity_id)
+            if key.kind() != model_class.kind():
+                return None
+        except Exception:
+            return None
+        return self.__identityMap.getEntity(key)
     
+    def __putEntity(self, entity):
+        """ Write the entity and keep the identity map in step with it. """
+        key = entity.put()
+        self.__identityMap.store(entity)
+        return key
+     
+     #---------------------------- customer -----------------------------------------------
     def getInvFldNames(self):
         """ 
         returns a list of field names that need to be highlighted to indicate errors. 
@@ -174,117 +426,70 @@ class MaintAppModel(object):
         """
         given a customer instance,
         returns boolean: True if valid else False
-        for each attribute, 
-             check the attribute by calling corresponding chk_attribute(customer.attribute)
-             Save a list of missing and invalid attributes and add errortext
-             for each missing or invalid field.
-        """
-        for a in customer.__dict__.keys():
-             check_attr_meth = getattr(self, 'chk_'+a, None)
-             if check_attr_meth == None: continue
-             anAttr = getattr(customer, a, None)
-             if isMissing(anAttr):
-                 if a in MaintAppModel.requiredCust:
-                     self.missing.append(a)
-                     self.errTxt += 'missing ' + a + '\n'
-                 else: pass
-             elif check_attr_meth(anAttr)  == False: 
-                  self.invFld.append(a)
-                  self.errTxt += 'invalid ' + a + '\n'    
-        # if there are no required missing fields  or invalid fields, everything is ok
-        return (len(self.missing) + len(self.invFld)) == 0
+        The customer is checked against MaintAppValidation.CUSTOMER_RULES.
+        Save a list of missing and invalid attributes and add errortext
+        for each missing or invalid field; the FieldErrors themselves are
+        kept in self.errors.
+        """
+        self.errors = CUSTOMER_RULES.validate(customer)
+        for error in self.errors:
+            if error.code == MaintAppValidation.MISSING:
+                self.missing.append(error.field)
+            else:
+                self.invFld.append(error.field)
+            self.errTxt += error.message + '\n'
+        return len(self.errors) == 0
     
     def saveCustomerInfo(self, customer):
         """ Write customer object to data store.  If id in customer is '-1',
             create the record; otherwise, update the record.  Return the 
             primary key of the customer (the new one if creating, the existing
             one if updating.)
+            
+            An update only writes the fields changed on the customer object
+            (see MaintAppObjects.TransferObject) that differ from the stored
+            ones, and nothing at all if there are none.  The fields written are
+            left in self.changedFields.
         """
         if self.validateCust(customer) == False: 
            resLst = self.getInvFldNames()
-           raise ValidationErrors(self.errTxt, resLst)
+           raise ValidationErrors(self.errTxt, resLst, self.errors)
        
         if customer.id == '-1':
             entity = None
         else:
-            try:
-                entity = CustomerEnt.get(db.Key(customer.id))
-            except Exception:
-                entity = None
+            entity = self.__getEntity(customer.id, CustomerEnt)
        
         if entity:
-            entity.first_name = customer.first_name
-            entity.last_name = customer.last_name
-            entity.address1 = customer.address1
-            entity.address2 = customer.address2
-            entity.city = customer.city
-            entity.state = customer.state
-            entity.zip = customer.zip
-            entity.phone1 = customer.phone1
-            entity.phone2 = customer.phone2
-            entity.email = customer.email
-            entity.comments = customer.comments
+            dirty = customer.changedFields()
+            self.changedFields = customerMapper.updateEntity(entity, customer, dirty)
+            if not self.changedFields:
+                return str(entity.key())
         else:    
-            entity = CustomerEnt(first_name=customer.first_name,
-                                 last_name=customer.last_name,
-                                 address1=customer.address1,
-                                 address2=customer.address2,
-                                 city=customer.city,
-                                 state=customer.state,
-                                 zip=customer.zip,
-                                 phone1=customer.phone1,
-                                 phone2=customer.phone2,
-                                 email=customer.email,
-                                 comments=customer.comments)
-        key = entity.put()
+            entity = customerMapper.newEntity(customer)
+            self.changedFields = list(Customer.FIELDS)
+        updateCustomerIndexFields(entity)
+        bumpVersion(entity)
+        key = self.__putEntity(entity)
+        self.__objectCache.invalidate([('Customer', str(key))])
         return str(key)
             
     def getCustomerFromCustomerEnt(self, customer_ent):
         """ Create a Customer object from a CustomerEnt; this is a helper method for searchForMatchingCustomers
         """
-        if customer_ent:
-            return Customer(id=str(customer_ent.key()), 
-                            first_name=customer_ent.first_name, 
-                            last_name=customer_ent.last_name,
-                            address1=customer_ent.address1,
-                            address2=customer_ent.address2,
-                            city=customer_ent.city,
-                            state=customer_ent.state,
-                            zip=customer_ent.zip,
-                            phone1=customer_ent.phone1,
-                            phone2=customer_ent.phone2,
-                            email=customer_ent.email,
-                            comments=customer_ent.comments)
-        else:
-            return None
+        return customerMapper.toObject(customer_ent)
 
     def getCustomer(self, customer_id):
         """ Retrieve the customer record from the database whose primary key
             is the customer_id passed in.
         """
-        try:
-        #entity = CustomerEnt.get(db.Key.from_path('CustomerEnt', customer_id))
-            entity = CustomerEnt.get(db.Key(customer_id))
-        except Exception:
-            entity = None
-
-        if entity:
-            return Customer(id=customer_id, 
-                            first_name=entity.first_name, 
-                            last_name=entity.last_name,
-                            address1=entity.address1,
-                            address2=entity.address2,
-                            city=entity.city,
-                            state=entity.state,
-                            zip=entity.zip,
-                            phone1=entity.phone1,
-                            phone2=entity.phone2,
-                            email=entity.email,
-                            comments=entity.comments)
-        else:
-            return None
+        return self.__readThrough('Customer', customer_id,
+                                  lambda: self.__loadCustomer(customer_id))
+        
+    def __loadCustomer(self, customer_id):
+        return customerMapper.toObject(self.__getEntity(customer_id, CustomerEnt))
         
-    def searchForMatchingCustomers(self, searchCriteria):
+    def searchForMatchingCustomers(self, searchCriteria, cursor=None, prefixSearch=False):
         """ The model forms a query based on AND logic for the various
             fields that have been entered into the searchCriteria object.
             The searchCriteria object is an instance of the Customer class.
@@ -294,334 +499,909 @@ class MaintAppModel(object):
             In the future we may consider supporting wild card matching.
             A list of Customer objects corresponding to the customer records
             The objects in the list are ordered by last_name, then first_name
+            Only one page of results is returned; see searchCustomersPage
+            (which also covers searches the datastore cannot sort.)
         """
-        result = []
-        limit = 50 # return at most 50 customers matching the search criteria
-        query_string = ""
-        if searchCriteria.first_name: 
-            query_string += " AND first_name='" + searchCriteria.first_name + "'"
-        if searchCriteria.last_name: 
-            query_string += " AND last_name='" + searchCriteria.last_name + "'"
-        if searchCriteria.address1: 
-            query_string += " AND address1='" + searchCriteria.address1 + "'"
-        if searchCriteria.city: 
-            query_string += " AND city='" + searchCriteria.city + "'"
-        if searchCriteria.state: 
-            query_string += " AND state='" + searchCriteria.state + "'"
-        if searchCriteria.zip: 
-            query_string += " AND zip='" + searchCriteria.zip + "'"
-        if searchCriteria.phone1: 
-            query_string += " AND phone1='" + searchCriteria.phone1 + "'"
-        if searchCriteria.email: 
-            query_string += " AND email='" + searchCriteria.email + "'"
+        customers, next_cursor = self.searchCustomersPage(searchCriteria, cursor,
+                                                          prefixSearch=prefixSearch)
+        return customers
+    
+    def searchCustomersPage(self, searchCriteria, cursor=None, limit=None,
+                            prefixSearch=False):
+        """ Return one page of the customers matching searchCriteria (see
+            searchForMatchingCustomers) as a (customer list, next page cursor)
+            pair.  cursor is the value returned for the previous page, or None
+            for the first page; the returned cursor is None on the last page.
+            A cursor that does not belong to the query (e.g. the criteria were
+            edited between pages) starts over at the first page.
+            
+            With prefixSearch, the first and last name criteria are matched
+            case-insensitively against the start of any word of either name
+            ("gai" finds Gaiser) through the name_prefixes index.
             
-        if query_string != "":
-            query_string = "WHERE " + query_string[5:] # replace the beginning AND by WHERE
-        query_string += " ORDER BY last_name, first_name"
+            Only the combinations of fields that customerSearchPlanner finds
+            an index for are sorted by the query.  The rest are answered from
+            the single property indexes without an ORDER BY, so they are not
+            paged: up to UNORDERED_SEARCH_LIMIT matches are read and sorted in
+            memory as one page, with no next page cursor.  searchTruncated is
+            set when there were more matches than that, for the user to be
+            asked to narrow the search down.  Each search logs its pattern for
+            IndexAdvisor.
+        """
+        result = []
+        self.searchTruncated = False
+        if limit is None:
+            limit = MaintAppModel.SEARCH_PAGE_SIZE
+        if self.__isPhoneOnlySearch(searchCriteria):
+            return (self.findCustomersByPhone(searchCriteria.phone1), None)
+        conditions = []
+        params = {}
+        longWords = []
+        for field in CUSTOMER_SEARCH_FIELDS:
+            value = getattr(searchCriteria, field)
+            if not value:
+                continue
+            if prefixSearch and field in ('first_name', 'last_name'):
+                for word in splitNameWords(value):
+                    param = 'name_prefix%d' % len(params)
+                    conditions.append(('name_prefixes', param))
+                    params[param] = word[:MAX_PREFIX_LENGTH]
+                    if len(word) > MAX_PREFIX_LENGTH:
+                        longWords.append(word)
+            elif field == 'phone1':
+                # Match either phone number whatever its formatting.
+                conditions.append(('phone_digits', field))
+                params[field] = normalizePhone(value)
+            else:
+                conditions.append((field, field))
+                params[field] = value
         
-        #print "query_string: " + query_string
-        query = CustomerEnt.gql(query_string)
-        customers = query.fetch(limit) 
-        for customer_ent in customers:
-            result.append(self.getCustomerFromCustomerEnt(customer_ent))
-        return result
-         
-    #---------------------------- vehicle -----------------------------------------------
-    def chk_make(self, make):
-        if isMissing(zip):
-           self.missing.append('make')
-           return False
-        status,msg = lenOK(make,1,30)
-        if len(msg):
-            self.invFld.append('make')
-            self.errTxt += 'make ' + msg  + '\n'
-        return status
-      
-    def chk_model(self, model):
-        if isMissing(model):
-           self.missing.append('zip')
-           return False
-        status,msg = lenOK(model,1,30)
-        if len(msg):
-            self.invFld.append('model')
-            self.errTxt += 'model ' + msg  + '\n'
-        return status
-      
-    def chk_year(self, year):
-        if isMissing(zip):
-           self.missing.append('year')
-           return False
-        if (year.isdigit() == False):
-            self.invFld.append('year')
-            self.errTxt += 'year must be a 4-digit number\n'
-            return False
-        maxYr = datetime.today().year + 3
-        if (int(year) < 1925) | (int(year) > maxYr) :
-            self.invFld.append('year')
-            self.errTxt += 'year must be between 1925 and 2 years after current year\n'
-            return False
-        status,msg = lenOK(year,4,4)
-        if len(msg):
-            self.invFld.append('year')
-            self.errTxt += 'year ' + msg  + '\n'
-        return status
-      
-    def chk_license(self, license):
-        if isMissing(zip):
-           self.missing.append('license')
-           return False
-        status,msg = lenOK(license,1,30)
-        if len(msg):
-            self.invFld.append('liense')
-            self.errTxt += 'license ' + msg  + '\n'
-        return status
-      
-    def chk_vin(self, vin):
-        # Note:  see http://www.vinguard.org/vin.htm for the full story. This is not a complete check
-        # For example, the year is encoded (vin[9]) as well as a check digit (vin[8])
-        if isMissing(vin):
-            return True
-        if (vin.isalnum() == False):
-            self.invFld.append('vin')
-            self.errTxt += 'vin must be only numbers and letters\n'
+        equalities = [c[0] for c in conditions]
+        ordered = customerSearchPlanner.isOrdered(equalities)
+        logging.info("%s %s", PATTERN_MARKER, ",".join(sorted(set(equalities))))
+        query = compiledCustomerSearch(tuple(conditions), ordered)
+        query.bind(**params)
+        if not ordered:
+            # Pages of an unsorted query would each be sorted on their own.
+            cursor = None
+            limit = MaintAppModel.UNORDERED_SEARCH_LIMIT
+        try:
+            query.with_cursor(cursor)
+            customers = query.fetch(limit)
+        except Exception:
+            if not cursor:
+                raise
+            query.with_cursor(None)
+            customers = query.fetch(limit)
+        if len(customers) < limit:
+            next_cursor = None
+        elif ordered:
+            next_cursor = query.cursor()
+        else:
+            next_cursor = None
+            self.searchTruncated = True
+            logging.warning("unordered customer search on %s stopped at %d matches",
+                            ",".join(sorted(set(equalities))), limit)
+        if longWords:
+            customers = [c for c in customers
+                         if self.__hasNameWords(c, longWords)]
+        if not ordered:
+            customers.sort(key=lambda c: (c.last_name or "", c.first_name or ""))
+        return (customerMapper.toObjects(customers), next_cursor)
+    
+    def __isPhoneOnlySearch(self, searchCriteria):
+        if not searchCriteria.phone1:
             return False
-        status,msg = lenOK(vin,16,17)
-        if len(msg):
-            self.invFld.append('vin')
-            self.errTxt += 'vin ' + msg  + '\n'
-        return status
-      
-    def chk_notes(self, notes):
-        if isMissing(notes):
-            return True
-        status,msg = lenOK(notes,1,999)
-        if len(msg):
-            self.invFld.append('notes')
-            self.errTxt += 'notes ' + msg  + '\n'
-        return status
+        for field in CUSTOMER_SEARCH_FIELDS:
+            if field != 'phone1' and getattr(searchCriteria, field):
+                return False
+        return True
     
+    def findCustomersByPhone(self, phone):
+        """ Fast path for looking up a caller: return the customers whose
+            primary or secondary phone number matches phone, in any format.
+            This is a single equality query on the phone_digits index (no
+            composite index needed); the handful of matches are sorted by
+            last_name, first_name in memory.
+        """
+        digits = normalizePhone(phone)
+        if not digits:
+            return []
+        query = CustomerEnt.all().filter('phone_digits =', digits)
+        customers = query.fetch(MaintAppModel.UNORDERED_SEARCH_LIMIT)
+        customers.sort(key=lambda c: (c.last_name or "", c.first_name or ""))
+        return customerMapper.toObjects(customers)
     
+    def __hasNameWords(self, customer_ent, words):
+        """ True if every word starts some word of the customer's names. """
+        nameWordList = nameWords(customer_ent.first_name) + \
+                       nameWords(customer_ent.last_name)
+        for word in words:
+            for nameWord in nameWordList:
+                if nameWord.startswith(word):
+                    break
+            else:
+                return False
+        return True
+         
+    #---------------------------- vehicle -----------------------------------------------
     def saveVehicleInfo(self, vehicle):
         """ Write vehicle object to data store.  If id in vehicle object is
             -1, create the record; otherwise, update the existing record
             in the database.  Return primary key of the vehicle.
+            
+            Vehicles are stored in their owner's entity group.  Saving a
+            vehicle that is not in its owner's group (it changed hands, or was
+            saved before vehicles were grouped) moves it there, which gives it
+            a new key; see regroupVehicle.
+            
+            As with customers, an update writes only the changed fields and is
+            skipped if nothing changed (see saveCustomerInfo.)
         """
         if vehicle.id == '-1':
             entity = None
         else:
-            try:
-            #entity = VehicleEnt.get_by_key_name(str(vehicle.id))
-            #entity = VehicleEnt.get(db.Key.from_path('VehicleEnt', vehicle.id))
-                entity = VehicleEnt.get(db.Key(vehicle.id))
-            except Exception:
-                entity = None
-        
-        customer_ent = CustomerEnt.get(db.Key(vehicle.customer_id))    
-        #print "-- In saveVehicleInfo, customer_ent: ", customer_ent
+            entity = self.__getEntity(vehicle.id, VehicleEnt)
+        previous_customer = None
+        previous_label = None
         if entity:
-            entity.make = vehicle.make
-            entity.model = vehicle.model
-            entity.year = int(vehicle.year)
-            entity.license = vehicle.license
-            entity.vin = vehicle.vin
-            entity.notes = vehicle.notes
-            entity.customer = customer_ent
+            previous_customer = vehicleOwnerKey(entity)
+            previous_label = vehicleLabel(entity)
+        
+        # A ReferenceProperty accepts the key itself, so there is no need to
+        # fetch the customer just to link the vehicle to it.  The reference is
+        # kept alongside the parent key for the reference queries of entities
+        # that are not grouped yet.
+        customer_key = db.Key(vehicle.customer_id)
+        if entity:
+            dirty = vehicle.changedFields()
+            self.changedFields = vehicleMapper.updateEntity(entity, vehicle, dirty)
+            if referenceKey(entity, VehicleEnt.customer) != customer_key:
+                entity.customer = customer_key
+                self.changedFields.append('customer_id')
+            if not self.changedFields:
+                return str(entity.key())
         else:    
-            entity = VehicleEnt(make=vehicle.make,
-                                model=vehicle.model,
-                                year=int(vehicle.year),
-                                license=vehicle.license,
-                                vin=vehicle.vin,
-                                notes=vehicle.notes,
-                                customer=customer_ent)
+            entity = vehicleMapper.newEntity(vehicle, parent=customer_key,
+                                             customer=customer_key)
+            self.changedFields = list(Vehicle.FIELDS)
         
-        key = entity.put()
+        updateVehicleIndexFields(entity)
+        bumpVersion(entity)
+        if entity.is_saved() and entity.key().parent() != customer_key:
+            key = self.__moveVehicle(entity, customer_key)
+        else:
+            key = self.__putEntity(entity)
+        stale = [('Vehicle', str(key)), ('VehicleList', str(customer_key))]
+        if previous_customer is not None and previous_customer != customer_key:
+            stale.append(('VehicleList', str(previous_customer)))
+        self.__invalidate(stale)
+        if previous_label is not None and previous_label != vehicleLabel(entity):
+            self.__relabelShopBoard(str(key), vehicleLabel(entity))
         return str(key)
     
     def getVehicleFromVehicleEnt(self, vehicle_ent):
         """ Create a Vehicle object from a VehicleEnt; this is a helper method for getVehicleList
         """
-        customer_key = '-1'
-        if vehicle_ent:
-            if vehicle_ent.customer:
-                customer_key = str(vehicle_ent.customer.key())
-                
-            #print "--In getVehicleFromVehicleEnt, customer_key: " + customer_key    
-            #print "--In getVehicleFromVehicleEnt, customer object:", vehicle_ent.customer    
-            return Vehicle(id=str(vehicle_ent.key()), 
-                           make=vehicle_ent.make, 
-                           model=vehicle_ent.model, 
-                           year=str(vehicle_ent.year),
-                           license=vehicle_ent.license,
-                           vin=vehicle_ent.vin,
-                           notes=vehicle_ent.notes,
-                           customer_id=customer_key)
-        else:
-            return None
+        return vehicleMapper.toObject(vehicle_ent)
 
     def getVehicle(self, vehicle_id):
         """ Retrieve the vehicle record from the database whose primary key
             is the vehicle_id passed in.
         """
-        try:
-            entity = VehicleEnt.get(db.Key(vehicle_id))
-        except Exception:
-            entity = None
-        return self.getVehicleFromVehicleEnt(entity)
+        return self.__readThrough('Vehicle', vehicle_id,
+                                  lambda: self.getVehicleFromVehicleEnt(
+                                              self.__getEntity(vehicle_id, VehicleEnt)))
             
-    def getVehicleList(self, customer_id):
+    def getVehicleList(self, customer_id, summary=False):
         """ This method queries the database for vehicles records belonging
             to the customer identified by customer_id. Return an empty list
             if no vehicles are found.
+            
+            With summary, the Vehicle objects only carry what the vehicle tabs
+            need (id, year and make.)  They come from a projection query, so
+            the rest of each vehicle is never read or decoded; use getVehicle
+            for the one being displayed.
         """
+        if summary:
+            return self.__readThrough('VehicleTabs', customer_id,
+                                      lambda: self.__loadVehicleTabs(customer_id))
+        return self.__readThrough('VehicleList', customer_id,
+                                  lambda: self.__loadVehicleList(customer_id))
+    
+    def __loadVehicleList(self, customer_id):
+        result = []
+        limit = 10 # get at most 10 vehicle for each customer
+        try:
+            customer_key = db.Key(customer_id)
+        except Exception:
+            return result
+        
+        # An ancestor query is strongly consistent (a vehicle just saved is
+        # always listed) and needs no composite index.
+        query = VehicleEnt.all().ancestor(customer_key)
+        legacy = VehicleEnt.all().filter('customer =', customer_key)
+        vehicles = self.__identityMap.query(('VehicleEnt.ancestor', str(customer_key)),
+                                            lambda: self.__fetchGroup(query, legacy, limit))
+        return vehicleMapper.toObjects(vehicles)
+    
+    def __loadVehicleTabs(self, customer_id):
         result = []
         limit = 10 # get at most 10 vehicle for each customer
         try:
-            customer = CustomerEnt.get(db.Key(customer_id))
+            customer_key = db.Key(customer_id)
         except Exception:
             return result
         
-        query = VehicleEnt.gql("WHERE customer = :key", key=customer)
-        vehicles = query.fetch(limit) 
-        for vehicle_ent in vehicles:
-            result.append(self.getVehicleFromVehicleEnt(vehicle_ent))
+        fields = ('year', 'make')
+        query = VehicleEnt.all(projection=fields).ancestor(customer_key)
+        legacy = VehicleEnt.all(projection=fields).filter('customer =', customer_key)
+        # Projected entities are incomplete, so they stay out of the identity map.
+        return vehicleMapper.toObjects(self.__fetchGroup(query, legacy, limit),
+                                       fields, customer_id=customer_id)
+    
+    def __fetchGroup(self, query, legacy, limit):
+        """ Run the ancestor query and, while LEGACY_REFERENCE_LOOKUPS is on,
+            top the results up from the reference query for entities that are
+            not in the group yet.
+        """
+        entities = query.fetch(limit)
+        if MaintAppModel.LEGACY_REFERENCE_LOOKUPS and len(entities) < limit:
+            seen = set([entity.key() for entity in entities])
+            for entity in legacy.fetch(limit):
+                if entity.key() not in seen and len(entities) < limit:
+                    entities.append(entity)
+        return entities
+    
+    def regroupVehicle(self, vehicle_id):
+        """ Move a vehicle saved before vehicles were kept in their owner's
+            entity group (or whose parent no longer matches its owner) into
+            its owner's group.  Return the vehicle's new id, or vehicle_id if
+            it was already in place or has no owner.
+        """
+        entity = self.__getEntity(vehicle_id, VehicleEnt)
+        if entity is None:
+            return vehicle_id
+        customer_key = referenceKey(entity, VehicleEnt.customer)
+        if customer_key is None or entity.key().parent() == customer_key:
+            return vehicle_id
+        key = self.__moveVehicle(entity, customer_key)
+        self.__invalidate([('VehicleList', str(customer_key))])
+        return str(key)
+    
+    def __moveVehicle(self, vehicle_ent, customer_key):
+        """ Copy vehicle_ent, with its current (possibly unsaved) values, and
+            all of its work orders into the entity group of customer_key, then
+            delete the originals.  Returns the new vehicle key.
+            
+            The work orders are copied MOVE_BATCH_SIZE at a time, each batch in
+            a transaction of its own, under a key allocated for the new
+            vehicle.  The new vehicle is only written once they all are, in the
+            same (cross-group) transaction that deletes the old one, so the
+            vehicle is never listed twice, nor in its new group without its
+            history.  The old work orders go last; see __deleteWorkorders.
+        """
+        old_key = vehicle_ent.key()
+        first, last = db.allocate_ids(db.Key.from_path(VehicleEnt.kind(), 1,
+                                                       parent=customer_key), 1)
+        new_key = db.Key.from_path(VehicleEnt.kind(), first, parent=customer_key)
+        
+        def copy(workorder_ents, detail_ents):
+            copies = [cloneEntity(ent, new_key, vehicle=new_key)
+                      for ent in workorder_ents]
+            db.put(copies)
+            details = []
+            for copied, detail_ent in zip(copies, detail_ents):
+                if detail_ent is not None:
+                    details.append(cloneEntity(detail_ent, copied.key(),
+                                               key_name=WorkorderDetailEnt.KEY_NAME))
+            if details:
+                db.put(details)
+            return copies
+        
+        moved = {}
+        # The reference query finds grouped and ungrouped work orders alike.
+        query = WorkorderEnt.all().filter('vehicle =', old_key)
+        while True:
+            workorder_ents = query.fetch(MaintAppModel.MOVE_BATCH_SIZE)
+            if not workorder_ents:
+                break
+            detail_ents = db.get([WorkorderDetailEnt.keyFor(ent.key())
+                                  for ent in workorder_ents])
+            copies = db.run_in_transaction(copy, workorder_ents, detail_ents)
+            for ent, copied in zip(workorder_ents, copies):
+                moved[str(ent.key())] = str(copied.key())
+                self.__identityMap.store(copied)
+            if len(workorder_ents) < MaintAppModel.MOVE_BATCH_SIZE:
+                break
+            query.with_cursor(query.cursor())
+        
+        def switch():
+            new_vehicle = cloneEntity(vehicle_ent, None, key=new_key,
+                                      customer=customer_key)
+            new_vehicle.put()
+            db.delete(old_key)
+            return new_vehicle
+        
+        new_vehicle = db.run_in_transaction_options(
+                          db.create_transaction_options(xg=True), switch)
+        self.__identityMap.store(new_vehicle)
+        self.__deleteWorkorders(old_key)
+        self.__identityMap.discard([old_key] + [db.Key(workorder_id)
+                                                for workorder_id in moved])
+        
+        stale = [('Vehicle', str(old_key)), ('WorkorderList', str(old_key))]
+        stale.extend([('Workorder', workorder_id) for workorder_id in moved])
+        if old_key.parent() is not None:
+            stale.append(('VehicleList', str(old_key.parent())))
+        self.__invalidate(stale)
+        if moved:
+            # The board lists work orders by id.
+            old_id = str(old_key)
+            new_id = str(new_key)
+            def rekey(fields):
+                if fields[1] == old_id:
+                    fields[0] = moved.get(fields[0], fields[0])
+                    fields[1] = new_id
+                return fields
+            self.__patchShopBoard(rekey)
+        return new_key
+    
+    def __deleteWorkorders(self, vehicle_key):
+        """ Delete the work orders, and their text, still referencing the
+            (deleted) vehicle_key, MOVE_BATCH_SIZE at a time.  Deleting is
+            idempotent, so a batch that fails is tried again, up to
+            DELETE_ATTEMPTS times.  Work orders left after that are only
+            logged: the queues skip work orders whose vehicle is gone, and
+            MaintAppMigrations.deleteOrphanedWorkorders clears them later.
+        """
+        query = WorkorderEnt.all(keys_only=True).filter('vehicle =', vehicle_key)
+        while True:
+            keys = query.fetch(MaintAppModel.MOVE_BATCH_SIZE)
+            batch = keys + [WorkorderDetailEnt.keyFor(key) for key in keys]
+            for attempt in range(MaintAppModel.DELETE_ATTEMPTS):
+                try:
+                    db.delete(batch)
+                    break
+                except (db.Timeout, db.InternalError):
+                    if attempt + 1 == MaintAppModel.DELETE_ATTEMPTS:
+                        logging.warning("could not delete %d work orders of moved vehicle %s",
+                                        len(keys), vehicle_key)
+            if len(keys) < MaintAppModel.MOVE_BATCH_SIZE:
+                break
+            query.with_cursor(query.cursor())
+        return None
+    
+    def findVehiclesByPlateOrVin(self, text):
+        """ Look a vehicle up by license plate or VIN, in any formatting.  Return
+            a list of (customer, vehicle) tuples for the matching vehicles.
+            A keys-only query on the plate_codes index finds the vehicles; the
+            vehicles and their owners (the parent keys) are then read with a
+            single batched get.
+        """
+        code = normalizePlate(text)
+        if not code:
+            return []
+        query = VehicleEnt.all(keys_only=True).filter('plate_codes =', code)
+        keys = query.fetch(MaintAppModel.SEARCH_PAGE_SIZE)
+        owner_keys = [key.parent() for key in keys if key.parent() is not None]
+        entities = self.__identityMap.getEntities(keys + owner_keys)
+        vehicle_ents = [ent for ent in entities[:len(keys)] if ent is not None]
+        customer_keys = [vehicleOwnerKey(ent) for ent in vehicle_ents]
+        customer_ents = self.__identityMap.getEntities(
+                            [key for key in customer_keys if key is not None])
+        customers = {}
+        for customer_ent in customer_ents:
+            if customer_ent is not None:
+                customers[customer_ent.key()] = customer_ent
+        
+        result = []
+        for vehicle_ent, customer_key in zip(vehicle_ents, customer_keys):
+            customer_ent = customers.get(customer_key)
+            if customer_ent is None:
+                continue # Vehicle with no owner on file.
+            result.append((self.getCustomerFromCustomerEnt(customer_ent),
+                           self.getVehicleFromVehicleEnt(vehicle_ent)))
         return result
     
     #---------------------------- work order -----------------------------------------------
     def saveWorkorder(self, workorder):
         """ Write contents of workorder object to data store.  If id in workorder
             object is -1, create the record; otherwise, update the existing record
-            in the database.  Return primary key of the workorder.
+            in the database.  Return primary key of the workorder.  New work
+            orders are created as children of their vehicle, which puts them in
+            the owning customer's entity group.  The text fields go to the work
+            order's WorkorderDetailEnt, written in the same transaction.
+            
+            An update writes the WorkorderEnt only if one of its fields changed
+            and the WorkorderDetailEnt only if the text did (which is the only
+            time the text is read); see saveCustomerInfo.
+            
+            The shop board is updated in the same (cross-group) transaction,
+            so the board cannot miss a saved change or list one that failed.
         """
         if workorder.id == '-1':
             entity = None
         else:
-            try:
-                entity = WorkorderEnt.get(db.Key(workorder.id))
-            except Exception:
-                entity = None
+            entity = self.__getEntity(workorder.id, WorkorderEnt)
+        previous_vehicle = None
+        previous_board_info = (None, None, None)
+        if entity:
+            previous_vehicle = referenceKey(entity, WorkorderEnt.vehicle)
+            previous_board_info = (entity.status, entity.mechanic, previous_vehicle)
 
-        vehicle_ent = VehicleEnt.get(db.Key(workorder.vehicle_id))    
+        vehicle_key = db.Key(workorder.vehicle_id)
+        detail = None
         if entity:
-            entity.mileage = int(workorder.mileage)
-            entity.status = workorder.status
-            entity.date_created = workorder.date_created
-            entity.customer_request = workorder.customer_request
-            entity.mechanic = workorder.mechanic
-            entity.task_list = workorder.task_list
-            entity.work_performed = workorder.work_performed
-            entity.notes = workorder.notes
-            entity.date_closed = workorder.date_closed
-            entity.vehicle = vehicle_ent
+            dirty = workorder.changedFields()
+            changed = workorderMapper.updateEntity(entity, workorder, dirty)
+            if previous_vehicle != vehicle_key:
+                entity.vehicle = vehicle_key
+                changed.append('vehicle_id')
+            text = [f for f in Workorder.DETAIL_FIELDS if f in dirty]
+            moved = entity.customer_request is not None
+            if moved:
+                # Text saved before WorkorderDetailEnt existed moves out on save.
+                detail = WorkorderDetailEnt(parent=entity.key(),
+                                            key_name=WorkorderDetailEnt.KEY_NAME,
+                                            **workorderDetail(entity))
+                for field in Workorder.DETAIL_FIELDS:
+                    setattr(entity, field, None)
+            elif text:
+                detail = self.__identityMap.getEntity(WorkorderDetailEnt.keyFor(entity.key()))
+                if detail is None:
+                    detail = WorkorderDetailEnt(parent=entity.key(),
+                                                key_name=WorkorderDetailEnt.KEY_NAME,
+                                                customer_request=workorder.customer_request)
+            text_changed = []
+            if detail is not None:
+                text_changed = detailMapper.updateEntity(detail, workorder, text)
+            self.changedFields = changed + text_changed
+            put_entity = bool(changed) or moved
+            put_detail = bool(text_changed) or moved
+            if not (put_entity or put_detail):
+                return str(entity.key())
         else:    
-            entity = WorkorderEnt(mileage=int(workorder.mileage),
-                                  status=workorder.status,
-                                  date_created=workorder.date_created,
-                                  customer_request=workorder.customer_request,
-                                  mechanic=workorder.mechanic,
-                                  task_list=workorder.task_list,
-                                  work_performed=workorder.work_performed,
-                                  notes=workorder.notes,
-                                  date_closed=workorder.date_closed,
-                                  vehicle = vehicle_ent)
-        key = entity.put()
+            entity = workorderMapper.newEntity(workorder, parent=vehicle_key,
+                                               vehicle=vehicle_key)
+            self.changedFields = list(Workorder.FIELDS)
+            put_entity = put_detail = True
+        
+        # The shop board only lists status, vehicle and mechanic, so it only
+        # needs touching when one of those changed (or the work order is new.)
+        board_changed = previous_board_info != (entity.status, entity.mechanic, vehicle_key)
+        if board_changed:
+            label = self.__boardLabel(vehicle_key)
+        
+        def save():
+            if put_entity:
+                key = entity.put()
+            else:
+                key = entity.key()
+            saved = detail
+            if saved is None and put_detail:
+                saved = detailMapper.newEntity(workorder, parent=key,
+                                               key_name=WorkorderDetailEnt.KEY_NAME)
+            if put_detail:
+                saved.put()
+            if board_changed:
+                self.__updateShopBoard(key, entity, label, previous_board_info[0])
+            return key, saved
+        
+        key, detail = db.run_in_transaction_options(
+                          db.create_transaction_options(xg=True), save)
+        self.__identityMap.store(entity)
+        if detail is not None:
+            self.__identityMap.store(detail)
+        stale = [('Workorder', str(key)), ('WorkorderList', str(vehicle_key))]
+        if previous_vehicle is not None and previous_vehicle != vehicle_key:
+            stale.append(('WorkorderList', str(previous_vehicle)))
+        if board_changed:
+            stale.append(('ShopBoard', MaintAppModel.SHOP_BOARD_CACHE_ID))
+        self.__invalidate(stale)
         return str(key)
     
-    def getWorkorderFromWorkorderEnt(self, workorder_ent):
+    def getWorkorderFromWorkorderEnt(self, workorder_ent, detail_ent=None):
         """ Create a Workorder object from a WorkorderEnt; this is a helper method for getWorkorferList
+            The text fields come from detail_ent, the WorkorderDetailEnt, when
+            given, and are decompressed as they are used.  Otherwise they are
+            left to be loaded if and when they are used (see
+            Workorder.detailLoader.)
         """
-        vehicle_key = '-1'
-        if workorder_ent:
-            if workorder_ent.vehicle:
-                vehicle_key = str(workorder_ent.vehicle.key())
-                
-            return Workorder(id=str(workorder_ent.key()), 
-                             mileage=workorder_ent.mileage, 
-                             status=workorder_ent.status, 
-                             date_created=workorder_ent.date_created,
-                             customer_request=workorder_ent.customer_request,
-                             mechanic=workorder_ent.mechanic,
-                             task_list=workorder_ent.task_list,
-                             work_performed=workorder_ent.work_performed,
-                             notes=workorder_ent.notes,
-                             date_closed=workorder_ent.date_closed,
-                             vehicle_id=vehicle_key)
-        else:
+        if workorder_ent is None:
             return None
+        if detail_ent is not None:
+            return workorderMapper.toObject(workorder_ent,
+                                            _detail=workorderDetail(detail_ent))
+        if workorder_ent.customer_request is not None:
+            # Not migrated yet; the text is still inline.
+            return workorderMapper.toObject(workorder_ent,
+                                            _detail=workorderDetail(workorder_ent))
+        return workorderMapper.toObject(workorder_ent)
 
     def getWorkorder(self, workorder_id):
         """ Return the workorder record whose id is given by the workorder_id
-            parameter.
+            parameter.  The work order and its text are read with one batched
+            get.
         """
+        return self.__readThrough('Workorder', workorder_id,
+                                  lambda: self.__loadWorkorder(workorder_id))
+    
+    def __loadWorkorder(self, workorder_id):
         try:
-            entity = WorkorderEnt.get(db.Key(workorder_id))
+            key = db.Key(workorder_id)
+            if key.kind() != WorkorderEnt.kind():
+                return None
         except Exception:
-            entity = None
-        return self.getWorkorderFromWorkorderEnt(entity)
+            return None
+        workorder_ent, detail_ent = self.__identityMap.getEntities(
+                                        [key, WorkorderDetailEnt.keyFor(key)])
+        return self.getWorkorderFromWorkorderEnt(workorder_ent, detail_ent)
     
     def getWorkorderList(self, vehicle_id):
-        """ Return the list of workorders belonging to the vehicle identified
-            by vehicle_id.  Return an empty list if no workorders are found.
+        """ Return the most recent workorders belonging to the vehicle
+            identified by vehicle_id (the first page of
+            getWorkorderHistoryPage.)  Return an empty list if no workorders
+            are found.
         """
-        result = []
-        limit = 10 # get at most 10 workorder for each vehicle
+        workorders, next_cursor = self.getWorkorderHistoryPage(vehicle_id)
+        return workorders
+    
+    def getWorkorderHistoryPage(self, vehicle_id, cursor=None, limit=None,
+                                summary=False):
+        """ Return one page of the work order history of the vehicle identified
+            by vehicle_id, newest first, as a (workorder list, next page cursor)
+            pair.  cursor is the value returned for the previous page, or None
+            for the first page; the returned cursor is None on the last page.
+            
+            The page is read from the ancestor -date_created index with a
+            keys-only query followed by one batched get, so it costs the same
+            however many visits the vehicle has had.  The first page is cached.
+            Vehicles not yet moved into their owner's group are read from the
+            (vehicle, -date_created) index instead, while
+            LEGACY_REFERENCE_LOOKUPS is on; that query is only eventually
+            consistent, so their first page is not cached.
+            
+            With summary, the Workorder objects only carry their id, vehicle
+            id and date_created, which is all the work order tabs show.  The
+            page is then a projection query on the same index and the work
+            order text is not read at all; use getWorkorder for the one being
+            displayed.  Cursors from summary and full pages are not
+            interchangeable.
+        """
+        if limit is None:
+            limit = MaintAppModel.WORKORDER_PAGE_SIZE
         try:
-            vehicle = VehicleEnt.get(db.Key(vehicle_id))
+            vehicle_key = db.Key(vehicle_id)
         except Exception:
-            return result
+            return ([], None)
+        if (cursor is None and limit == MaintAppModel.WORKORDER_PAGE_SIZE and
+            not self.__isUngrouped(vehicle_key)):
+            if summary:
+                kind = 'WorkorderTabs'
+            else:
+                kind = 'WorkorderList'
+            return self.__readThrough(kind, vehicle_id,
+                                      lambda: self.__loadWorkorderPage(vehicle_key, None,
+                                                                       limit, summary))
+        return self.__loadWorkorderPage(vehicle_key, cursor, limit, summary)
+    
+    def __isUngrouped(self, vehicle_key):
+        """ True if the work orders of the vehicle may not be in its entity
+            group yet.  Grouped vehicles only ever get work orders as their
+            children (new ones are created there and __moveVehicle copies the
+            rest there), so only root vehicles need the reference query.
+        """
+        return MaintAppModel.LEGACY_REFERENCE_LOOKUPS and vehicle_key.parent() is None
+    
+    def __loadWorkorderPage(self, vehicle_key, cursor, limit, summary):
+        if summary:
+            query = WorkorderEnt.all(projection=('date_created',))
+        else:
+            query = WorkorderEnt.all(keys_only=True)
+        if self.__isUngrouped(vehicle_key):
+            # Also finds the work orders not yet moved into the vehicle's group.
+            query.filter('vehicle =', vehicle_key)
+        else:
+            query.ancestor(vehicle_key)
+        query.order('-date_created')
+        try:
+            query.with_cursor(cursor)
+            rows = query.fetch(limit)
+        except Exception:
+            # Not a cursor for this query (e.g. from before the migration.)
+            if not cursor:
+                raise
+            query.with_cursor(None)
+            rows = query.fetch(limit)
+        if len(rows) == limit:
+            next_cursor = query.cursor()
+        else:
+            next_cursor = None
         
-        query = WorkorderEnt.gql("WHERE vehicle = :key", key=vehicle)
-        workorders = query.fetch(limit) 
-        for workorder_ent in workorders:
-            result.append(self.getWorkorderFromWorkorderEnt(workorder_ent))
-        return result
+        if summary:
+            return (workorderMapper.toObjects(rows, ('date_created',),
+                                              vehicle_id=str(vehicle_key)),
+                    next_cursor)
+        result = []
+        for workorder_ent in self.__identityMap.getEntities(rows):
+            if workorder_ent is not None:
+                result.append(self.getWorkorderFromWorkorderEnt(workorder_ent))
+        return (result, next_cursor)
     
-    def getOpenWorkorders(self):
+    def getOpenWorkorders(self, cursor=None):
         """ Query the database for all work orders where the work order status
             is 'open'.  Also retrieve the vehicle associated with each
             work order.  Return a list of (vehicle, workorder) tuples filled in
-            with the results of the query.
+            with the results of the query.  At most STATUS_PAGE_SIZE work orders
+            are returned, newest first; pass the cursor from getWorkorderQueue
+            to continue with the next page.
         """
-        return []
+        workorders, next_cursor = self.getWorkorderQueue(Workorder.OPEN, cursor)
+        return workorders
     
-    def getCompletedWorkorders(self):
+    def getCompletedWorkorders(self, cursor=None):
         """ Query the database for all work orders where the work order status
             is 'completed'.  Also retrieve the vehicle associated with each
             work order.  Return a list of (vehicle, workorder) tuples filled in
-            with the results of the query.
+            with the results of the query.  Paged the same way as
+            getOpenWorkorders.
         """
-        return []
+        workorders, next_cursor = self.getWorkorderQueue(Workorder.COMPLETED, cursor)
+        return workorders
+    
+    def getWorkorderQueue(self, status, cursor=None, limit=None):
+        """ Return one page of the work orders with the given status as a
+            ((vehicle, workorder) tuple list, next page cursor) pair.  The cursor
+            is None when there are no more pages.
+            
+            The page is served from the (status, -date_created) index with a
+            keys-only query, then the work orders and their vehicles are each
+            read with one batched get, so the cost of a page is fixed no matter
+            how many work orders are waiting in the shop.  limit is capped at
+            STATUS_PAGE_LIMIT.
+        """
+        if limit is None:
+            limit = MaintAppModel.STATUS_PAGE_SIZE
+        limit = min(limit, MaintAppModel.STATUS_PAGE_LIMIT)
+        
+        query = WorkorderEnt.all(keys_only=True)
+        query.filter('status =', status)
+        query.order('-date_created')
+        if cursor:
+            query.with_cursor(cursor)
+        keys = query.fetch(limit)
+        if len(keys) == limit:
+            next_cursor = query.cursor()
+        else:
+            next_cursor = None
+        
+        workorder_ents = [ent for ent in self.__identityMap.getEntities(keys)
+                          if ent is not None]
+        vehicle_keys = [referenceKey(ent, WorkorderEnt.vehicle) for ent in workorder_ents]
+        vehicle_ents = self.__identityMap.getEntities(
+                            [key for key in vehicle_keys if key is not None])
+        vehicles = {}
+        for vehicle_ent in vehicle_ents:
+            if vehicle_ent is not None:
+                vehicles[vehicle_ent.key()] = vehicle_ent
+        
+        result = []
+        for workorder_ent, vehicle_key in zip(workorder_ents, vehicle_keys):
+            vehicle_ent = vehicles.get(vehicle_key)
+            if vehicle_ent is None:
+                continue # Orphaned work order; nothing useful to show.
+            result.append((self.getVehicleFromVehicleEnt(vehicle_ent),
+                           self.getWorkorderFromWorkorderEnt(workorder_ent)))
+        return (result, next_cursor)
+    
+    #---------------------------- shop board -----------------------------------------------
+    def getShopBoard(self):
+        """ Return the side panel lists as (open, completed, version): two
+            lists of WorkorderSummary objects, newest change first, and the
+            version of the board, which changes whenever either list does.
+            This is one cached read of the two ShopBoardEnt summary entities
+            instead of two work order queries.  A board that has not been
+            built yet (see MaintAppMigrations.rebuildShopBoard) is empty;
+            requests only read the board, they never build it.
+        """
+        return self.__readThrough('ShopBoard', MaintAppModel.SHOP_BOARD_CACHE_ID,
+                                  self.__loadShopBoard)
+    
+    def __loadShopBoard(self):
+        boards = db.get([ShopBoardEnt.keyFor(status)
+                         for status in MaintAppModel.SHOP_BOARD_STATUSES])
+        lists = []
+        versions = []
+        for board in boards:
+            if board is None:
+                lists.append([])
+                versions.append(0)
+            else:
+                lists.append([self.__decodeBoardEntry(entry) for entry in board.workorders])
+                versions.append(board.version)
+        return (lists[0], lists[1], tuple(versions))
+    
+    def rebuildShopBoard(self):
+        """ Recreate the shop board from the open and completed work order
+            queues.  Used to initialize the board and to repair it (see
+            MaintAppMigrations.rebuildShopBoard); returns the new
+            ShopBoardEnts.
+        """
+        lists = []
+        for status in MaintAppModel.SHOP_BOARD_STATUSES:
+            entries = []
+            cursor = None
+            while len(entries) < MaintAppModel.SHOP_BOARD_LIMIT:
+                page, cursor = self.getWorkorderQueue(status, cursor,
+                                                      MaintAppModel.STATUS_PAGE_LIMIT)
+                for vehicle, workorder in page:
+                    entries.append(self.__encodeBoardEntry(
+                        workorder.getId(), vehicle.getId(),
+                        "%s %s %s" % (vehicle.year, vehicle.make, vehicle.model),
+                        workorder.mechanic))
+                if cursor is None:
+                    break
+            lists.append(entries[:MaintAppModel.SHOP_BOARD_LIMIT])
+        
+        def replace():
+            # Carry on from the version of the board being replaced, if any,
+            # so the new one cannot be mistaken for it.  Reading it in the
+            # same transaction as the put means a change made to the board
+            # meanwhile cannot leave two boards with the same version.
+            keys = [ShopBoardEnt.keyFor(status)
+                    for status in MaintAppModel.SHOP_BOARD_STATUSES]
+            boards = []
+            for key, old, entries in zip(keys, db.get(keys), lists):
+                board = ShopBoardEnt(key=key, workorders=entries,
+                                     version=old and old.version or 0)
+                bumpVersion(board)
+                boards.append(board)
+            db.put(boards)
+            return boards
+        
+        boards = db.run_in_transaction_options(
+                     db.create_transaction_options(xg=True), replace)
+        self.__objectCache.invalidate([('ShopBoard', MaintAppModel.SHOP_BOARD_CACHE_ID)])
+        return boards
+    
+    def __encodeBoardEntry(self, workorder_id, vehicle_id, label, mechanic):
+        fields = [workorder_id, vehicle_id, label, mechanic or ""]
+        return db.Text("\t".join([field.replace("\t", " ") for field in fields]))
+    
+    def __decodeBoardEntry(self, entry):
+        workorder_id, vehicle_id, label, mechanic = entry.split("\t")
+        return WorkorderSummary(id=workorder_id, vehicle_id=vehicle_id,
+                                vehicle_label=label, mechanic=mechanic)
+    
+    def __boardLabel(self, vehicle_key):
+        """ The label the shop board shows for the vehicle with vehicle_key. """
+        vehicle_ent = self.__identityMap.getEntity(vehicle_key)
+        if vehicle_ent is None:
+            return ""
+        return vehicleLabel(vehicle_ent)
+    
+    def __updateShopBoard(self, workorder_key, workorder_ent, label, previous_status):
+        """ Move the work order saved under workorder_key to the front of the
+            shop board for its status, taking it off the board for
+            previous_status (closed work orders drop off the board.)  Called
+            in the transaction that saves the work order, so only the boards
+            for those two statuses are read and written.  A board that does
+            not exist yet is started with this work order; the work orders
+            saved before it are added by rebuilding it.
+        """
+        workorder_id = str(workorder_key)
+        entry = self.__encodeBoardEntry(workorder_id,
+                                        str(referenceKey(workorder_ent, WorkorderEnt.vehicle)),
+                                        label, workorder_ent.mechanic)
+        prefix = workorder_id + "\t"
+        status = workorder_ent.status
+        statuses = [s for s in MaintAppModel.SHOP_BOARD_STATUSES
+                    if s == status or s == previous_status]
+        keys = [ShopBoardEnt.keyFor(s) for s in statuses]
+        changed = []
+        for board_status, key, board in zip(statuses, keys, db.get(keys)):
+            if board is None:
+                if board_status != status:
+                    continue
+                board = ShopBoardEnt(key=key)
+            board.workorders = [e for e in board.workorders if not e.startswith(prefix)]
+            if board_status == status:
+                board.workorders.insert(0, entry)
+                del board.workorders[MaintAppModel.SHOP_BOARD_LIMIT:]
+            bumpVersion(board)
+            changed.append(board)
+        if changed:
+            db.put(changed)
+        return None
+    
+    def __relabelShopBoard(self, vehicle_id, label):
+        """ Refresh the vehicle label of every shop board entry for vehicle_id. """
+        def relabel(fields):
+            if fields[1] == vehicle_id:
+                fields[2] = label
+            return fields
+        self.__patchShopBoard(relabel)
+        return None
+    
+    def __patchShopBoard(self, patch):
+        """ Rewrite the shop board entries in place, in a transaction:
+            patch is called with the [workorder id, vehicle id, label,
+            mechanic] fields of each entry and returns the fields to keep.
+        """
+        def rewrite(entries):
+            result = []
+            for entry in entries:
+                fields = patch(entry.split("\t"))
+                result.append(self.__encodeBoardEntry(*fields))
+            return result
+        
+        def update():
+            boards = db.get([ShopBoardEnt.keyFor(status)
+                             for status in MaintAppModel.SHOP_BOARD_STATUSES])
+            boards = [board for board in boards if board is not None]
+            for board in boards:
+                board.workorders = rewrite(board.workorders)
+                bumpVersion(board)
+            db.put(boards)
+            return None
+        
+        db.run_in_transaction_options(db.create_transaction_options(xg=True), update)
+        self.__objectCache.invalidate([('ShopBoard', MaintAppModel.SHOP_BOARD_CACHE_ID)])
+        return None
+    
+    def editedFields(self, saved, edited):
+        """ Return the fields filled in on the object edited (see
+            TransferObject.changedFields) whose values differ from those of
+            saved, the stored record (None, or a blank object, for a new one.)
+            The values are compared as they would be stored, so a mileage typed
+            as "45000" is the 45000 on file.
+        """
+        if saved is None:
+            saved = edited.__class__()
+        mapper = objectMappers[edited.__class__]
+        return mapper.differingFields(saved, edited, sorted(edited.changedFields()))
     
     def validateCustomerInfo(self, customer):
         """ Validate the data fields in the 'customer' object for data errors 
             and required fields before save to db.  Return list of 
-            (field name, error type) tuples.
+            MaintAppValidation.FieldErrors (field name, error type, message.)
         """
-        return []
+        return CUSTOMER_RULES.validate(customer)
     
     def validateVehicleInfo(self, vehicle):
         """ Validate the data fields in the 'vehicle' object for data errors 
             and required fields before save to db.  Return list of 
-            (field name, error type) tuples.
+            MaintAppValidation.FieldErrors (field name, error type, message.)
         """
-        return []
+        return VEHICLE_RULES.validate(vehicle)
     
     def validateWorkorderInfo(self, workorder):
         """ Validate the data fields in the 'workorder' object for data errors 
             and required fields before save to db.  Return list of 
-            (field name, error type) tuples.
+            MaintAppValidation.FieldErrors (field name, error type, message.)
         """
-        return []
+        return WORKORDER_RULES.validate(workorder)
     
 
+def useLocalStubs(datastore_path=''):
+    """ Serve the datastore and memcache APIs from stubs in this process, for
+        running outside App Engine.  The datastore is kept in the file named by
+        datastore_path, or only in memory if it is ''.
+    """
+    # Start with a fresh api proxy. 
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap() 
+    
+    stub = datastore_file_stub.DatastoreFileStub(APP_ID, datastore_path, '') 
+    apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub) 
+    apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache_stub.MemcacheServiceStub())
+    return None
+
+
 class TestMaintAppModel(object):
     def __init__(self): 
-        # Start with a fresh api proxy. 
-        apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap() 
-        
         # Use a fresh stub datastore. 
-        stub = datastore_file_stub.DatastoreFileStub(APP_ID, '', '') 
-        apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub) 
+        useLocalStubs()
         
     def testSaveAndGet(self):
         appModel = MaintAppModel()
@@ -670,6 +1450,16 @@ class TestMaintAppModel(object):
         print "c2_key = " + c2_key
         c2_retrieved = appModel.getCustomer(c2_key)
         print "c2_retrieved: ", c2_retrieved
+        
+        print "\n** testing customer update..."
+        c1_retrieved.setFirstName('Fiona')
+        appModel.saveCustomerInfo(c1_retrieved)
+        print "unchanged save wrote:", appModel.changedFields
+        c1_retrieved.setComments('prefers a text message')
+        appModel.saveCustomerInfo(c1_retrieved)
+        print "edited save wrote:", appModel.changedFields
+        print "version after two saves, one of them unchanged:", \
+              appModel.getCustomer(c1_key).version
 
         print "\n** testing vehicle save..."
         v1 = Vehicle(id='-1',
@@ -705,10 +1495,15 @@ class TestMaintAppModel(object):
         v3_key = appModel.saveVehicleInfo(v3)
         print "v3_key = " + v3_key
 
+        print "v3 in c2's entity group:", db.Key(v3_key).parent() == db.Key(c2_key)
+        print "vehicles with plate 'xy-9999':", appModel.findVehiclesByPlateOrVin('xy-9999')
+        
         print "* all saved vehicles:"
-        vehicles = VehicleEnt.all()
+        vehicles = VehicleEnt.all().fetch(100)
+        owners = resolveReferences(vehicles, VehicleEnt.customer)
         for vehicle in vehicles:
-            print vehicle.make, vehicle.model, ", owner by customer with id ", str(vehicle.customer.key()), "(object ", vehicle.customer, ")"
+            owner_key = str(referenceKey(vehicle, VehicleEnt.customer))
+            print vehicle.make, vehicle.model, ", owner by customer with id ", owner_key, "(object ", owners.get(owner_key), ")"
         
     
         print "\n** testing vehicle retrieve..."
@@ -757,13 +1552,305 @@ class TestMaintAppModel(object):
         for i in customer_list:
             print i
         print
+        searchCriteria = Customer(last_name='wo')
+        customer_list = appModel.searchForMatchingCustomers(searchCriteria, prefixSearch=True)
+        print "customer_list, prefix search last_name='wo':", customer_list
+        for i in customer_list:
+            print i
+        print
+        print "name words of u'Jos\\xe9 M\\xfcller-Smith':", nameWords(u'Jos\xe9 M\xfcller-Smith')
+        appModel.saveCustomerInfo(Customer(first_name=u'Jos\xe9', last_name=u'M\xfcller',
+                                           address1='1 Elm St', city='San Jose', state='CA',
+                                           zip='95110', phone1='408-555-0199'))
+        for first, last in ((u'jos\xe9', ''), ('', u'M\xfc'), ('', 'mul')):
+            found = appModel.searchForMatchingCustomers(Customer(first_name=first, last_name=last),
+                                                        prefixSearch=True)
+            print "prefix search %r %r: %d found" % (first, last, len(found))
+            assert len(found) == (last != 'mul')
+        print
+        print "customers with phone (111) 111-1111:", appModel.findCustomersByPhone('(111) 111-1111')
+        print
+        searchCriteria = Customer(last_name="O'Brien")
+        customer_list = appModel.searchForMatchingCustomers(searchCriteria)
+        print "customer_list, searchCriteria last_name=\"O'Brien\":", customer_list
+        print
+        for i in range(MaintAppModel.SEARCH_PAGE_SIZE + 5):
+            appModel.saveCustomerInfo(Customer(first_name='Pat', last_name='Lee%02d' % (30 - i),
+                                               address1='9 Oak Ave', city='Milpitas',
+                                               state='CA', zip='95035', phone1='408-555-%04d' % i,
+                                               email='pat@oak.example'))
+        page, next_cursor = appModel.searchCustomersPage(Customer(address1='9 Oak Ave'))
+        names = [c.last_name for c in page]
+        print "search on address1: %d found, next page %s" % (len(page), next_cursor is not None)
+        assert names == sorted(names) and len(names) == MaintAppModel.SEARCH_PAGE_SIZE
+        assert next_cursor is not None and not appModel.searchTruncated
+        # No index sorts a search on email, so the matches are sorted in memory.
+        unordered_limit = MaintAppModel.UNORDERED_SEARCH_LIMIT
+        MaintAppModel.UNORDERED_SEARCH_LIMIT = 10
+        try:
+            page, next_cursor = appModel.searchCustomersPage(Customer(email='pat@oak.example'))
+        finally:
+            MaintAppModel.UNORDERED_SEARCH_LIMIT = unordered_limit
+        names = [c.last_name for c in page]
+        print "unordered search on email: %d found, next page %r, truncated %s" % (
+              len(page), next_cursor, appModel.searchTruncated)
+        assert names == sorted(names) and len(names) == 10
+        assert next_cursor is None and appModel.searchTruncated
+        print
+        
+        print "\n** testing request identity map..."
+        v2_key = c2_list[0].getId()
+        w1_key = appModel.saveWorkorder(Workorder(vehicle_id=v2_key, mileage=41000,
+                                                  mechanic='Lee',
+                                                  date_created=datetime.datetime.now(),
+                                                  customer_request='rotate tires'))
+        appModel.beginRequest()
+        for i in range(3):
+            # With memcache emptied every read gets past the object cache, so
+            # the identity map has to answer all but the first of each.
+            memcache.flush_all()
+            appModel.getCustomer(c2_key)
+            appModel.getVehicle(v2_key)
+            appModel.getWorkorder(w1_key)
+        stats = appModel.endRequest()
+        print "request stats:", stats
+        # One get each for the customer, the vehicle, the work order and its text.
+        assert stats['gets'] == 4 and stats['hits'] > 0
+        
+        print "\n** testing memcache read-through..."
+        appModel.getCustomer(c2_key)
+        appModel.getVehicleList(c2_key)
+        print "cache stats:", appModel.getCacheStats()
+        # A reader finds the customer invalidated and loads it, another save
+        # invalidates it, and only then does the reader get round to caching
+        # what it loaded.
+        cache = ObjectCache()
+        cache.invalidate([('Customer', c2_key)])
+        assert cache.get('Customer', c2_key) is None
+        loaded = appModel.getCustomer(c2_key)
+        ObjectCache().invalidate([('Customer', c2_key)])
+        stale = cache.add('Customer', c2_key, loaded)
+        print "value loaded before an invalidation cached after it:", stale
+        assert not stale and cache.get('Customer', c2_key) is None
+        # The value loaded after the last save is cached straight away.
+        fresh = cache.add('Customer', c2_key, loaded)
+        print "value loaded after the invalidation cached:", fresh
+        assert fresh and cache.get('Customer', c2_key) == loaded
+        
+        print "\n** testing a vehicle changing hands..."
+        v4_key = appModel.saveVehicleInfo(Vehicle(make='Toyota', model='Camry', year=2004,
+                                                  license='MOVE01', customer_id=c1_key))
+        for i in range(5):
+            appModel.saveWorkorder(Workorder(vehicle_id=v4_key, mileage=40000 + i,
+                                             mechanic='Lee', date_created=datetime.datetime.now(),
+                                             customer_request='oil change %d' % i))
+        v4 = appModel.getVehicle(v4_key)
+        v4.setCustomerId(c2_key)
+        batch_size = MaintAppModel.MOVE_BATCH_SIZE
+        MaintAppModel.MOVE_BATCH_SIZE = 2
+        try:
+            moved_key = appModel.saveVehicleInfo(v4)
+        finally:
+            MaintAppModel.MOVE_BATCH_SIZE = batch_size
+        history = appModel.getWorkorderList(moved_key)
+        left = WorkorderEnt.all().filter('vehicle =', db.Key(v4_key)).count()
+        open_list, completed_list, version = appModel.getShopBoard()
+        on_board = [s.id for s in open_list if s.vehicle_id == moved_key]
+        print "moved to c2: %s, history %d, left behind %d, on the board %d" % (
+              db.Key(moved_key).parent() == db.Key(c2_key), len(history), left, len(on_board))
+        assert appModel.getVehicle(v4_key) is None and left == 0
+        assert sorted(on_board) == sorted([w.id for w in history]) and len(history) == 5
+        assert history[0].customer_request.startswith('oil change')
+        
+        print "\n** testing work order history consistency..."
+        legacy = VehicleEnt(make='Ford', model='F150', year=1999, license='OLD001',
+                            customer=db.Key(c1_key))
+        legacy.put()
+        appModel.getWorkorderList(str(legacy.key()))
+        appModel.getWorkorderList(moved_key)
+        legacy_cached = cache.get('WorkorderList', str(legacy.key())) is not None
+        grouped_cached = cache.get('WorkorderList', moved_key) is not None
+        print "first history page cached: ungrouped %s, grouped %s" % (legacy_cached,
+                                                                        grouped_cached)
+        assert grouped_cached and not legacy_cached
+        
+        print "\n** testing re-opening a completed work order..."
+        form = {'workorder_id': history[0].id, 'vehicle_id': moved_key,
+                'customer_request': history[0].customer_request, 'mileage': '40004',
+                'date_created': history[0].getDateCreated(), 'mechanic': 'Lee',
+                'task_list': '', 'work_performed': '', 'notes': ''}
+        for status in ('completed', 'open'):
+            form['status'] = status
+            workorder = Workorder()
+            workorder.loadFromDictionary(form)
+            appModel.saveWorkorder(workorder)
+            print "saved as %s, wrote %s" % (status, appModel.changedFields)
+        reopened = appModel.getWorkorder(history[0].id).status
+        print "status after completing and re-opening:", reopened
+        assert reopened == Workorder.OPEN
+        saved = appModel.getWorkorder(history[0].id)
+        for mileage, expected in (('40004', []), ('40,004', ['mileage'])):
+            form['mileage'] = mileage
+            workorder = Workorder()
+            workorder.loadFromDictionary(form)
+            edited = appModel.editedFields(saved, workorder)
+            print "fields edited with mileage %r: %s" % (mileage, edited)
+            assert edited == expected
+        
+
+    def benchmarkTextCompression(self, count=50, repeat=5):
+        """ Store the same long work order text with DatastoreModels
+            compression off and on, then print the bytes stored per work order
+            and the time taken to read the details back and map them, and to
+            read the request or all of the text of each work order once
+            mapped (the text is decompressed as it is read.)
+        """
+        print "\n** benchmarking work order text compression..."
+        line = "%02d/12 replaced front pads and rotors, flushed brake fluid, " \
+               "road tested; customer reports squeal at low speed\n"
+        text = "".join([line % (i % 28 + 1) for i in range(60)])
+        saved = DatastoreModels.TEXT_COMPRESSION
+        try:
+            for compress in (False, True):
+                DatastoreModels.TEXT_COMPRESSION = compress
+                keys = []
+                stored = 0
+                for i in range(count):
+                    detail = WorkorderDetailEnt(customer_request=text, task_list=text,
+                                                work_performed=text, notes=text)
+                    keys.append(detail.put())
+                    stored += db.model_to_protobuf(detail).ByteSize()
+                timings = []
+                for fields in ((), ('customer_request',), Workorder.DETAIL_FIELDS):
+                    start = time.time()
+                    for i in range(repeat):
+                        for entity in db.get(keys):
+                            workorder = Workorder(detail=workorderDetail(entity))
+                            for field in fields:
+                                getattr(workorder, field)
+                    timings.append((time.time() - start) / repeat * 1000)
+                print "compression %-3s: %6d bytes stored per work order, " \
+                      "%.1f ms to read and map %d, %.1f ms with the request, " \
+                      "%.1f ms with all the text" % \
+                      ((compress and "on" or "off", stored / count) +
+                       tuple(timings[:1]) + (count,) + tuple(timings[1:]))
+                db.delete(keys)
+        finally:
+            DatastoreModels.TEXT_COMPRESSION = saved
+        
+
+    def benchmarkMappers(self, count=200, repeat=10):
+        """ Time converting a batch of customers and vehicles to objects with
+            the generated mappers against the field by field code they
+            replaced.
+        """
+        print "\n** benchmarking entity to object conversion..."
+        def customerByHand(ent):
+            return Customer(id=str(ent.key()), first_name=ent.first_name,
+                            last_name=ent.last_name, address1=ent.address1,
+                            address2=ent.address2, city=ent.city, state=ent.state,
+                            zip=ent.zip, phone1=ent.phone1, phone2=ent.phone2,
+                            email=ent.email, comments=ent.comments)
+        def vehicleByHand(ent):
+            owner = vehicleOwnerKey(ent)
+            customer_id = '-1'
+            if owner is not None:
+                customer_id = str(owner)
+            return Vehicle(id=str(ent.key()), make=ent.make, model=ent.model,
+                           year=str(ent.year), license=ent.license, vin=ent.vin,
+                           notes=ent.notes, customer_id=customer_id)
+        
+        customers = []
+        for i in range(count):
+            customers.append(CustomerEnt(first_name='First%d' % i, last_name='Last%d' % i,
+                                         address1='%d Main St' % i, city='San Jose',
+                                         state='CA', zip='95110', phone1='408-555-0100'))
+        db.put(customers)
+        vehicles = []
+        for ent in customers:
+            vehicles.append(VehicleEnt(parent=ent.key(), customer=ent.key(), make='Honda',
+                                       model='Civic', year=2004, license='4ABC123'))
+        db.put(vehicles)
+        
+        for label, entities, byHand, mapper in \
+                (("customers", customers, customerByHand, customerMapper),
+                 ("vehicles", vehicles, vehicleByHand, vehicleMapper)):
+            start = time.time()
+            for i in range(repeat):
+                manual = [byHand(ent) for ent in entities]
+            byHandTime = (time.time() - start) / repeat
+            start = time.time()
+            for i in range(repeat):
+                mapped = mapper.toObjects(entities)
+            mappedTime = (time.time() - start) / repeat
+            print "%d %s: field by field %.1f ms, mapper %.1f ms, same objects: %s" % \
+                  (count, label, byHandTime * 1000, mappedTime * 1000, manual == mapped)
+        db.delete(vehicles)
+        db.delete(customers)
+        
+
+    def benchmarkValidation(self, repeat=2000):
+        """ Time validating a customer with CUSTOMER_RULES against the checks
+            it replaced: a chk_ method looked up by name per field, a linear
+            scan of the state list and the phone pattern compiled per call.
+        """
+        print "\n** benchmarking customer validation..."
+        states = tuple(MaintAppValidation.US_STATES)
+        class PreviousChecks(object):
+            def chk_first_name(self, value): return MaintAppValidation.lenOK(value, 1, 50)[0]
+            chk_last_name = chk_address1 = chk_address2 = chk_city = chk_email = chk_first_name
+            def chk_state(self, value): return value in states
+            def chk_zip(self, value): return MaintAppValidation.isZip(value)[0]
+            def chk_phone1(self, value):
+                pattern = re.compile(MaintAppValidation.PHONE_PATTERN, re.VERBOSE)
+                return pattern.search(value) is not None
+            chk_phone2 = chk_phone1
+            def chk_comments(self, value): return MaintAppValidation.lenOK(value, 1, 999)[0]
+        required = ('last_name', 'address1', 'city', 'state', 'zip', 'phone1')
+        def previousValidate(checks, customer):
+            missing = []; invalid = []; errTxt = ""
+            for a in Customer.FIELDS:
+                check = getattr(checks, 'chk_' + a, None)
+                if check is None: continue
+                value = getattr(customer, a, None)
+                if MaintAppValidation.isMissing(value):
+                    if a in required:
+                        missing.append(a)
+                        errTxt += 'missing ' + a + '\n'
+                elif check(value) == False:
+                    invalid.append(a)
+                    errTxt += 'invalid ' + a + '\n'
+            return missing + invalid
+        
+        customers = [Customer(first_name='Fiona', last_name='Wong', address1='PO Box 3134',
+                              city='Santa Clara', state='CA', zip='95055',
+                              phone1='111.111.1111', phone2='222.222.2222',
+                              email='fionawhwong@gmail.com'),
+                     Customer(last_name='Wong', address1='c2 address1', city='',
+                              state='XX', zip='9505', phone1='555-1212')]
+        checks = PreviousChecks()
+        for customer in customers:
+            start = time.time()
+            for i in range(repeat):
+                previous = previousValidate(checks, customer)
+            previousTime = (time.time() - start) / repeat
+            start = time.time()
+            for i in range(repeat):
+                errors = CUSTOMER_RULES.validate(customer)
+            rulesTime = (time.time() - start) / repeat
+            print "%d errors: previous checks %.1f us, rule table %.1f us, same fields: %s" % \
+                  (len(errors), previousTime * 1e6, rulesTime * 1e6,
+                   sorted(previous) == sorted([e.field for e in errors]))
         
 
 def main( ):
     test = TestMaintAppModel()
     test.testSaveAndGet()
+    test.benchmarkTextCompression()
+    test.benchmarkMappers()
+    test.benchmarkValidation()
 
 if __name__ == '__main__' :
     main()
     
-    
\ No newline at end of file
+    
\ No newline at end of file
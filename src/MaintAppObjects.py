@@ -18,14 +18,121 @@ requirements of the UI or of the Data Store.
     will be -1, for existing ones being edited, I assume the hidden form field
     will hold the database id of the record being edited. -- bdg
 """
+import operator
 from datetime import *
 from time import *
 
 def nz(value):
 	return ("" if value is None else value)
 
-class Customer(object):
-    """ Light weight class for passing the customer data around. """
+class TransferObject(object):
+    """ Base class of the light weight objects.  Each subclass lists its
+        attributes in __slots__ (so a long list of them does not carry a
+        dictionary per object) and the ones that are compared in FIELDS;
+        fieldComparison() then gives it __eq__ and __ne__.
+        Slots are not pickled by default, so the state of the attributes that
+        are set is pickled as a dictionary.
+        
+        An object also keeps track of the FIELDS assigned a different value
+        since it was constructed (or since markClean()), whether through a
+        setter or plain assignment, and of every field loadFromDictionary
+        fills in (see markChanged()).  The Model uses this to write only what
+        was edited; see changedFields().  Subclasses call markClean() at the
+        end of __init__ to start tracking; until then _changed is None and
+        assignments are not looked at.
+    """
+    __slots__ = ('_changed',)
+    FIELDS = ()
+    
+    def __new__(cls, *args, **kwargs):
+        self = object.__new__(cls)
+        object.__setattr__(self, '_changed', None)
+        return self
+    
+    def __setattr__(self, name, value):
+        changed = self._changed
+        if changed is not None and name in self.FIELDS and name not in changed:
+            try:
+                old = object.__getattribute__(self, name)
+            except AttributeError:
+                # A field never set (None), e.g. work order text not loaded.
+                old = None
+            if old != value:
+                changed.add(name)
+        object.__setattr__(self, name, value)
+    
+    def changedFields(self):
+        """ Set of the names of the fields changed since the object was
+            created or last marked clean.
+        """
+        return set(self._changed)
+    
+    def markClean(self):
+        """ Forget the changes made so far. """
+        object.__setattr__(self, '_changed', set())
+    
+    def markChanged(self, *names):
+        """ Count the named fields as changed whatever their values.  A form
+            value equal to the default the object was constructed with (e.g.
+            the OPEN status of a work order) can still be an edit of the
+            stored record; the Model compares each field with it.
+        """
+        self._changed.update(names)
+    
+    def __getstate__(self):
+        state = {}
+        for name in self.__slots__ + TransferObject.__slots__:
+            try:
+                # Bypasses __getattr__, so nothing is loaded just to pickle it.
+                state[name] = object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+        return state
+    
+    def __setstate__(self, state):
+        self.markClean()
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+def fieldComparison(cls):
+    """ Give cls an __eq__ and __ne__ comparing cls.FIELDS, read from both
+        objects as a tuple by one operator.attrgetter.  The values are
+        compared as they are; the Model compares an edited object with a
+        saved one as they would be stored (see MaintAppModel.editedFields.)
+        The objects are mutable and compare by value, so no hash would stay
+        consistent with __eq__: __hash__ is None and they cannot be put in a
+        set or used as a dictionary key.  Returns cls.
+    """
+    fields = operator.attrgetter(*cls.FIELDS)
+    
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return fields(self) == fields(other)
+    
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+    
+    cls.__eq__ = __eq__
+    cls.__ne__ = __ne__
+    cls.__hash__ = None
+    return cls
+
+class Customer(TransferObject):
+    """ Light weight class for passing the customer data around.  Two
+        customers are equal when all of their saved fields are; the id is not
+        compared.  version is the save count of the stored record it was read
+        from (None if it was not read from one.)
+    """
+    FIELDS = ('first_name', 'last_name', 'address1', 'address2', 'city',
+              'state', 'zip', 'phone1', 'phone2', 'email', 'comments')
+    __slots__ = ('id', 'version') + FIELDS
+    
     def __init__(self, id="-1", first_name=None, last_name=None,
                  address1=None, address2=None, city=None, state=None, zip=None,
                  phone1=None, phone2=None, email=None, comments=None):
@@ -41,6 +148,8 @@ class Customer(object):
         self.phone2 = phone2
         self.email = email
         self.comments = comments
+        self.version = None
+        self.markClean()
     
     """ In general, I don't think we want to change the id of an object once it is created.
         From the DataStore's perspective, it's not allowed. -- Wing
@@ -71,11 +180,8 @@ class Customer(object):
     
     def loadFromDictionary(self, dictionary):
         """ Load values from dictionary passed over from the view. """
-        customer_id = dictionary['customer_id']
-        if customer_id == '-1':
-            self.setId(None)
-        else:
-            self.setId(customer_id)
+        # A new record keeps the id "-1", like the hidden form field.
+        self.setId(dictionary['customer_id'])
             
         self.setFirstName(dictionary['first_name'])
         self.setLastname(dictionary['last_name'])
@@ -84,12 +190,20 @@ class Customer(object):
         self.state = dictionary['state']
         self.zip = dictionary['zip']
         self.phone1 = dictionary['phone1']
+        self.markChanged('first_name', 'last_name', 'address1', 'city',
+                         'state', 'zip', 'phone1')
 
         # The 'comments' field is not available when searching.
         # Another choice here would be to hide the comments field
         # in search mode so this if statement wouldn't be needed.
         if 'comments' in dictionary.keys():
             self.setComments(dictionary['comments'])
+            self.markChanged('comments')
+        # Nor are these on the form yet.
+        for field in ('address2', 'phone2', 'email'):
+            if field in dictionary:
+                setattr(self, field, dictionary[field])
+                self.markChanged(field)
             
         return None
     
@@ -106,21 +220,18 @@ class Customer(object):
                 "\tphone2 = " + self.phone2 + "\n" + \
                 "\temail = " + self.email + "\n" + \
                 "\tcomments = " + self.comments + "\n"            
+
+fieldComparison(Customer)
     
-    def __eq__(self, testCustomer):
-        """ Overload the == operator to do a field-by-field comparison of self
-            against testCustomer """
-        return self.firstName == testCustomer.firstName and \
-               self.lastName  == testCustomer.lastName # and etc., etc.
-    
-    def __ne__(self, testCustomer):
-        """ Overload the != operator to do a field-by-field comparison of self
-            to testCustomer """
-        return not self.__eq__(testCustomer)
     
+class Vehicle(TransferObject):
+    """ Light weight class for passing the vehicle data around.  Equality
+        compares the saved fields, including the owning customer, but not
+        the id or version (see Customer.)
+    """
+    FIELDS = ('customer_id', 'make', 'model', 'year', 'license', 'vin', 'notes')
+    __slots__ = ('id', 'version') + FIELDS
     
-class Vehicle(object):
-    """ Light weight class for passing the vehicle data around. """
     def __init__(self, id="-1", customer_id=None, make=None, model=None,
                  year=None, license=None, vin=None, notes=None):
         self.id = id
@@ -131,6 +242,8 @@ class Vehicle(object):
         self.license = license
         self.vin = vin
         self.notes = notes
+        self.version = None
+        self.markClean()
     
     """ Getters & setters go next. """
     
@@ -152,11 +265,7 @@ class Vehicle(object):
             javascript.
         """
         # Load fields similarly to method sketched out in Customer class
-        vehicle_id = dictionary['vehicle_id']
-        if vehicle_id == '-1':
-            self.setId(None)
-        else:
-            self.setId(vehicle_id)
+        self.setId(dictionary['vehicle_id'])
             
         self.make = dictionary['make']
         self.model = dictionary['model']
@@ -165,6 +274,7 @@ class Vehicle(object):
         self.license = dictionary['license']
         self.vin = dictionary['vin']
         self.notes = dictionary['notes']
+        self.markChanged('make', 'model', 'year', 'license', 'vin', 'notes')
             
         return None
 
@@ -178,41 +288,75 @@ class Vehicle(object):
                 "\tnotes = " + self.notes + "\n" + \
                 "\tcustomer_id = " + self.customer_id + "\n"            
 
-    def __eq__(self, testVehicle):
-        """ Overload the == operator to do a field-by-field comparison of self
-            against testVehicle """
-        return True
-    
-    def __ne__(self, testVehicle):
-        """ Overload the != operator to do a field-by-field comparison of self
-            to testVehicle """
-        return not self.__eq__(testVehicle)
+fieldComparison(Vehicle)
     
     
-class Workorder(object):
-    """ Light weight class for passing the workorder data around. """
+class Workorder(TransferObject):
+    """ Light weight class for passing the workorder data around.  Equality
+        compares the saved fields but not the id; comparing a work order whose
+        detail has not been loaded yet loads it.
+    """
     
     OPEN = 1; COMPLETED = 2; CLOSED = 3
     _status_map = { 'open':OPEN, 'completed':COMPLETED, 'closed':CLOSED }
     DATE_FORMAT = "%b %d, %Y  %H:%M:%S"
     
+    # The free text fields are stored apart from the rest of the work order.
+    # A work order created with detail_loaded=False reads them the first time
+    # one of them is used, through detailLoader: a function set by the Model
+    # that takes a work order id and returns a dictionary of these fields.
+    # The values in that dictionary, or in the detail given to __init__, are
+    # kept in _detail as they were stored; one with an unpack() method
+    # (DatastoreModels.PackedText) is only decompressed when its field is
+    # first read.
+    DETAIL_FIELDS = ('customer_request', 'task_list', 'work_performed', 'notes')
+    detailLoader = None
+    
+    FIELDS = ('vehicle_id', 'mileage', 'status', 'mechanic', 'date_created',
+              'date_closed') + DETAIL_FIELDS
+    __slots__ = ('id', '_detail') + FIELDS
+    
     def __init__(self, id="-1", vehicle_id=None, mileage=None,
                  status=OPEN, date_created=None, customer_request=None,
                  mechanic=None, task_list=None, work_performed=None,
-                 notes=None, date_closed=None):
+                 notes=None, date_closed=None, detail_loaded=True, detail=None):
         self.id = id
         self.vehicle_id = vehicle_id
         self.mileage = mileage
         self.status = status
-        self.customer_request = customer_request
         self.mechanic = mechanic 
-        self.task_list = task_list 
-        self.work_performed = work_performed
-        self.notes = notes 
         self.date_created = date_created
         self.date_closed = date_closed
+        if detail is not None:
+            self._detail = dict(detail)
+        elif detail_loaded:
+            self.customer_request = customer_request
+            self.task_list = task_list 
+            self.work_performed = work_performed
+            self.notes = notes 
+        self.markClean()
        	return None
     
+    def __getattr__(self, name):
+        """ Only called for attributes that are not set, i.e. the detail fields
+            not read yet.  Each is unpacked from _detail the first time it is
+            read, after loading _detail if the work order has none.
+        """
+        if name not in Workorder.DETAIL_FIELDS:
+            raise AttributeError(name)
+        detail = getattr(self, '_detail', None)
+        if detail is None:
+            detail = {}
+            if Workorder.detailLoader is not None and self.id not in (None, "-1"):
+                detail = Workorder.detailLoader(self.id)
+            object.__setattr__(self, '_detail', detail)
+        value = detail.pop(name, None)
+        if hasattr(value, 'unpack'):
+            value = value.unpack()
+        # Loading the saved text is not an edit.
+        object.__setattr__(self, name, value)
+        return value
+    
     """ Getters & setters go next. """
     
     def setId(self, id):
@@ -252,17 +396,8 @@ class Workorder(object):
             javascript.
         """
         # Load fields similarly to method sketched out in Customer class
-        workorder_id = dictionary['workorder_id']
-        if workorder_id == '-1':
-            self.setId(None)
-        else:
-            self.setId(workorder_id)
-            
-        vehicle_id = dictionary['vehicle_id']
-        if vehicle_id == '-1':
-            self.setVehicleId(None)
-        else:
-            self.setVehicleId(vehicle_id)
+        self.setId(dictionary['workorder_id'])
+        self.setVehicleId(dictionary['vehicle_id'])
         self.customer_request = dictionary['customer_request']
         self.mileage = dictionary['mileage']
         strDate = dictionary['date_created']
@@ -276,6 +411,9 @@ class Workorder(object):
         self.task_list = dictionary['task_list'] 
         self.work_performed = dictionary['work_performed']
         self.notes = dictionary['notes'] 
+        self.markChanged('vehicle_id', 'customer_request', 'mileage',
+                         'date_created', 'mechanic', 'status', 'task_list',
+                         'work_performed', 'notes')
         
         return None
     
@@ -294,13 +432,29 @@ class Workorder(object):
             # routine does not need to generate additional errors.
             retVal = []
         return retVal
+
+fieldComparison(Workorder)
+
     
-    def __eq__(self, testWO):
-        """ Overload the == operator to do a field-by-field comparison of self
-            against testWO """
-        return True
+class WorkorderSummary(TransferObject):
+    """ Light weight class for the work order entries in the side panel lists.
+        Carries just enough to label the entry and open the work order.
+    """
+    FIELDS = ('id', 'vehicle_id', 'vehicle_label', 'mechanic')
+    __slots__ = FIELDS
     
-    def __ne__(self, testWO):
-        """ Overload the != operator to do a field-by-field comparison of self
-            to testWO """
-        return not self.__eq__(testWO)
+    def __init__(self, id="-1", vehicle_id=None, vehicle_label=None, mechanic=None):
+        self.id = id
+        self.vehicle_id = vehicle_id
+        self.vehicle_label = vehicle_label
+        self.mechanic = mechanic
+        self.markClean()
+        
+    def getId(self):
+        return self.id
+    
+    def __str__(self):
+        return "workorder summary " + str(self.id) + ": " + \
+                nz(self.vehicle_label) + " (" + nz(self.mechanic) + ")"
+
+fieldComparison(WorkorderSummary)
@@ -0,0 +1,224 @@
+'''
+A standalone server for the Maintenance Records System, for running and
+load testing it outside App Engine and the dev server.
+
+The WSGI application of dermico is served by a fixed pool of worker threads
+against the datastore and memcache stubs (see MaintAppModel.useLocalStubs.)
+The listening thread only accepts connections and queues them; each worker
+takes connections off the queue and serves them one at a time with a Model
+of its own (MaintAppController.workerModel.)  On SIGINT or SIGTERM the server
+stops accepting, lets the workers finish the connections already queued and
+prints the number of requests each worker served and the requests/sec.
+
+The App Engine SDK (google.appengine and its bundled libraries) has to be on
+the path.
+
+    python MaintAppServer.py --port 8080 --workers 8 --datastore shop.datastore
+    python MaintAppServer.py --workers 8 --bench 2000 --clients 16
+'''
+
+import sys
+import time
+import signal
+import socket
+import logging
+import threading
+import urllib2
+import Queue
+from optparse import OptionParser
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+from MaintAppModel import useLocalStubs
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """ WSGIRequestHandler logging through the logging module rather than
+        writing a line to stderr for every request.
+    """
+    def log_message(self, format, *args):
+        logging.debug("%s - %s" % (self.client_address[0], format % args))
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """ A WSGIServer handing its connections to a pool of worker threads.
+        startWorkers has to be called before serve_forever, and stop after it
+        has returned.  initWorker, if given, is called once at the start of
+        each worker thread (e.g. to set up its Model ahead of the first
+        request.)
+    """
+
+    def __init__(self, address, workers, initWorker=None,
+                 handler=QuietRequestHandler):
+        WSGIServer.__init__(self, address, handler)
+        self.workerCount = workers
+        self.served = [0] * workers
+        self.__initWorker = initWorker
+        self.__connections = Queue.Queue(workers * 4)
+        self.__workers = []
+        self.__started = None
+        self.__stopped = None
+        return None
+
+    def startWorkers(self):
+        for i in range(self.workerCount):
+            worker = threading.Thread(target=self.__work, args=(i,),
+                                      name="worker-%d" % i)
+            worker.setDaemon(True)
+            worker.start()
+            self.__workers.append(worker)
+        self.__started = time.time()
+        return None
+
+    def process_request(self, request, client_address):
+        """ Queue the connection for a worker (blocks while they are all busy
+            and the queue is full.)
+        """
+        self.__connections.put((request, client_address))
+        return None
+
+    def __work(self, index):
+        if self.__initWorker is not None:
+            self.__initWorker()
+        while True:
+            item = self.__connections.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            self.served[index] += 1
+        return None
+
+    def stop(self):
+        """ Let the workers serve the connections already queued, then stop
+            them and close the listening socket.  Call after serve_forever has
+            returned (see shutdown.)
+        """
+        for worker in self.__workers:
+            self.__connections.put(None)
+        for worker in self.__workers:
+            worker.join()
+        self.__stopped = time.time()
+        self.server_close()
+        return None
+
+    def report(self):
+        """ Requests served by each worker and in all, and the rate. """
+        total = sum(self.served)
+        elapsed = (self.__stopped or time.time()) - self.__started
+        lines = ["worker %d: %d requests" % (i, self.served[i])
+                 for i in range(self.workerCount)]
+        lines.append("%d requests in %.1f s, %.1f requests/sec" %
+                     (total, elapsed, total / max(elapsed, 0.001)))
+        return "\n".join(lines)
+
+
+def makeServer(host, port, workers, datastore_path=''):
+    """ A ThreadPoolWSGIServer serving the Maintenance Records System on the
+        local stubs, with its workers started.
+    """
+    useLocalStubs(datastore_path)
+    import dermico
+    controller = dermico.MaintAppController.theController()
+    server = ThreadPoolWSGIServer((host, port), workers, controller.workerModel)
+    server.set_app(dermico.application)
+    server.startWorkers()
+    return server
+
+
+def stopOnSignals(server):
+    """ Shut server down on SIGINT or SIGTERM.  shutdown waits for
+        serve_forever to return, so it is called from a thread of its own
+        rather than from the handler, which runs in the serving thread.
+    """
+    def handler(signum, frame):
+        logging.info("signal %d, shutting down" % signum)
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGINT, handler)
+    signal.signal(signal.SIGTERM, handler)
+    return None
+
+
+def runBenchmark(server, path, requests, clients):
+    """ Fire requests GETs of path at server from clients threads at once and
+        print the requests/sec seen by the clients.
+    """
+    host, port = server.server_address[:2]
+    if host in ('', '0.0.0.0'):
+        host = 'localhost'
+    url = "http://%s:%d%s" % (host, port, path)
+    urllib2.urlopen(url).read()     # warm up: first request sets up the app
+
+    lock = threading.Lock()
+    remaining = [requests]
+    failures = []
+
+    def client():
+        while True:
+            lock.acquire()
+            try:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            finally:
+                lock.release()
+            try:
+                urllib2.urlopen(url).read()
+            except (urllib2.URLError, socket.error), e:
+                failures.append(e)
+
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    print "%d GET %s from %d clients on %d workers: %.2f s, %.1f requests/sec, %d failed" % \
+          (requests, path, clients, server.workerCount, elapsed,
+           requests / max(elapsed, 0.001), len(failures))
+    return None
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--host", default="localhost")
+    parser.add_option("--port", type="int", default=8080)
+    parser.add_option("--workers", type="int", default=8,
+                      help="number of worker threads [%default]")
+    parser.add_option("--datastore", default="",
+                      help="file to keep the stub datastore in (in memory only if not given)")
+    parser.add_option("--bench", type="int", default=0, metavar="REQUESTS",
+                      help="serve REQUESTS requests from local clients, report the rate and exit")
+    parser.add_option("--clients", type="int", default=16,
+                      help="client threads for --bench [%default]")
+    parser.add_option("--path", default="/",
+                      help="path requested by --bench [%default]")
+    options, args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.INFO)
+    server = makeServer(options.host, options.port, options.workers, options.datastore)
+    if options.bench:
+        serving = threading.Thread(target=server.serve_forever)
+        serving.start()
+        try:
+            runBenchmark(server, options.path, options.bench, options.clients)
+        finally:
+            server.shutdown()
+            serving.join()
+            server.stop()
+    else:
+        stopOnSignals(server)
+        print "serving on http://%s:%d/ with %d workers" % \
+              (options.host, options.port, options.workers)
+        server.serve_forever()
+        server.stop()
+    print server.report()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
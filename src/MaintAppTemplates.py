@@ -0,0 +1,321 @@
+'''
+Precompiled HTML templates for MaintAppView.
+
+A template is an HTML file in the templates directory written in the part of
+the Django template syntax the view needs:
+
+    {{ name }}, {{ name.attr }}, {{ name.0 }}       a value; None shows as ""
+    {% if name %} ... {% else %} ... {% endif %}
+    {% for item in name %} ... {% empty %} ... {% endfor %}
+    {% for a, b in name %} ... {% endfor %}         (a sequence of pairs)
+    {% panel name %}                               a panel, see below
+    {# comment #}
+
+Every value is escaped with cgi.escape(value, True) as it is written out, so
+text typed into a form cannot become markup on the page.  The text a
+template renders is marked safe (a SafeStr or SafeUnicode) and is written
+out as it is, so a panel rendered from one template can be given as a value
+to another.  safe() marks markup the view builds itself the same way.
+
+A panel is given either as text or as a function taking the write function
+the template is rendered with; the function is called in its place so the
+panel is written straight to the same output, a run at a time, rather than
+rendered into a string first.  The page template takes its panels this way.
+
+getTemplate parses a template the first time it is asked for and keeps it
+for the life of the process; MaintAppView asks for all of them on import.
+Parsing turns the template into a tree of nodes.  The text and values
+between two tags are preassembled into one format string and the names and
+attributes of the values to look up; each if and for becomes a node holding
+the blocks it chooses between.  Nothing is generated as Python source:
+rendering is a walk of the tree, writing out each run with its values
+escaped.
+'''
+
+import os
+import re
+from cgi import escape
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+_tagPat = re.compile(r'({{.*?}}|{%.*?%}|{#.*?#})', re.DOTALL)
+_namePat = re.compile(r'^[A-Za-z]\w*(\.\w+)*$')
+_needsEscape = re.compile(r'[&<>"]').search
+
+
+class SafeStr(str):
+    """ Text that is already HTML and is written out without escaping. """
+    pass
+
+class SafeUnicode(unicode):
+    """ The unicode form of SafeStr. """
+    pass
+
+_safeTypes = (SafeStr, SafeUnicode)
+
+def safe(text):
+    """ text marked as HTML, to be written out as it is. """
+    if isinstance(text, unicode):
+        return SafeUnicode(text)
+    return SafeStr(text)
+
+
+def _text(value):
+    """ The text written for a value: "" for None, safe text as it is and
+        anything else escaped.
+    """
+    if value is None:
+        return ""
+    cls = value.__class__
+    if cls is int or cls is long:
+        return str(value)
+    if cls in _safeTypes:
+        return value
+    if not isinstance(value, basestring):
+        value = str(value)
+    if _needsEscape(value) is None:
+        return value
+    return escape(value, True)
+
+
+class TemplateError(Exception):
+    """ Raised for a template that cannot be parsed. """
+    pass
+
+
+def _path(text):
+    """ (name, ((index, attribute), ...)) for a dotted name, index being
+        False for an attribute.
+    """
+    parts = text.split(".")
+    return (parts[0], tuple([(part.isdigit() and int(part), part) for part in parts[1:]]))
+
+
+def _follow(value, path):
+    """ Follow path from value: None if anything along the way is missing. """
+    for index, attr in path:
+        if value is None:
+            return None
+        if index is False:
+            value = getattr(value, attr, None)
+        else:
+            try:
+                value = value[index]
+            except (IndexError, KeyError, TypeError):
+                return None
+    return value
+
+
+# The nodes of a parsed template besides text, told apart by their class.
+class _Run(tuple):
+    """ (format, ((name, path), ...)): a run of text and values between two
+        tags, written out as format % (the values, escaped).
+    """
+    pass
+
+class _If(tuple):
+    """ (name, path, if block, else block) """
+    pass
+
+class _For(tuple):
+    """ (loop variables, name, path, body, empty block) """
+    pass
+
+class _Panel(tuple):
+    """ (name, path): a panel, text or a function called with write. """
+    pass
+
+
+def _runText(run, get):
+    """ The text of a _Run, its values looked up with get and escaped. """
+    texts = []
+    for name, path in run[1]:
+        value = get(name)
+        if path:
+            value = _follow(value, path)
+        cls = value.__class__
+        if (cls is str or cls is unicode) and _needsEscape(value) is None:
+            texts.append(value)
+        else:
+            texts.append(_text(value))
+    return run[0] % tuple(texts)
+
+
+def _renderBlock(block, values, write):
+    """ Write out a block of nodes: text as it is, values escaped, and the
+        blocks an if or a for chooses.  A block that is a single piece of
+        text, or a loop body that is a single run, is written out in line.
+    """
+    get = values.get
+    for node in block:
+        cls = node.__class__
+        if cls is str:
+            write(node)
+        elif cls is _Run:
+            write(_runText(node, get))
+        elif cls is _Panel:
+            name, path = node
+            value = get(name)
+            if path:
+                value = _follow(value, path)
+            if callable(value):
+                value(write)
+            else:
+                write(_text(value))
+        elif cls is _If:
+            name, path, ifBlock, elseBlock = node
+            value = get(name)
+            if path:
+                value = _follow(value, path)
+            chosen = ifBlock if value else elseBlock
+            if len(chosen) == 1 and chosen[0].__class__ is str:
+                write(chosen[0])
+            elif chosen:
+                _renderBlock(chosen, values, write)
+        else:
+            names, name, path, body, emptyBlock = node
+            items = get(name)
+            if path:
+                items = _follow(items, path)
+            if not items:
+                if emptyBlock:
+                    _renderBlock(emptyBlock, values, write)
+                continue
+            # The loop variables hide any values of the same names until the
+            # end of the loop.
+            hidden = [(variable, get(variable)) for variable in names]
+            run = len(body) == 1 and body[0].__class__ is _Run and body[0]
+            if len(names) == 1:
+                variable = names[0]
+                for item in items:
+                    values[variable] = item
+                    if run:
+                        write(_runText(run, get))
+                    else:
+                        _renderBlock(body, values, write)
+            else:
+                for item in items:
+                    values.update(zip(names, item))
+                    if run:
+                        write(_runText(run, get))
+                    else:
+                        _renderBlock(body, values, write)
+            values.update(hidden)
+    return None
+
+
+class Template(object):
+    """ A parsed template.  render(**values) returns the text of the template
+        for the values given, marked safe; names used by the template but not
+        given are None.  renderTo(write, values) writes the same text out a
+        piece at a time with write.
+    """
+
+    def __init__(self, source, name="<template>"):
+        self.name = name
+        self.__block = self.__parse(source)
+        return None
+
+    def renderTo(self, write, values):
+        _renderBlock(self.__block, values, write)
+        return None
+
+    def render(self, **values):
+        parts = []
+        _renderBlock(self.__block, values, parts.append)
+        return safe("".join(parts))
+
+    def __parse(self, source):
+        # Each open block: [tag, nodes, ...]; the template itself is the first.
+        stack = [["template", []]]
+
+        def fail(message):
+            raise TemplateError("%s: %s" % (self.name, message))
+
+        def lookup(text):
+            if not _namePat.match(text):
+                fail("bad name %r" % text)
+            return _path(text)
+
+        # The text and values since the last tag: [format, paths].
+        run = ["", []]
+
+        def flush():
+            """ Add the pending run to the open block: as plain text if it
+                has no values.
+            """
+            format, paths = run
+            if paths:
+                stack[-1][1].append(_Run((format, tuple(paths))))
+            elif format:
+                stack[-1][1].append(format.replace("%%", "%"))
+            run[:] = ["", []]
+
+        def add(node):
+            flush()
+            stack[-1][1].append(node)
+
+        for token in _tagPat.split(source):
+            if token.startswith("{{"):
+                run[0] += "%s"
+                run[1].append(lookup(token[2:-2].strip()))
+            elif token.startswith("{#"):
+                continue
+            elif token.startswith("{%"):
+                flush()
+                words = token[2:-2].split()
+                tag = words and words[0]
+                top = stack[-1][0]
+                if tag == "panel" and len(words) == 2:
+                    add(_Panel(lookup(words[1])))
+                elif tag == "if" and len(words) == 2:
+                    stack.append(["if", [], lookup(words[1]), ()])
+                elif tag == "else" and top == "if":
+                    block = stack.pop()
+                    stack.append(["else", [], block[2], block[1]])
+                elif tag == "endif" and top in ("if", "else"):
+                    block = stack.pop()
+                    if block[0] == "if":
+                        blocks = (tuple(block[1]), ())
+                    else:
+                        blocks = (tuple(block[3]), tuple(block[1]))
+                    add(_If(block[2] + blocks))
+                elif tag == "for" and len(words) >= 4 and words[-2] == "in":
+                    names = tuple([v.strip() for v in " ".join(words[1:-2]).split(",")])
+                    for name in names:
+                        if not _namePat.match(name) or "." in name:
+                            fail("bad loop variable %r" % name)
+                    stack.append(["for", [], names, lookup(words[-1]), None])
+                elif tag == "empty" and top == "for":
+                    block = stack.pop()
+                    stack.append(["empty", [], block[2], block[3], block[1]])
+                elif tag == "endfor" and top in ("for", "empty"):
+                    block = stack.pop()
+                    if block[0] == "for":
+                        blocks = (tuple(block[1]), ())
+                    else:
+                        blocks = (tuple(block[4]), tuple(block[1]))
+                    add(_For((block[2],) + block[3] + blocks))
+                else:
+                    fail("unexpected %s" % token)
+            else:
+                run[0] += token.replace("%", "%%")
+        flush()
+        if len(stack) > 1:
+            fail("missing end tag for %s" % stack[-1][0])
+        return tuple(stack[0][1])
+
+
+_templates = {}
+
+def getTemplate(name):
+    """ The parsed template in file name of TEMPLATE_DIR. """
+    template = _templates.get(name)
+    if template is None:
+        f = open(os.path.join(TEMPLATE_DIR, name), 'rU')
+        try:
+            template = Template(f.read(), name)
+        finally:
+            f.close()
+        _templates[name] = template
+    return template
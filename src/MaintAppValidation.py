@@ -0,0 +1,238 @@
+'''
+Validation of the customer, vehicle and work order records before they are
+saved.
+
+The rules for each record type are declared in one table: a row per field
+giving whether the field is required and the checks its value must pass.
+RuleSet prepares a table once, at import, as a tuple of (field, required,
+checks) rows with the messages worked out, and validating a record is one
+loop over it that reads each field once, runs its checks in order and
+collects a FieldError for every field that is missing or fails a check.
+The checks are built ahead of time too, so the state list is a set and the
+phone pattern is compiled once.
+
+The helper functions isState, isPhone, isZip and lenOK keep the
+(status, message) interface the Model has always used.
+'''
+
+import re
+from datetime import datetime
+
+REQUIRED = True
+OPTIONAL = False
+
+MISSING = 'missing'
+INVALID = 'invalid'
+
+#states, DX, possesions, territories and military bases
+US_STATES = frozenset(("WA", "VA", "DE", "DC", "WI", "WV", "HI", "AE", "FL", "FM", "WY", "NH", "NJ", "NM", "TX", "LA", "NC", "ND", "NE", "TN", "NY", "PA", "CA", "NV", "AA", "PW", "GU", "CO", "VI", "AK", "AL", "AP", "AS", "AR", "VT", "IL", "GA", "IN", "IA", "OK", "AZ", "ID", "CT", "ME", "MD", "MA", "OH", "UT", "MO", "MN", "MI", "MH", "RI", "KS", "MT", "MP", "MS", "PR", "SC", "KY", "OR", "SD"))
+
+# after Example 7.16. Parsing Phone Numbers (Final Version), Diving into PYTHON
+# note that we are allowing extra characters here because phone#s come in a myriad of formats
+PHONE_PATTERN = r'''
+                # don't match beginning of string, number can start anywhere
+    (\d{3})     # area code is 3 digits (e.g. '800')
+    \D*         # optional separator is any number of non-digits
+    (\d{3})     # trunk is 3 digits (e.g. '555')
+    \D*         # optional separator
+    (\d{4})     # rest of number is 4 digits (e.g. '1212')
+    \D*         # optional separator
+    (\d*)       # extension is optional and can be any number of digits
+                #$ end of string
+    '''
+_phonePat = re.compile(PHONE_PATTERN, re.VERBOSE)
+
+
+class FieldError(object):
+    """ One problem found with a record: the field, the kind of error
+        (MISSING or INVALID) and a message to show the user.
+    """
+    __slots__ = ('field', 'code', 'message')
+
+    def __init__(self, field, code, message):
+        self.field = field
+        self.code = code
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+    def __repr__(self):
+        return "FieldError(%r, %r, %r)" % (self.field, self.code, self.message)
+
+
+#---------------------------- checks -----------------------------------------------
+# A check is built from its parameters once and then called with the value of
+# a field that is present; it returns None if the value is fine or the
+# reason it is not.
+
+def length(minLen, maxLen):
+    message = "needs to have a length between %i and %i" % (minLen, maxLen)
+    def check(value):
+        if minLen <= len(value) <= maxLen:
+            return None
+        return message
+    return check
+
+def oneOf(values, message):
+    values = frozenset(values)
+    def check(value):
+        if value in values:
+            return None
+        return message
+    return check
+
+def matches(pattern, message):
+    def check(value):
+        if pattern.search(value) is not None:
+            return None
+        return message
+    return check
+
+def zipCode():
+    def check(value):
+        if isZip(value)[0]:
+            return None
+        return "is not a valid zip code"
+    return check
+
+def alphanumeric(message):
+    def check(value):
+        if value.isalnum():
+            return None
+        return message
+    return check
+
+def modelYear(first, yearsAhead):
+    """ A four digit year from first to yearsAhead years after this one. """
+    rangeMessage = "must be between %d and %d years after current year" % (first, yearsAhead)
+    def check(value):
+        value = str(value)
+        if not value.isdigit() or len(value) != 4:
+            return "must be a 4-digit number"
+        if not first <= int(value) <= datetime.today().year + yearsAhead:
+            return rangeMessage
+        return None
+    return check
+
+def wholeNumber(minimum, maximum):
+    message = "must be a whole number between %d and %d" % (minimum, maximum)
+    def check(value):
+        value = str(value)
+        if value.isdigit() and minimum <= int(value) <= maximum:
+            return None
+        return message
+    return check
+
+
+#---------------------------- rule sets -----------------------------------------------
+
+class RuleSet(object):
+    """ The prepared form of a rule table.  Each row of the table is
+        (field, REQUIRED or OPTIONAL, check, ...).  A field is missing if it
+        is None or empty; a missing optional field is not checked.
+    """
+
+    def __init__(self, rules):
+        self.rules = tuple(rules)
+        self.fields = tuple([rule[0] for rule in self.rules])
+        # (field, message if missing or None, checks, prefix of the messages)
+        self.__rows = tuple([(rule[0], rule[1] and "missing " + rule[0] or None,
+                              tuple(rule[2:]), rule[0] + " ")
+                             for rule in self.rules])
+        return None
+
+    def validate(self, record):
+        """ Check the object record against the table.  Returns a list of
+            FieldErrors, empty if the record is valid.
+        """
+        errors = []
+        for field, missing, checks, prefix in self.__rows:
+            value = getattr(record, field)
+            if value is None or value == '':
+                if missing is not None:
+                    errors.append(FieldError(field, MISSING, missing))
+                continue
+            for check in checks:
+                problem = check(value)
+                if problem is not None:
+                    errors.append(FieldError(field, INVALID, prefix + problem))
+                    break
+        return errors
+
+
+CUSTOMER_RULES = RuleSet((
+    ('first_name', OPTIONAL, length(1, 50)),
+    ('last_name',  REQUIRED, length(1, 50)),
+    ('address1',   REQUIRED, length(1, 50)),
+    ('address2',   OPTIONAL, length(1, 50)),
+    ('city',       REQUIRED, length(1, 50)),
+    ('state',      REQUIRED, oneOf(US_STATES, "is not a state abbreviation")),
+    ('zip',        REQUIRED, zipCode()),
+    ('phone1',     REQUIRED, matches(_phonePat, "is not a valid phone number")),
+    ('phone2',     OPTIONAL, matches(_phonePat, "is not a valid phone number")),
+    ('email',      OPTIONAL, length(1, 50)),
+    ('comments',   OPTIONAL, length(1, 999)),
+))
+
+VEHICLE_RULES = RuleSet((
+    ('make',    REQUIRED, length(1, 30)),
+    ('model',   REQUIRED, length(1, 30)),
+    ('year',    REQUIRED, modelYear(1925, 2)),
+    ('license', REQUIRED, length(1, 30)),
+    # Note:  see http://www.vinguard.org/vin.htm for the full story. This is not a complete check
+    # For example, the year is encoded (vin[9]) as well as a check digit (vin[8])
+    ('vin',     OPTIONAL, alphanumeric("must be only numbers and letters"), length(16, 17)),
+    ('notes',   OPTIONAL, length(1, 999)),
+))
+
+WORKORDER_RULES = RuleSet((
+    ('mileage',          REQUIRED, wholeNumber(0, 9999999)),
+    ('status',           REQUIRED, oneOf((1, 2, 3), "is not a work order status")),
+    ('mechanic',         REQUIRED, length(1, 50)),
+    ('customer_request', REQUIRED),
+))
+
+
+#---------------------------- field helpers -----------------------------------------------
+
+def isState(s):
+    if s in US_STATES:
+       return (True,"")
+    return (False,"Illegal State Name")
+
+def isPhone(s):
+    """
+    Since phone num info is so variable little validation is done
+    More specific validation could be done if there is separate fields for extension and location (home, work, other)
+    """
+    if _phonePat.search(s) is None:
+       return  (False, "invalid phone number format")
+    return (True, "")
+
+def isZip(s):
+    aLen = len(s)
+    if (aLen == 5) | (aLen == 9):
+       if s.isdigit():
+          return (True,"")
+       else:
+          return (False,"bad zip code")
+    elif aLen != 10:
+         return (False,"bad zip code")
+    elif (s[:5].isdigit())  &  \
+       (s[5] == '-') & \
+       (s[6:].isdigit()):
+            return (True,"")
+    return (False,"bad zip code")
+
+def lenOK(s,minLen, maxLen):
+    if s == None:
+       return (False,"needs to have a length between %i and %i" % ( minLen, maxLen))
+    aLen = len(s)
+    if (aLen >= minLen) & (aLen <= maxLen):
+       return (True, "")
+    else:
+       return (False, "needs to have a length between %i and %i" % ( minLen, maxLen))
+
+def isMissing(s):
+       return (s == None) | (s == '')
@@ -21,9 +21,184 @@ FIND_CUSTOMER = 2
 INPUT_CUSTOMER = 3
 INPUT_WORKORDER = 4
 
+import os
+import re
+import sys
+import imp
+import time
+import threading
+from cgi import escape
 from datetime import datetime
+from StringIO import StringIO
 from MaintAppObjects import nz
-from MaintAppObjects import Workorder
+from MaintAppObjects import Customer, Vehicle, Workorder, WorkorderSummary
+from MaintAppTemplates import getTemplate, safe, Template, TEMPLATE_DIR
+
+# Display names for the mechanic codes stored in work orders.
+MECHANIC_NAMES = {"mechanic_1" : "Jerome Calvo",
+                  "mechanic_2" : "Les Faby",
+                  "mechanic_3" : "Brad Gaiser",
+                  "mechanic_4" : "Wing Wong"}
+MECHANIC_CODES = sorted(MECHANIC_NAMES.keys())
+
+# The templates of the page and its panels, parsed once on import.
+PAGE_TEMPLATE = getTemplate('page.html')
+SIDE_PANEL_TEMPLATE = getTemplate('sidePanel.html')
+CUSTOMER_TEMPLATE = getTemplate('customer.html')
+VEHICLE_TEMPLATE = getTemplate('vehicle.html')
+WORKORDER_TEMPLATE = getTemplate('workorder.html')
+WORKORDER_LISTS_TEMPLATE = getTemplate('workorderLists.html')
+VEHICLE_TABS_TEMPLATE = getTemplate('vehicleTabs.html')
+WORKORDER_HEADER_TEMPLATE = getTemplate('workorderHeader.html')
+
+FRAGMENT_CACHE_SIZE = 500   # rendered fragments kept per process
+
+class RenderBuffer(object):
+    """ Collects the fragments of a page so they can be joined and written out
+        in one go rather than with a write call each.  write is the append of
+        the fragment list itself, so collecting a fragment costs no more than
+        a list append.
+    """
+    __slots__ = ('fragments', 'write')
+    
+    def __init__(self):
+        self.fragments = []
+        self.write = self.fragments.append
+        
+    def getvalue(self):
+        return "".join(self.fragments)
+    
+    def writeTo(self, out):
+        out.write(self.getvalue())
+        return None
+
+
+class FragmentCache(object):
+    """ In-process LRU cache of rendered HTML fragments, shared by the views
+        of every request and thread in the process.  A key names the fragment
+        and the ids and versions of the records it shows (see versionStamp),
+        or the values themselves, so once one of those records is saved or
+        edited the fragment is simply never asked for again and ages out.
+        At most capacity fragments are kept; the least recently used one is
+        evicted to make room for a new one.
+    """
+    
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__lock = threading.Lock()
+        # key -> [previous, next, key, fragment], in a circular list through
+        # __root from the most to the least recently used.
+        self.__links = {}
+        self.__root = []
+        self.__root[:] = [self.__root, self.__root, None, None]
+        return None
+    
+    def get(self, key):
+        """ The fragment cached under key, or None. """
+        self.__lock.acquire()
+        try:
+            link = self.__links.get(key)
+            if link is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.__unlink(link)
+            self.__linkFirst(link)
+            return link[3]
+        finally:
+            self.__lock.release()
+    
+    def put(self, key, fragment):
+        self.__lock.acquire()
+        try:
+            link = self.__links.get(key)
+            if link is not None:
+                link[3] = fragment
+                self.__unlink(link)
+            else:
+                if self.capacity <= 0:
+                    return None
+                if len(self.__links) >= self.capacity:
+                    last = self.__root[0]
+                    self.__unlink(last)
+                    del self.__links[last[2]]
+                    self.evictions += 1
+                link = [None, None, key, fragment]
+                self.__links[key] = link
+            self.__linkFirst(link)
+            return None
+        finally:
+            self.__lock.release()
+    
+    def fragment(self, key, render):
+        """ The fragment cached under key, rendering it with render() and
+            caching it first if need be.  A key of None means the fragment
+            cannot be cached; it is then rendered every time.
+        """
+        if key is None:
+            return render()
+        fragment = self.get(key)
+        if fragment is None:
+            fragment = render()
+            self.put(key, fragment)
+        return fragment
+    
+    def clear(self):
+        self.__lock.acquire()
+        try:
+            self.__links.clear()
+            self.__root[:] = [self.__root, self.__root, None, None]
+            return None
+        finally:
+            self.__lock.release()
+    
+    def getStats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self.__links),
+                'capacity': self.capacity,
+                'hit_ratio': (float(self.hits) / lookups) if lookups else 0.0}
+    
+    def __unlink(self, link):
+        previous, next = link[0], link[1]
+        previous[1] = next
+        next[0] = previous
+        return None
+    
+    def __linkFirst(self, link):
+        root = self.__root
+        first = root[1]
+        link[0] = root
+        link[1] = first
+        first[0] = link
+        root[1] = link
+        return None
+
+fragmentCache = FragmentCache(FRAGMENT_CACHE_SIZE)
+
+def versionStamp(record, fields=None):
+    """ (id, version) of a record for a fragment cache key, or None if the
+        record cannot be cached: it is not saved, its version is not known or
+        it has been edited since it was read.  With fields, only edits to those
+        fields count.
+    """
+    if record is None or record.version is None or record.id in (None, "-1"):
+        return None
+    changed = record.changedFields()
+    if fields is None:
+        if changed:
+            return None
+    else:
+        for field in fields:
+            if field in changed:
+                return None
+    return (record.id, record.version)
+
 
 class MaintAppView(object):
     """ Class to implement the View part of the MVC implementation of the
@@ -78,8 +253,9 @@ class MaintAppView(object):
         self.__workorderPanel._configureActiveWorkorder(workorder_id)
         
     def configureErrorMessages(self, errorObj):
-        """ Errors is a list of (field name, error type) tuples to be used to format
-            errors and highlighting fields where data validation errors were detected.
+        """ Errors is a list of MaintAppValidation.FieldErrors (field name, error
+            type, message) to be used to format errors and highlighting fields
+            where data validation errors were detected, or a ValidationErrors.
         """
         self.__sidePanel._configureErrorMessages(errorObj)
         pass
@@ -87,17 +263,39 @@ class MaintAppView(object):
     def configureSidePanelContent(self, activeElement,
                                   openWorkorders,
                                   completedWorkorders,
-                                  debug_message):
+                                  debug_message,
+                                  boardVersion=None):
+        """ boardVersion is the version of the shop board the lists come from,
+            if known; the lists are then rendered from the fragment cache.
+        """
         self.__sidePanel._configure_selection(activeElement)
         self.__sidePanel._configure_content(openWorkorders, 
                                             completedWorkorders, 
-                                            debug_message)
+                                            debug_message,
+                                            boardVersion)
         
     def configureCustomerContent(self, customer_info):
         self.__customerPanel._configure_content(customer_info)
 
-    def configureSearchResults(self, customer_list):
-        self.__customerPanel._configure_search_results(customer_list)
+    def configureSearchResults(self, customer_list, cursor=None, history="",
+                               next_cursor=None, prefix_search=False,
+                               truncated=False):
+        """ customer_list is one page of search results.  cursor, history and
+            next_cursor are the paging values the Controller needs back with the
+            next request (current page, earlier pages and next page.)
+            prefix_search keeps the 'Partial names' box checked.  truncated
+            means the results are not all the customers matching, and the
+            user is asked to refine the search.
+        """
+        self.__customerPanel._configure_search_results(customer_list, cursor,
+                                                       history, next_cursor,
+                                                       prefix_search, truncated)
+        
+    def configureVehicleSearchResults(self, matches, plate):
+        """ matches is a list of (customer, vehicle) tuples found by license
+            plate or VIN; plate is the text that was searched for.
+        """
+        self.__customerPanel._configure_vehicle_search_results(matches, plate)
         
     def configureVehicleContent(self, vehicle_list):
         self.__vehiclePanel._configure_content(vehicle_list)
@@ -108,6 +306,12 @@ class MaintAppView(object):
     def configureWorkorderContent(self, workorder_list):
         self.__workorderPanel._configureWorkorderContent(workorder_list)
     
+    def configureWorkorderPaging(self, cursor=None, history="", next_cursor=None):
+        """ Paging values for the work order history tabs, handled the same
+            way as configureSearchResults.
+        """
+        self.__workorderPanel._configureWorkorderPaging(cursor, history, next_cursor)
+    
     def showSaveDialog(self, request_button, request_tag):
         """ This method is called to set the UI up to display a save dialog
             on the browser with Yes/No/Cancel buttons.  This dialog should be
@@ -124,60 +328,29 @@ class MaintAppView(object):
         pass
     
     def serve_content(self, reqhandler):
-        self.__serve_header(reqhandler)
-        reqhandler.response.out.write("""
-          <body>
-            <form action="/Customer" method="post">
-              <table class="my_table">
-                <tr>
-                  <td rowspan="2" class="my_tleft">""")
-        if self.__sidePanel is not None:
-            self.__sidePanel._serve_content(reqhandler)
-        reqhandler.response.out.write("""
-                  </td>
-                  <td class="my_tright">""")
-        
+        """ Write the page to the response of reqhandler.  The page is built up
+            in a RenderBuffer and written to the response all at once.
+        """
+        page = RenderBuffer()
+        self.render(page)
+        page.writeTo(reqhandler.response.out)
+        return None
+    
+    def render(self, out):
+        """ Render the page to out, anything with a write method.  The panels
+            are written to out as the page template reaches them, a run of
+            text at a time.
+        """
+        vehiclePanel = None
         if self.__mainMode == INPUT_WORKORDER:
-            if self.__workorderPanel is not None:
-                self.__workorderPanel._serve_content(reqhandler)
+            mainPanel = self.__workorderPanel._render
         else:
-            if self.__customerPanel is not None:
-                self.__customerPanel._serve_content(reqhandler)
-            reqhandler.response.out.write("""
-                      </td>
-                    </tr>
-                    """)
-            
+            mainPanel = self.__customerPanel._render
             if self.__mainMode == INPUT_CUSTOMER:
-                reqhandler.response.out.write("""
-                        <tr>
-                          <td class="my_tright_bottom">""")
-                if self.__vehiclePanel is not None:
-                    self.__vehiclePanel._serve_content(reqhandler)
-        reqhandler.response.out.write("""
-                  </td>
-                </tr>
-                """)
-            
-        reqhandler.response.out.write("""
-              </table>
-            </form>
-          </body>
-        </html>
-        """)
-        return None
-    
-    def __serve_header(self, reqhandler):
-        reqhandler.response.out.write(
-"""<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN"
-       "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
-<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
-    <head>
-        <title>Dermico Auto Maintenance Records System</title>
-        <meta http-equiv="Content-Type" content="text/html; charset=iso-8859-1" />
-        <link href="/stylesheets/dermico.css" rel="stylesheet" type="text/css" />
-    </head>
-    """)
+                vehiclePanel = self.__vehiclePanel._render
+        PAGE_TEMPLATE.renderTo(out.write, {'sidePanel': self.__sidePanel._render,
+                                           'mainPanel': mainPanel,
+                                           'vehiclePanel': vehiclePanel})
         return None
 
     
@@ -189,6 +362,9 @@ class SidePanelSubview(object):
         self.__vehicleId = "-1"
         self.__workorderId = "-1"
         self.__errorObj = None
+        self.__openWorkorders = []
+        self.__completedWorkorders = []
+        self.__boardVersion = None
         return None
     
     def _configure_selection(self, whichItem):
@@ -203,8 +379,16 @@ class SidePanelSubview(object):
         """
         self.__itemSelected = whichItem
     
-    def _configure_content(self, openWorkorders, completedWorkorders, debug_message):
+    def _configure_content(self, openWorkorders, completedWorkorders, debug_message,
+                           boardVersion=None):
+        """ openWorkorders and completedWorkorders are lists of WorkorderSummary
+            objects as returned by the Model's shop board, boardVersion the
+            version of the board.
+        """
+        self.__openWorkorders = openWorkorders
+        self.__completedWorkorders = completedWorkorders
         self.__comments = debug_message
+        self.__boardVersion = boardVersion
         
     def _configure_hidden_fields(self, customer_id, vehicle_id, workorder_id):
         self.__customerId = customer_id
@@ -215,28 +399,60 @@ class SidePanelSubview(object):
     def _configureErrorMessages(self, errorObj):
         self.__errorObj = errorObj
         
-    def _serve_content(self, reqhandler):
+    def __workorderButtons(self, workorders):
+        """ (css class, id, label) for the button of each work order summary.
+            The button name carries the work order key so the Controller can
+            open it directly.
+        """
+        buttons = []
+        for workorder in workorders:
+            if self.__itemSelected == 3 and workorder.getId() == self.__workorderId:
+                css_class = "s_active_side_links"
+            else:
+                css_class = "s_side_links"
+            label = nz(workorder.vehicle_label)
+            if workorder.mechanic in MECHANIC_NAMES:
+                label += " (%s)" % MECHANIC_NAMES[workorder.mechanic]
+            buttons.append((css_class, workorder.getId(), label))
+        return buttons
+    
+    def __renderWorkorderLists(self):
+        return WORKORDER_LISTS_TEMPLATE.render(
+            openWorkorders=self.__workorderButtons(self.__openWorkorders),
+            completedWorkorders=self.__workorderButtons(self.__completedWorkorders))
+    
+    def __workorderListsKey(self):
+        """ The lists only change with the board and the highlighted work order. """
+        if self.__boardVersion is None:
+            return None
+        if self.__itemSelected == 3:
+            selected = self.__workorderId
+        else:
+            selected = None
+        return ('workorderLists', self.__boardVersion, selected)
+        
+    def _render(self, write):
         linkClass = "s_side_links"
         activeLinkClass = "s_active_side_links"
         
-        reqhandler.response.out.write('<p><strong>Customer Input:</strong></p>')
-        css_class = activeLinkClass if (self.__itemSelected == 1) else linkClass
-        reqhandler.response.out.write('<p><input class="%s" type="submit" name="submit_newcust" value="Add New Customer" /></p>' % css_class)
-        css_class = activeLinkClass if (self.__itemSelected == 2) else linkClass
-        reqhandler.response.out.write('<p><input class="%s" type="submit" name="submit_findcust" value="Find Customer" /></p>' % css_class)
-        reqhandler.response.out.write('<p><strong>Open Work Orders:</strong></p>')
-        reqhandler.response.out.write('<p style="margin-left:15px;">No Open Work Orders</p>')
-        reqhandler.response.out.write('<p><strong>Work Completed:</strong></p>')
-        reqhandler.response.out.write('<p style="margin-left:15px;">No Completed Work Orders</p>')
-        reqhandler.response.out.write('<hr />')
-        reqhandler.response.out.write('<p><strong>App Info:</strong></p>')
-        reqhandler.response.out.write('<p style="margin-left:15px;">%s</p>' % self.__comments)
+        errorText = None
         if self.__errorObj is not None:
-            reqhandler.response.out.write('<p style="margin-left:15px; color:red;">%s</p>' % \
-                                          str(self.__errorObj))        
-        reqhandler.response.out.write('<input type="hidden" name="customer_id"  value="%s" />' % self.__customerId)
-        reqhandler.response.out.write('<input type="hidden" name="vehicle_id"   value="%s" />' % self.__vehicleId)
-        reqhandler.response.out.write('<input type="hidden" name="workorder_id" value="%s" />' % self.__workorderId)
+            if isinstance(self.__errorObj, list):
+                # MaintAppValidation.FieldErrors, one message per line.
+                errorText = safe("<br />".join([escape(str(error), True)
+                                                for error in self.__errorObj]))
+            else:
+                errorText = str(self.__errorObj)
+        SIDE_PANEL_TEMPLATE.renderTo(write, dict(
+            newCustomerClass=(activeLinkClass if (self.__itemSelected == 1) else linkClass),
+            findCustomerClass=(activeLinkClass if (self.__itemSelected == 2) else linkClass),
+            workorderLists=fragmentCache.fragment(self.__workorderListsKey(),
+                                                  self.__renderWorkorderLists),
+            comments=self.__comments,
+            errorText=errorText,
+            customerId=self.__customerId,
+            vehicleId=self.__vehicleId,
+            workorderId=self.__workorderId))
         return None
     
         
@@ -245,6 +461,13 @@ class CustomerSubview(object):
         self.__customer = None
         self.__searchMode = False
         self.__searchResults = None
+        self.__searchCursor = None
+        self.__searchHistory = ""
+        self.__searchNext = None
+        self.__searchTruncated = False
+        self.__prefixSearch = False
+        self.__vehicleResults = None
+        self.__plate = None
         return None
     
     def _configure_content(self, customerInfo):
@@ -259,111 +482,41 @@ class CustomerSubview(object):
         self.__searchMode = False
         return None
     
-    def _configure_search_results(self, customer_list):
+    def _configure_search_results(self, customer_list, cursor, history, next_cursor,
+                                  prefix_search, truncated):
         self.__searchMode = True
+        self.__prefixSearch = prefix_search
+        self.__searchTruncated = truncated
+        self.__vehicleResults = None
+        self.__plate = None
         self.__searchResults = customer_list
+        self.__searchCursor = cursor
+        self.__searchHistory = history
+        self.__searchNext = next_cursor
         return None
     
-    def _serve_content(self, reqhandler):
-        reqhandler.response.out.write("""
-            <table style="margin-top:15px; margin-left:auto; margin-right:auto;">
-            <tr>
-            <td>
-            <label for="first_name">First Name: </label>
-            </td>
-            <td>""")
-        reqhandler.response.out.write('<input type="text" name="first_name" value="%s" />' %
-                                        nz(self.__customer.first_name))
-        reqhandler.response.out.write("""
-            </td>
-            <td>
-            <label for="last_name" style="padding-left:10px">Last Name: </label>
-            </td>
-            <td>""")
-        reqhandler.response.out.write('<input type="text" name="last_name" value="%s" />' %
-                                        nz(self.__customer.last_name))
-        reqhandler.response.out.write("""
-            </td>
-            </tr>
-            <tr>
-            <td>
-            <label for="address1">Address1: </label>
-            </td>
-            <td>""")
-        reqhandler.response.out.write('<input type="text" name="address1" value="%s" />' %
-                                        nz(self.__customer.address1))
-        reqhandler.response.out.write("""
-            </td>
-            <td>
-            <label for="city" style="padding-left:10px">City: </label>
-            </td>
-            <td>""")
-        reqhandler.response.out.write('<input type="text" name="city" value="%s" />' %
-                                        nz(self.__customer.city))
-        reqhandler.response.out.write("""
-            </td>
-            </tr>
-            <tr>
-            <td>
-            <label for="state">State: </label>
-            </td>
-            <td>""")
-        reqhandler.response.out.write('<input type="text" name="state" value="%s" />' %
-                                        nz(self.__customer.state))
-        reqhandler.response.out.write("""
-            </td>
-            <td>
-            <label for="zip" style="padding-left:10px">Zip: </label>
-            </td>
-            <td>""")
-        reqhandler.response.out.write('<input type="text" name="zip" value="%s" />' %
-                                        nz(self.__customer.zip))
-        reqhandler.response.out.write("""
-            </td>
-            </tr>
-            <tr>
-            <td>
-            <label for="phone1">Primary Phone: </label>
-            </td>
-            <td>""")
-        reqhandler.response.out.write('<input type="text" name="phone1" value="%s" />' %
-                                            nz(self.__customer.phone1))
-        reqhandler.response.out.write("""
-            </td>
-            <td></td><td></td>
-            </tr>""")
-        if not self.__searchMode:
-            reqhandler.response.out.write("""
-            <tr><td colspan="4"><br />
-            <label for="comments">Comments:</label><br />
-            <textarea name="comments" rows="3" cols="60">""" + self.__customer.getComments() +  
-              """</textarea>
-            <p style="width:100%; text-align:center;"><input type="submit" name="submit_savecust" value="Save Customer Info" />
-                <input type="submit" name="submit_resetcust_0" value="Reset Customer Info" />
-            </p>
-            </td></tr>
-            </table>""")
-        else:
-            reqhandler.response.out.write("""
-            <tr><td colspan="4">
-            <p style="width:100%; text-align:center;">
-                <input type="submit" name="submit_search" value="Find Customer(s)" />
-                <input type="submit" name="submit_resetcust_1" value="Clear Customer Info" />
-            </p>
-            </td></tr>
-            </table>""")
-            if self.__searchResults is not None:
-                reqhandler.response.out.write("<hr \>")
-                if len(self.__searchResults) == 0:
-                    reqhandler.response.out.write("""
-                    <p><strong>No customers match the search you requested.
-                    </strong></p>""")
-                else:
-                    for customer in self.__searchResults:
-                        link = "/Search?cid=%s" % customer.getId()
-                        reqhandler.response.out.write( \
-                            '<p><a href="%s">%s %s</a></p>' % \
-                            (link, nz(customer.first_name), nz(customer.last_name)))
+    def _configure_vehicle_search_results(self, matches, plate):
+        self.__searchMode = True
+        self.__searchResults = None
+        self.__vehicleResults = matches
+        self.__plate = plate
+        return None
+    
+    def _render(self, write):
+        CUSTOMER_TEMPLATE.renderTo(write, dict(
+            customer=self.__customer,
+            searchMode=self.__searchMode,
+            plate=self.__plate,
+            prefixSearch=self.__prefixSearch,
+            customerResults=(self.__searchResults is not None),
+            searchResults=self.__searchResults,
+            searchCursor=self.__searchCursor,
+            searchHistory=self.__searchHistory,
+            searchNext=self.__searchNext,
+            searchTruncated=self.__searchTruncated,
+            searchPaging=(self.__searchCursor or self.__searchNext),
+            vehicleResults=(self.__vehicleResults is not None),
+            vehicleMatches=self.__vehicleResults))
         return None
     
 class VehicleSubview(object):
@@ -385,9 +538,8 @@ class VehicleSubview(object):
                 break
         return None
     
-    def _serve_content(self, reqhandler):
-        self.__retrieveActiveVehicle()
-        reqhandler.response.out.write('<div style="width:100%">')
+    def __renderTabs(self):
+        tabs = []
         tabNum = -1
         for eachVehicle in self.__vehicles:
             tabNum += 1
@@ -396,88 +548,26 @@ class VehicleSubview(object):
             else:
                 style = "tab_button"
             if eachVehicle.getId() == "-1":
-                reqhandler.response.out.write( \
-                    '<input class="%s" type="submit" name="submit_vtab_%d" value="New Vehicle" />' % \
-                    (style, tabNum, ))
+                label = "New Vehicle"
             else:
-                reqhandler.response.out.write( \
-                    '<input class="%s" type="submit" name="submit_vtab_%d" value="%s" />' % \
-                    (style, tabNum, str(eachVehicle.year)))
-        #<input class="tab_button" type="submit" name="submit_vtab_1" value="2008 Toyota Tercel" />
-        #<input class="selected_tab_button" type="submit" name="submit_vtab_2" value="New Vehicle" />
-        reqhandler.response.out.write("""
-            <hr style="width=102%; margin-top:-1px; padding-top:0px; padding-bottom:0px;" />
-            </div>
-            <table style="margin-top:15px; width:90%; margin-left:auto; margin-right:auto;">
-            <tr>
-            <td>
-            <label for="make">Make: </label>
-            </td>
-            <td>""")
-        reqhandler.response.out.write('<input type="text" name="make" value="%s" />' %
-                                        nz(self.__vehicle.make))
-        reqhandler.response.out.write("""
-            </td>
-            <td>
-            <label for="model" style="padding-left:10px">Model: </label>
-            </td>
-            <td>""")
-        reqhandler.response.out.write('<input type="text" name="model" value="%s" />' %
-                                        nz(self.__vehicle.model))
-        reqhandler.response.out.write("""
-            </td>
-            <td>
-            <label for="year" style="padding-left:10px">Year: </label>
-            </td>
-            <td>""")
-        reqhandler.response.out.write('<input type="text" name="year" size="8" value="%s" />' %
-                                        nz(self.__vehicle.year))
-        reqhandler.response.out.write("""
-            </td>
-            </tr>
-            <tr>
-            <td>
-            <label for="license">License Plate: </label>
-            </td>
-            <td>""")
-        reqhandler.response.out.write('<input type="text" name="license" value="%s" />' %
-                                        nz(self.__vehicle.license))
-        reqhandler.response.out.write("""
-            <input type="hidden" name="mileage" value="150000" />
-            </td>
-            <td>
-            <label for="vin" style="padding-left:10px">VIN: </label>
-            </td>
-            <td colspan="3">""")
-        reqhandler.response.out.write('<input type="text" name="vin" size="40" value="%s" />' %
-                                        nz(self.__vehicle.vin))
-        reqhandler.response.out.write("""
-            </td>
-            </tr>
-            <tr>
-            <td colspan="6"><br />
-            <label for="notes">Notes: </label><br />
-            <textarea name="notes" rows="3" cols="65">""")
-        reqhandler.response.out.write(nz(self.__vehicle.notes))
-        reqhandler.response.out.write("""
-            </textarea>
-            </td>
-            </tr>            
-        """)
-        reqhandler.response.out.write("""
-            <tr><td colspan="3">
-            <p style="width:100%; text-align:left;">
-            <input type="submit" name="submit_savevhcl" value="Save Vehicle Info" />
-            <input type="submit" name="submit_rstrvhcl" value="Clear Vehicle Info" />
-            </p>
-            </td><td colspan="3">
-            <p style="width:100%; text-align:right;">
-            <input type="submit" name="submit_newwo" value="New Work Order" />
-            <input type="submit" name="submit_showwos" value="Show Work Order History" />
-            </p>
-            </td></tr>
-            </table>
-            """)
+                label = str(eachVehicle.year)
+            tabs.append((style, tabNum, label))
+        return VEHICLE_TABS_TEMPLATE.render(tabs=tabs)
+    
+    def __tabsKey(self):
+        """ The tabs only show the id and year of each vehicle and which one
+            is active, so those are the key; the vehicle summaries the tabs are
+            drawn from carry no version.
+        """
+        return ('vehicleTabs', self.__activeVehicleId,
+                tuple([(eachVehicle.getId(), eachVehicle.year)
+                       for eachVehicle in self.__vehicles]))
+    
+    def _render(self, write):
+        self.__retrieveActiveVehicle()
+        VEHICLE_TEMPLATE.renderTo(write, dict(
+            tabStrip=fragmentCache.fragment(self.__tabsKey(), self.__renderTabs),
+            vehicle=self.__vehicle))
         return None
     
 class WorkorderSubview(object):
@@ -487,6 +577,9 @@ class WorkorderSubview(object):
         self.__activeWorkorderId = None
         self.__workorders = None
         self.__workorder = None
+        self.__pageCursor = None
+        self.__pageHistory = ""
+        self.__pageNext = None
         return None
     
     def _configureHeader(self, customer, vehicle):
@@ -502,6 +595,12 @@ class WorkorderSubview(object):
         self.__workorders = workorder_list
         return None
     
+    def _configureWorkorderPaging(self, cursor, history, next_cursor):
+        self.__pageCursor = cursor
+        self.__pageHistory = history
+        self.__pageNext = next_cursor
+        return None
+    
     def __retrieveActiveWorkorder(self):
         for eachWorkorder in self.__workorders:
             if eachWorkorder.getId() == self.__activeWorkorderId:
@@ -509,44 +608,40 @@ class WorkorderSubview(object):
                 break
         return None
     
-    def _serve_content(self, reqhandler):
+    def _render(self, write):
         self.__retrieveActiveWorkorder()
-        self.__output_workorder_header(reqhandler)
-        self.__output_workorder_form(reqhandler)
+        workorder = self.__workorder
+        WORKORDER_TEMPLATE.renderTo(write, dict(
+            header=fragmentCache.fragment(self.__headerKey(), self.__renderHeader),
+            tabs=self.__tabs(),
+            pageCursor=self.__pageCursor,
+            pageHistory=self.__pageHistory,
+            pageNext=self.__pageNext,
+            workorder=workorder,
+            dateCreated=workorder.getDateCreated(),
+            mechanics=[(code, workorder.mechanic == code, MECHANIC_NAMES[code])
+                       for code in MECHANIC_CODES],
+            open=(workorder.status == Workorder.OPEN),
+            completed=(workorder.status == Workorder.COMPLETED),
+            closed=(workorder.status == Workorder.CLOSED)))
         return None
     
-    def __output_workorder_header(self, reqhandler):
-        reqhandler.response.out.write("""
-            <table>
-            <tr>
-                <td>
-                    Customer info:
-                </td>
-                <td>""")
-        reqhandler.response.out.write("%s %s; Contact: %s" %
-                                      (nz(self.__customer.first_name),
-                                       nz(self.__customer.last_name),
-                                       nz(self.__customer.phone1)))
-        reqhandler.response.out.write("""
-                </td>
-            </tr>
-            <tr>
-                <td>
-                    Vehicle info:
-                </td>
-                <td>""")
-        reqhandler.response.out.write("%s %s %s; License: %s" %
-                                      (nz(self.__vehicle.year),
-                                       nz(self.__vehicle.make),
-                                       nz(self.__vehicle.model),
-                                       nz(self.__vehicle.license)))
-        reqhandler.response.out.write("""
-                </td>
-            </tr>
-            </table>""")
-        return None
+    def __renderHeader(self):
+        return WORKORDER_HEADER_TEMPLATE.render(customer=self.__customer,
+                                                vehicle=self.__vehicle)
+    
+    def __headerKey(self):
+        customer = versionStamp(self.__customer)
+        vehicle = versionStamp(self.__vehicle)
+        if customer is None or vehicle is None:
+            return None
+        return ('workorderHeader', customer, vehicle)
     
-    def __format_tabs(self, reqhandler):
+    def __tabs(self):
+        """ One tab per work order on the current page of the history:
+            (css class, index, label).
+        """
+        tabs = []
         woIndex = -1
         for workorder in self.__workorders:
             woIndex += 1
@@ -556,119 +651,210 @@ class WorkorderSubview(object):
                 label = "New Work Order"
             else:
                 label = workorder.date_created.strftime("%b %d, %Y")
-            reqhandler.response.out.write( \
-                '<input style="margin-top:25px;" class="%s" type="submit" name="submit_wotab_%d" value="%s" />' %
-                    (selClass, woIndex, label))
-    
-    def __output_workorder_form(self, reqhandler):
-        reqhandler.response.out.write('<div style="width:100%">')
-        self.__format_tabs(reqhandler)
-        #<input style="margin-top:25px;" class="selected_tab_button" type="submit" name="submit_wotab_0" value="New Workorder" />
-        #<input class="tab_button" type="submit" name="submit_wotab_1" value="12-Dec-2008" />
-        #<input class="tab_button" type="submit" name="submit_wotab_2" value="04-Mar-2009" />
-        reqhandler.response.out.write('<hr style="width=100%; margin-top:-1px; padding-top:0px; padding-bottom:0px;" />')
-        reqhandler.response.out.write('</div>')
-        dateText = nz(self.__workorder.getDateCreated())
-        reqhandler.response.out.write( \
-            '<input type="hidden" name="date_created" value="%s" />' % \
-            dateText)
-        reqhandler.response.out.write("""
-            <table style="margin-top:30px;">
-                <tr>
-                    <td>
-                        Customer's Service Request:
-                    </td>
-                    <td style="text-align:right;">
-                        <label for="mileage">Odometer Reading:</label>""")
-        reqhandler.response.out.write( \
-            '<input type="text" name="mileage" value="%s" />' % \
-            nz(self.__workorder.mileage))
-        reqhandler.response.out.write("""
-                    </td>
-                </tr>
-                <tr>
-                    <td colspan="2">
-                        <textarea name="customer_request" rows="3" cols="85">""")
-        reqhandler.response.out.write(nz(self.__workorder.customer_request))
-        reqhandler.response.out.write("""
-                        </textarea>
-                    </td>
-                </tr>
-                <tr><td colspan="2"><hr /></td></tr>
-                <tr>
-                    <td>""")
-        reqhandler.response.out.write( \
-            "Work Order Date: %s" % dateText)
-        reqhandler.response.out.write("""
-                    </td>
-                    <td style="text-align:right;">
-                        <label for "mechanic">Mechanic:</label>
-                        <select name="mechanic">
-                        <option value="mechanic_0">Select...</option>""")
-        reqhandler.response.out.write( \
-            '<option value="mechanic_1"%s>Jerome Calvo</option>' % \
-                (' selected="selected"' if self.__workorder.mechanic=="mechanic_1" else ""))
-        reqhandler.response.out.write( \
-            '<option value="mechanic_2"%s>Les Faby</option>' % \
-                (' selected="selected"' if self.__workorder.mechanic=="mechanic_2" else ""))
-        reqhandler.response.out.write( \
-            '<option value="mechanic_3"%s>Brad Gaiser</option>' % \
-                (' selected="selected"' if self.__workorder.mechanic=="mechanic_3" else ""))
-        reqhandler.response.out.write( \
-            '<option value="mechanic_4"%s>Wing Wong</option>' % \
-                (' selected="selected"' if self.__workorder.mechanic=="mechanic_4" else ""))
-        reqhandler.response.out.write("""
-                        </select>
-                    </td>
-                </tr>
-                <tr>
-                    <td>
-                        <label for "mechanics_tasks">Mechanics Tasks:</label><br />
-                        <textarea name="task_list" rows="7" cols="40">""")
-        reqhandler.response.out.write(nz(self.__workorder.task_list))
-        reqhandler.response.out.write("""
-                        </textarea>
-                    </td>
-                    <td>
-                        <label for "work_done">Work Performed:</label><br />
-                        <textarea name="work_performed" rows="7" cols="40">""")
-        reqhandler.response.out.write(nz(self.__workorder.work_performed))
-        reqhandler.response.out.write("""
-                        </textarea>
-                    </td>
-                </tr>
-                <tr>
-                    <td colspan="2">
-                        <label for "next_service">Notes and next service recommendations:</label><br />
-                        <textarea name="notes" rows="4" cols="85">""")
-        reqhandler.response.out.write(nz(self.__workorder.notes))
-        reqhandler.response.out.write("""
-                        </textarea>
-                    </td>
-                </tr>
-                <tr>
-                    <td colspan="2" style="text-align:center;">
-                        <label for "status">Work Order Status:</label>""")
-        reqhandler.response.out.write( \
-            '<input style="margin-left:15px;" type="radio" name="status" value="Open" %s /> Open' % \
-                ('checked="checked"' if self.__workorder.status == Workorder.OPEN else ''))
-        reqhandler.response.out.write( \
-            '<input style="margin-left:25px;" type="radio" name="status" value="Completed" %s /> Completed' % \
-                ('checked="checked"' if self.__workorder.status == Workorder.COMPLETED else ''))
-        reqhandler.response.out.write( \
-            '<input style="margin-left:15px;" type="radio" name="status" value="Closed" %s /> Closed' % \
-                ('checked="checked"' if self.__workorder.status == Workorder.CLOSED else ''))
-        reqhandler.response.out.write("""
-                    </td>
-                </tr>
-                <tr>
-                    <td colspan="2">
-                        <p style="width:100%; text-align:center;">
-                        <input type="submit" name="submit_savewo" value="Save Work Order" />
-                        <input type="submit" name="submit_rstrwo" value="Restore Work Order" />
-                        </p>
-                    </td>
-                </tr>
-            </table>""")
+            tabs.append((selClass, woIndex, label))
+        return tabs
+
+
+class TestMaintAppView(object):
+    class FakeRequestHandler(object):
+        """ Stands in for a webapp.RequestHandler: the page goes to a StringIO
+            as it does in webapp.Response.
+        """
+        class Response(object):
+            def __init__(self):
+                self.out = StringIO()
+        
+        def __init__(self):
+            self.response = TestMaintAppView.FakeRequestHandler.Response()
+    
+    def __customerPage(self, viewClass=MaintAppView, board=True):
+        """ A customer page, with the shop board in the side panel if board.
+            viewClass may be the MaintAppView of the baseline, which takes no
+            shop board.
+        """
+        view = viewClass(None)
+        customer = Customer(id='c1', first_name='Fiona', last_name='Wong',
+                            address1='PO Box 3134', city='Santa Clara', state='CA',
+                            zip='95055', phone1='111.111.1111', email='fionawhwong@gmail.com')
+        vehicles = [Vehicle(id='v%d' % i, customer_id='c1', make='Honda', model='Civic',
+                            year='200%d' % i, license='4ABC12%d' % i, notes='dent in door')
+                    for i in range(3)]
+        for vehicle in vehicles:
+            vehicle.version = 1
+        workorders = [WorkorderSummary(id='w%d' % i, vehicle_id='v1',
+                                       vehicle_label='2001 Honda Civic', mechanic='mechanic_2')
+                      for i in range(8)]
+        view.set_customer_vehicle_mode()
+        view.configureHiddenFields('c1', 'v1', '-1')
+        if board:
+            view.configureSidePanelContent(None, workorders, workorders[:3], "", 1)
+        else:
+            view.configureSidePanelContent(None, [], [], "")
+        view.configureCustomerContent(customer)
+        view.configureVehicleContent(vehicles)
+        return view
+    
+    def __workorderPage(self, viewClass=MaintAppView, board=True):
+        view = self.__customerPage(viewClass, board)
+        customer = Customer(id='c1', first_name='Fiona', last_name='Wong', phone1='111.111.1111')
+        vehicle = Vehicle(id='v1', make='Honda', model='Civic', year='2001', license='4ABC121')
+        customer.version = vehicle.version = 1
+        workorders = [Workorder(vehicle_id='v1', mileage='%d' % (40000 + i * 5000),
+                                mechanic='mechanic_2', customer_request='oil change ' * 20,
+                                task_list='check brakes', notes='due again in 3 months')
+                      for i in range(4)]
+        view.set_workorder_mode()
+        view.configureWorkorderHeader(customer, vehicle)
+        view.configureWorkorderContent(workorders)
+        if viewClass is MaintAppView:
+            view.configureWorkorderPaging()
+        return view
+    
+    def __timePage(self, view, repeat, rounds=5, buffered=True):
+        """ (seconds per page, page) serving view repeat times, split into
+            rounds; the time is that of the fastest round.  Unless buffered,
+            each fragment of the page is written to the response as it is
+            rendered instead of going through a RenderBuffer.
+        """
+        best = None
+        for i in range(rounds):
+            start = time.time()
+            for j in range(repeat / rounds):
+                handler = TestMaintAppView.FakeRequestHandler()
+                if buffered:
+                    view.serve_content(handler)
+                else:
+                    view.render(handler.response.out)
+                page = handler.response.out.getvalue()
+            elapsed = (time.time() - start) / (repeat / rounds)
+            if best is None or elapsed < best:
+                best = elapsed
+        return (best, page)
+    
+    def testEscaping(self):
+        """ Text from the form or the datastore must come out escaped, both in
+            the search form and in the vehicle search results.
+        """
+        print "** testing that values are escaped..."
+        plate = '"><script>alert(1)</script>'
+        view = MaintAppView(None)
+        owner = Customer(id='c1', first_name='Fiona', last_name='<b>Wong</b>')
+        vehicle = Vehicle(id='v1', customer_id='c1', make='Honda', model='Civic',
+                          year='2001', license=plate)
+        view.set_search_mode()
+        view.configureHiddenFields('-1', '-1', '-1')
+        view.configureSidePanelContent(2, [], [], "")
+        view.configureCustomerContent(Customer())
+        view.configureVehicleSearchResults([(owner, vehicle)], plate)
+        handler = TestMaintAppView.FakeRequestHandler()
+        view.serve_content(handler)
+        page = handler.response.out.getvalue()
+        escaped = '&quot;&gt;&lt;script&gt;alert(1)&lt;/script&gt;'
+        print "plate input escaped: %s" % ('value="%s"' % escaped in page)
+        print "vehicle match escaped: %s" % (('(%s)</a>' % escaped) in page)
+        print "owner name escaped: %s" % ('&lt;b&gt;Wong&lt;/b&gt;' in page)
+        print "no raw markup: %s" % ('<script>' not in page and '<b>' not in page)
+        return ('<script>' not in page and '<b>' not in page and
+                page.count(escaped) == 2)
+    
+    def benchmarkRendering(self, repeat=2000, baseline=None):
+        """ Time serving pages from the templates: written out a fragment at a
+            time and through a RenderBuffer, and without and with the fragment
+            cache.  Then time parsing the templates, which is done once per
+            process rather than per page.
+            
+            baseline is the MaintAppView module from before the templates, if
+            given (see main); the same pages, less the shop board, are then
+            served by both and compared.
+        """
+        global fragmentCache
+        print "** benchmarking page rendering..."
+        saved = fragmentCache
+        try:
+            for cacheLabel, cache in (("uncached", FragmentCache(0)),
+                                      ("fragment cache", FragmentCache(FRAGMENT_CACHE_SIZE))):
+                fragmentCache = cache
+                pages = []
+                for label, view in (("customer page", self.__customerPage()),
+                                    ("work order page", self.__workorderPage())):
+                    fragments = RenderBuffer()
+                    view.render(fragments)
+                    writeTime, written = self.__timePage(view, repeat, buffered=False)
+                    renderTime, page = self.__timePage(view, repeat)
+                    assert written == page, "buffered page differs"
+                    print "%s, %s, %d bytes: %d writes %.1f us, buffered %.1f us" % \
+                          (cacheLabel, label, len(page), len(fragments.fragments),
+                           writeTime * 1e6, renderTime * 1e6)
+                    pages.append(page)
+                stats = cache.getStats()
+                print "%s: %d hits, %d misses, %d evictions, %d of %d fragments kept" % \
+                      (cacheLabel, stats['hits'], stats['misses'], stats['evictions'],
+                       stats['size'], stats['capacity'])
+                if cache.capacity:
+                    assert pages == uncachedPages, "cached pages differ"
+                else:
+                    uncachedPages = pages
+            
+            if baseline is not None:
+                fragmentCache = FragmentCache(0)
+                for label, makePage in (("customer page", self.__customerPage),
+                                        ("work order page", self.__workorderPage)):
+                    oldTime, oldPage = self.__timePage(makePage(baseline.MaintAppView,
+                                                                board=False), repeat)
+                    newTime, newPage = self.__timePage(makePage(board=False), repeat)
+                    print "baseline, %s: %.1f us, templates uncached %.1f us" % \
+                          (label, oldTime * 1e6, newTime * 1e6)
+                    self.__comparePages(label, oldPage, newPage)
+        finally:
+            fragmentCache = saved
+        
+        sources = []
+        for name in ('page.html', 'sidePanel.html', 'customer.html',
+                     'vehicle.html', 'workorder.html', 'workorderLists.html',
+                     'vehicleTabs.html', 'workorderHeader.html'):
+            f = open(os.path.join(TEMPLATE_DIR, name), 'rU')
+            sources.append((f.read(), name))
+            f.close()
+        start = time.time()
+        for i in range(repeat / 10):
+            for source, name in sources:
+                Template(source, name)
+        parseTime = (time.time() - start) / (repeat / 10)
+        print "parsing the %d templates: %.1f us" % (len(sources), parseTime * 1e6)
         return None
-    
\ No newline at end of file
+    
+    def __comparePages(self, label, oldPage, newPage):
+        """ Print whether two pages are the same but for the whitespace around
+            tags, or where they first differ.
+        """
+        def normalize(page):
+            return re.sub(r'\s*([<>])\s*', r'\1', re.sub(r'\s+', ' ', page)).strip()
+        old = normalize(oldPage)
+        new = normalize(newPage)
+        if old == new:
+            print "baseline, %s: same page" % label
+            return None
+        at = 0
+        while at < min(len(old), len(new)) and old[at] == new[at]:
+            at += 1
+        print "baseline, %s: differs at %d:\n    was %r\n    now %r" % \
+              (label, at, old[max(at - 40, 0):at + 60], new[max(at - 40, 0):at + 60])
+        return None
+
+def main():
+    """ Test escaping and benchmark rendering.  --baseline PATH compares with
+        the MaintAppView.py from before the templates, e.g. as written out by
+        git show <commit>:src/MaintAppView.py.
+    """
+    baseline = None
+    if '--baseline' in sys.argv:
+        path = sys.argv[sys.argv.index('--baseline') + 1]
+        baseline = imp.load_source('MaintAppViewBaseline', path)
+    test = TestMaintAppView()
+    if not test.testEscaping():
+        print "FAILED"
+        sys.exit(1)
+    test.benchmarkRendering(baseline=baseline)
+
+if __name__ == '__main__':
+    main()
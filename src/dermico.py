@@ -3,19 +3,25 @@
     This module provides the main routine and the implementation of the
     Contoller class in the MVC implementation of the Auto Shop Maintenance
     Records System.
-    06/04/09  Added support for templates via import ~ Jerome Calvo [1]
+    06/04/09  Added support for templates via import ~ Jerome Calvo
 """
 
 import sys
+import logging
+import threading
+from StringIO import StringIO
 
 from google.appengine.ext import webapp
-from google.appengine.ext.webapp import template    # [1]
 from google.appengine.ext.webapp.util import run_wsgi_app
 
 from MaintAppView import MaintAppView
 from MaintAppModel import MaintAppModel, ValidationErrors
 from MaintAppObjects import Customer, Vehicle, Workorder
 
+# Placeholder kept in the page history of a paged list (search results, work
+# order history) for the first page, which has no cursor.
+FIRST_PAGE = "first"
+
 
 class DefaultConfiguration(webapp.RequestHandler):
     def get(self):
@@ -32,6 +38,8 @@ class SearchLinkHandler(webapp.RequestHandler):
             from the results of a customer search.  The results are fed back to the
             server as get request:  http://...../Search?cid=#### where #### is the
             database primary key for the customer information being displayed.
+            Links from a license plate/VIN search add &vid=#### to select the
+            vehicle tab as well.
         """
         customer_id = self.request.get('cid')
         MaintAppController.theController().handle_button_events(self, "showcust", customer_id)
@@ -41,7 +49,9 @@ class SearchLinkHandler(webapp.RequestHandler):
 class CustomerInput(webapp.RequestHandler):
     def post(self):
         button_pressed = self.__getbutton()
-        button_fields = button_pressed.split("_")
+        # Only split off the command; the index may itself contain '_' (work
+        # order buttons carry the datastore key.)
+        button_fields = button_pressed.split("_", 1)
         button = button_fields[0]
         tag = (None if len(button_fields) < 2 else button_fields[1])
         MaintAppController.theController().handle_button_events(self, button, tag)
@@ -71,48 +81,97 @@ class CustomerInput(webapp.RequestHandler):
 class MaintAppController(object):
     """ Main class for implementing the Controller portion of MVC implementation
         of the Maintenance Records System.
+        
+        There is a single instance (see theController) and it only holds what
+        every request shares and nobody changes once it is set up: the WSGI
+        application, the dispatch table and the list of context changing
+        actions.  Everything that belongs to one request (form values, active
+        ids, the View and the Model) lives in a RequestController made for
+        that request, so requests can be served on several threads at once.
     """
     __theController = None
     
     def __init__(self):
         MaintAppController.__theController = self
-        self.__view = MaintAppView(self)
         self.__app = webapp.WSGIApplication(
                                             [('/',         DefaultConfiguration),
                                              ('/Customer', CustomerInput),
                                              ('/Search',   SearchLinkHandler)],
                                              debug=True)
 
-        self.__dispatch_table = {"newcust"   : MaintAppController.addNewCustomer,
-                                 "findcust"  : MaintAppController.setupCustomerSearch,
-                                 "savecust"  : MaintAppController.saveCustomerInfo,
-                                 "showcust"  : MaintAppController.showCustomer,
-                                 "resetcust" : MaintAppController.clearCustomerInfo,
-                                 "rstrcust"  : MaintAppController.restoreCustomerInfo,
-                                 "search"    : MaintAppController.doSearch,
-                                 "savevhcl"  : MaintAppController.saveVehicleInfo,
-                                 "rstrvhcl"  : MaintAppController.restoreVehicleInfo,
-                                 "vtab"      : MaintAppController.vehicleTabClicked,
-                                 "newwo"     : MaintAppController.newWorkOrder,
-                                 "showwos"   : MaintAppController.showWorkOrderHistory,
-                                 "savewo"    : MaintAppController.saveWorkOrder,
-                                 "wotab"     : MaintAppController.workOrderTabClicked,
-                                 "activewo"  : MaintAppController.displayActiveWorkOrder,
-                                 "rstrwo"    : MaintAppController.restoreWorkOrder}
-        
-        self.__contextChangingActions = \
-            ["newcust", "findcust", "vtab", "showwos", "wotab", "activewo"]
-        self.__model = MaintAppModel()
-        self.__model.initialize()
-        self.__userValues = None
-        self.__clearHiddenIdFields()
+        self.__dispatch_table = {"newcust"   : RequestController.addNewCustomer,
+                                 "findcust"  : RequestController.setupCustomerSearch,
+                                 "savecust"  : RequestController.saveCustomerInfo,
+                                 "showcust"  : RequestController.showCustomer,
+                                 "resetcust" : RequestController.clearCustomerInfo,
+                                 "rstrcust"  : RequestController.restoreCustomerInfo,
+                                 "search"    : RequestController.doSearch,
+                                 "savevhcl"  : RequestController.saveVehicleInfo,
+                                 "rstrvhcl"  : RequestController.restoreVehicleInfo,
+                                 "vtab"      : RequestController.vehicleTabClicked,
+                                 "newwo"     : RequestController.newWorkOrder,
+                                 "showwos"   : RequestController.showWorkOrderHistory,
+                                 "savewo"    : RequestController.saveWorkOrder,
+                                 "wotab"     : RequestController.workOrderTabClicked,
+                                 "wopage"    : RequestController.workOrderPageClicked,
+                                 "activewo"  : RequestController.displayActiveWorkOrder,
+                                 "rstrwo"    : RequestController.restoreWorkOrder}
         
+        # Each thread serving requests keeps a Model of its own; see workerModel.
+        self.__workerState = threading.local()
         return None
     
     @staticmethod
     def theController():
         return MaintAppController.__theController
+    
+    def wsgiApplication(self):
+        return self.__app
+    
+    def dispatchFunction(self, whichButton):
+        """ The RequestController method handling whichButton, or None. """
+        return self.__dispatch_table.get(whichButton)
+    
+    def workerModel(self):
+        """ The Model of the thread serving the current request.  A worker
+            thread makes one the first time it serves a request and reuses it
+            for every request after that; MaintAppModel.beginRequest and
+            endRequest keep the requests apart.
+        """
+        model = getattr(self.__workerState, 'model', None)
+        if model is None:
+            model = MaintAppModel()
+            model.initialize()
+            self.__workerState.model = model
+        return model
+    
+    def handle_button_events(self, reqhandler, whichButton, bIndex):
+        """ Handle one request with a RequestController of its own. """
+        RequestController(self).handle_button_events(reqhandler, whichButton, bIndex)
+        return None
+        
+    def run(self):
+        run_wsgi_app(self.__app)
+
 
+class RequestController(object):
+    """ The Controller state and button handlers for a single request.  A new
+        one, with its own View, is made for every request by
+        MaintAppController.handle_button_events and dropped once the page has
+        been served.  The Model is the one of the thread serving the request
+        (see MaintAppController.workerModel), so nothing here is shared with
+        requests running at the same time.
+    """
+    
+    def __init__(self, controller):
+        self.__controller = controller
+        self.__view = MaintAppView(self)
+        self.__model = controller.workerModel()
+        self.__userValues = None
+        self.__clearHiddenIdFields()
+        
+        return None
+    
     def view(self):
         return self.__view
     
@@ -120,19 +179,18 @@ class MaintAppController(object):
         """ Retrieve form fields from request handler, then call the
             handler for the particular button or link that resulted 
             in the current html request.
+            
+            The Model caches every entity it reads while the request is being
+            handled; the cache is flushed once the page has been served.
         """
         
-        self.__getValues(reqhandler)
-        if bIndex != "STARTUP":
-            self.__getHiddenIdFields()
-        
-        # If button would result in context change where edits might be lost, 
-        # display dialog prompting for save or not.
-        if whichButton in self.__contextChangingActions and self.__fieldsNeedSaving():
-            self.__view.showSaveDialog(whichButton)
-            self.__regenerateCurrentView()
-        else:    
-            dispatch_function = self.__dispatch_table[whichButton]
+        self.__model.beginRequest()
+        try:
+            self.__getValues(reqhandler)
+            if bIndex != "STARTUP":
+                self.__getHiddenIdFields()
+            
+            dispatch_function = self.__controller.dispatchFunction(whichButton)
             if dispatch_function is not None:
                 dispatch_function(self, reqhandler, bIndex)
             else:
@@ -141,6 +199,13 @@ class MaintAppController(object):
                 
             self.__configureHiddenIdFields()
             self.__view.serve_content(reqhandler)
+        finally:
+            stats = self.__model.endRequest()
+            cacheStats = self.__model.getCacheStats()
+            logging.debug("'%s' request: %d identity map hits, %d datastore gets, %d queries; "
+                          "memcache hit ratio %.2f" %
+                          (whichButton, stats['hits'], stats['gets'], stats['queries'],
+                           cacheStats['hit_ratio']))
         return None
     
     ##############################################################################
@@ -201,7 +266,6 @@ class MaintAppController(object):
         """
         retVehicle = None
         for vehicle in vehicleList:
-            sys.stderr.write("%s -- %s\n" % (vehicle.getId(), self.__activeVehicleId))
             if vehicle.getId() == self.__activeVehicleId:
                 retVehicle = vehicle
                 break
@@ -217,6 +281,79 @@ class MaintAppController(object):
                 retWorkorder = workorder
                 break
         return retWorkorder
+    
+    def __replaceActiveRecord(self, records, activeId, record):
+        """ Put record, the active one loaded from the form fields, in place
+            of the entry of records whose id is activeId (at the front of the
+            list if there is none.)
+        """
+        for index, entry in enumerate(records):
+            if entry.getId() == activeId:
+                records[index] = record
+                return records
+        records.insert(0, record)
+        return records
+
+    def __pageCursors(self, prefix, tag):
+        """ Work out which page of a cursor paged list to show.  The cursor of
+            the page being shown, the cursors of the earlier pages and the
+            cursor of the next page travel in the hidden form fields
+            <prefix>_cursor, <prefix>_history and <prefix>_next.  tag is None
+            for the first page, "same" to stay on the page being shown, or
+            "next"/"prev".  Returns a (cursor, history list) pair.
+        """
+        cursor = None
+        history = []
+        if tag is not None:
+            cursor = self.__userValues.get(prefix + '_cursor') or None
+            if self.__userValues.get(prefix + '_history'):
+                history = self.__userValues[prefix + '_history'].split(",")
+            if tag == "next":
+                history.append(cursor or FIRST_PAGE)
+                cursor = self.__userValues.get(prefix + '_next') or None
+            elif tag == "prev" and len(history) > 0:
+                cursor = history.pop()
+                if cursor == FIRST_PAGE:
+                    cursor = None
+        return (cursor, history)
+    
+    def __getWorkorderPage(self, tag=None):
+        """ Retrieve the page of the active vehicle's work order history picked
+            by tag (see __pageCursors), pass the paging state on to the View and
+            return the work orders on the page, newest first.  The work orders
+            are tab summaries; see __loadActiveRecord.
+        """
+        cursor, history = self.__pageCursors('wo', tag)
+        workorders, nextCursor = \
+            self.__model.getWorkorderHistoryPage(self.__activeVehicleId, cursor,
+                                                 summary=True)
+        self.__view.configureWorkorderPaging(cursor, ",".join(history), nextCursor)
+        return workorders
+    
+    def __getVehicleTabs(self):
+        """ Retrieve the active customer's vehicles as tab summaries; see
+            __loadActiveRecord.
+        """
+        return self.__model.getVehicleList(self.__activeCustomerId, summary=True)
+    
+    def __loadActiveRecord(self, items, activeId, getRecord):
+        """ The vehicle and work order lists behind the tabs only carry what
+            the tab labels show.  Replace the entry the View will display (the
+            one matching activeId, or the first one when none does) with the
+            full record from getRecord.  Nothing is loaded when activeId is
+            "-1": the View is showing the empty slot for a new item.
+        """
+        if activeId == "-1" or len(items) == 0:
+            return items
+        index = 0
+        for i in range(len(items)):
+            if items[i].getId() == activeId:
+                index = i
+                break
+        record = getRecord(items[index].getId())
+        if record is not None:
+            items[index] = record
+        return items
 
     ##############################################################################
     # The following three functions are refactored code that was repeated a
@@ -233,10 +370,10 @@ class MaintAppController(object):
                 3 = Item in one of work order lists corresponding to
                      activeWorkorderId)
         """
-        openWorkorders = self.__model.getOpenWorkorders()
-        completedWorkorders = self.__model.getCompletedWorkorders()
+        openWorkorders, completedWorkorders, boardVersion = self.__model.getShopBoard()
         self.__view.configureSidePanelContent( \
-               activeElement, openWorkorders, completedWorkorders, debug_message)
+               activeElement, openWorkorders, completedWorkorders, debug_message,
+               boardVersion)
         return None
     
     def __configureVehicleInfo(self):
@@ -254,7 +391,9 @@ class MaintAppController(object):
             activeVehicleList = [activeVehicle]
             self.__activeVehicleId = "-1"
         else:
-            activeVehicleList = self.__model.getVehicleList(self.__activeCustomerId)
+            activeVehicleList = self.__loadActiveRecord(self.__getVehicleTabs(),
+                                                        self.__activeVehicleId,
+                                                        self.__model.getVehicle)
             # There is always an unsaved vehicle record at the end of the list for
             # entering new vehicle information.
             newVehicleSlot = Vehicle()
@@ -362,17 +501,68 @@ class MaintAppController(object):
               below the search boxes per item 3 in mockup.  The hyperlink target
               will be /Search?cid=### where ### corresponds to the customer id
               for the Customer represented by the hyperlink.
+              
+            Results are paged.  The 'tag' is None for a new search, "next" or
+            "prev" when paging.  The cursor of the page being shown, the cursor
+            of the next page and the cursors of the earlier pages travel back
+            and forth in hidden form fields so paging costs the same no matter
+            how deep into the results the user is.
+            
+            When the 'Partial names' box is checked the name fields are matched
+            against the start of the customer's name words, ignoring case.
+            
+            If a license plate or VIN was entered, search vehicles instead (see
+            __doVehicleSearch.)
         """
+        plate = self.__userValues.get('plate')
+        if plate:
+            self.__doVehicleSearch(plate)
+            return None
+        
         searchCriteria = Customer()
         searchCriteria.loadFromDictionary(self.__userValues)
         self.__view.configureCustomerContent(searchCriteria)
         
-        searchResults = self.__model.searchForMatchingCustomers(searchCriteria)
-        self.__view.configureSearchResults(searchResults)
-        self.__configureSidePanel(2, "Search Results: %d" % len(searchResults))
+        cursor, history = self.__pageCursors('search', tag)
+        prefixSearch = 'prefix_search' in self.__userValues
+        searchResults, nextCursor = \
+            self.__model.searchCustomersPage(searchCriteria, cursor,
+                                             prefixSearch=prefixSearch)
+        self.__view.configureSearchResults(searchResults, cursor, ",".join(history),
+                                           nextCursor, prefixSearch,
+                                           self.__model.searchTruncated)
+        self.__configureSidePanel(2, "Search Results: %d (page %d)" %
+                                     (len(searchResults), len(history) + 1))
         self.__view.set_search_results_mode()
         return None
     
+    def __doVehicleSearch(self, plate):
+        """ Find vehicles by license plate or VIN.  A single match goes straight
+            to the customer/vehicle form with that vehicle's tab active;
+            otherwise the matches are listed as links to the owners with the
+            vehicle preselected.
+        """
+        matches = self.__model.findVehiclesByPlateOrVin(plate)
+        if len(matches) == 1:
+            customer, vehicle = matches[0]
+            self.__activeCustomerId = customer.getId()
+            self.__activeVehicleId = vehicle.getId()
+            self.__activeWorkorderId = "-1"
+            self.__view.configureCustomerContent(customer)
+            vehicleList = self.__loadActiveRecord(self.__getVehicleTabs(),
+                                                  self.__activeVehicleId,
+                                                  self.__model.getVehicle)
+            vehicleList.append(Vehicle())
+            self.__view.configureVehicleContent(vehicleList)
+            self.__configureSidePanel(0, "Found Vehicle %s" % vehicle.license)
+            self.__view.set_customer_vehicle_mode()
+        else:
+            self.__view.configureCustomerContent(Customer())
+            self.__view.configureVehicleSearchResults(matches, plate)
+            self.__configureSidePanel(2, "Vehicle Search Results: %d" % len(matches))
+            self.__view.set_search_results_mode()
+        return None
+    
     def saveVehicleInfo(self, reqhandler, tag):
         """ Save the Vehicle information to the data store.  Redisplay the current
             set of vehicles with an empty slot for the New Vehicle tab.
@@ -393,11 +583,15 @@ class MaintAppController(object):
             self.__activeVehicleId = self.__model.saveVehicleInfo(vehicle)
             # Need to load the vehicle list after saving the vehicle so saved
             # vehicle is in list.
-            vehicleList = self.__model.getVehicleList(self.__activeCustomerId)
+            vehicleList = self.__loadActiveRecord(self.__getVehicleTabs(),
+                                                  self.__activeVehicleId,
+                                                  self.__model.getVehicle)
             vehicleList.append(Vehicle())
         else:
             self.__view.configureErrorMessages(errorList)
-            vehicleList = self.__model.getVehicleList(self.__activeCustomerId)
+            vehicleList = self.__loadActiveRecord(self.__getVehicleTabs(),
+                                                  self.__activeVehicleId,
+                                                  self.__model.getVehicle)
             if self.__activeVehicleId == "-1":
                 # User was entering info for a new vehicle.  Just append the
                 # vehicle loaded from the UI to the end of the list as the
@@ -406,9 +600,8 @@ class MaintAppController(object):
             else:
                 # Replace entry in list with the active one whose values were
                 #   loaded from the form fields.
-                vehicleIndex = self.__findActiveVehicle(vehicleList)
-                vehicleList.pop(vehicleIndex)
-                vehicleList.insert(vehicleIndex, vehicle)
+                self.__replaceActiveRecord(vehicleList, self.__activeVehicleId,
+                                           vehicle)
             
         customer = Customer()
         customer.loadFromDictionary(self.__userValues)
@@ -437,9 +630,11 @@ class MaintAppController(object):
             Configure the customer and vehicle information in the View.
             Ask the View to rerender.
         """
-        vehicleList = self.__model.getVehicleList(self.__activeCustomerId)
+        vehicleList = self.__getVehicleTabs()
         vehicleList.append(Vehicle())
         self.__activeVehicleId = vehicleList[int(tag)].getId()
+        self.__loadActiveRecord(vehicleList, self.__activeVehicleId,
+                                self.__model.getVehicle)
         
         customer = Customer()
         customer.loadFromDictionary(self.__userValues)
@@ -460,8 +655,10 @@ class MaintAppController(object):
                and active work order index of 0 to display first tab
         """
         self.__configureWorkorderCustomerVehicleInfo()
-        workorders = self.__model.getWorkorderList(self.__activeVehicleId)
-        self.__activeWorkorderId == "-1"  # Creating a new work order.
+        workorders = self.__getWorkorderPage()
+        self.__loadActiveRecord(workorders, self.__activeWorkorderId,
+                                self.__model.getWorkorder)
+        self.__activeWorkorderId = "-1"  # Creating a new work order.
         workorders.insert(0, Workorder())
         self.__view.configureWorkorderContent(workorders)
         self.__configureSidePanel(0, "New Workorder")
@@ -477,8 +674,10 @@ class MaintAppController(object):
             Tell view to go into Show Work Order mode passing in list of work orders and
               active work order index of 0 to display first tab
         """
-        workorders = self.__model.getWorkorderList(self.__activeVehicleId)
+        workorders = self.__getWorkorderPage()
         self.__activeWorkorderId = workorders[0].getId()
+        self.__loadActiveRecord(workorders, self.__activeWorkorderId,
+                                self.__model.getWorkorder)
         self.__configureWorkorderCustomerVehicleInfo()
         self.__view.configureWorkorderContent(workorders)
         self.__configureSidePanel(3, "Show Workorder History")
@@ -517,24 +716,30 @@ class MaintAppController(object):
             if self.__activeWorkorderId == "-1": # New workorder to be saved.
                 workorder.setDateCreated()
                 workorder.setVehicleId(self.__activeVehicleId)
-            elif workorder.status == Workorder.CLOSED and \
-                    workorder.getDateClosed() is not None:
-                workorder.setDateClosed()
+                page = None     # The new work order is the newest one.
+            else:
+                page = "same"
+                if workorder.status == Workorder.CLOSED and \
+                        workorder.getDateClosed() is not None:
+                    workorder.setDateClosed()
             self.__activeWorkorderId = self.__model.saveWorkorder(workorder)
             
-            workorders = self.__model.getWorkorderList(self.__activeVehicleId)
+            workorders = self.__getWorkorderPage(page)
+            self.__loadActiveRecord(workorders, self.__activeWorkorderId,
+                                    self.__model.getWorkorder)
         else:
             self.__view.configureErrorMessages(errorList)
-            workorders = self.__model.getWorkorderList(self.__activeVehicleId)
+            workorders = self.__getWorkorderPage("same")
+            self.__loadActiveRecord(workorders, self.__activeWorkorderId,
+                                    self.__model.getWorkorder)
             if self.__activeWorkorderId == "-1":
                 # User is entering a new workorder.
                 workorders.insert(0, workorder)
             else:
                 # Replace entry in list with the active one whose values were
                 #   loaded from the form fields.
-                workorderIndex = self.__findActiveWorkorder(workorders)
-                workorders.pop(workorderIndex)
-                workorders.insert(workorderIndex, workorder)
+                self.__replaceActiveRecord(workorders, self.__activeWorkorderId,
+                                           workorder)
                 
         self.__configureWorkorderCustomerVehicleInfo()
         self.__view.configureWorkorderContent(workorders)
@@ -553,14 +758,32 @@ class MaintAppController(object):
               It is unknown at this point whether the Work Order list is cached or
               not and whether it is cached by the view or by the controller.
         """
-        workorders = self.__model.getWorkorderList(self.__activeVehicleId)
+        workorders = self.__getWorkorderPage("same")
         self.__activeWorkorderId = workorders[int(tag)].getId()
+        self.__loadActiveRecord(workorders, self.__activeWorkorderId,
+                                self.__model.getWorkorder)
         self.__configureWorkorderCustomerVehicleInfo()
         self.__view.configureWorkorderContent(workorders)
         self.__configureSidePanel(3, "Workorder Tab Change")
         self.__view.set_workorder_mode()
         return None
     
+    def workOrderPageClicked(self, reqhandler, tag):
+        """ The user asked for the next (older) or previous (newer) page of
+            work order tabs; tag is "next" or "prev".  The first work order on
+            the new page is made active.
+        """
+        workorders = self.__getWorkorderPage(tag)
+        if len(workorders) > 0:
+            self.__activeWorkorderId = workorders[0].getId()
+        self.__loadActiveRecord(workorders, self.__activeWorkorderId,
+                                self.__model.getWorkorder)
+        self.__configureWorkorderCustomerVehicleInfo()
+        self.__view.configureWorkorderContent(workorders)
+        self.__configureSidePanel(3, "Workorder Page Change")
+        self.__view.set_workorder_mode()
+        return None
+    
     
     def displayActiveWorkOrder(self, reqhandler, tag):
         """ Display either an open work order or a completed work order in response
@@ -580,13 +803,18 @@ class MaintAppController(object):
             Set active customer/vehicle/workorder ids.
             Tell view to rerender.
         """
-        self.__activeWorkorderId = int(tag)
+        self.__activeWorkorderId = tag
         activeWorkorder = self.__model.getWorkorder(self.__activeWorkorderId)
         self.__activeVehicleId = activeWorkorder.getVehicleId()
         vehicle = self.__model.getVehicle(self.__activeVehicleId)
         self.__activeCustomerId = vehicle.getCustomerId()
         
-        workorders = self.__model.getWorkorderList(self.__activeVehicleId)
+        workorders = self.__getWorkorderPage()
+        if self.__findActiveWorkorder(workorders) is None:
+            # Older than anything on the first page; show it in front.
+            workorders.insert(0, activeWorkorder)
+        self.__loadActiveRecord(workorders, self.__activeWorkorderId,
+                                self.__model.getWorkorder)
         self.__configureWorkorderCustomerVehicleInfo()
         self.__view.configureWorkorderContent(workorders)
         self.__configureSidePanel(3, "Display Open/Completed Workorder")
@@ -615,10 +843,16 @@ class MaintAppController(object):
         customer = self.__model.getCustomer(self.__activeCustomerId)
         self.__view.configureCustomerContent(customer)
 
-        vehicleList = self.__model.getVehicleList(self.__activeCustomerId)
+        vehicleList = self.__getVehicleTabs()
         vehicleList.append(Vehicle())
-        self.__view.configureVehicleContent(vehicleList)
+        # Links from a vehicle search also name the vehicle to show.
         self.__activeVehicleId = vehicleList[0].getId()
+        for vehicle in vehicleList:
+            if vehicle.getId() == self.__userValues.get('vid'):
+                self.__activeVehicleId = vehicle.getId()
+        self.__loadActiveRecord(vehicleList, self.__activeVehicleId,
+                                self.__model.getVehicle)
+        self.__view.configureVehicleContent(vehicleList)
         self.__configureSidePanel(0, "Showing Customer")
         self.__view.set_customer_vehicle_mode()
         return None
@@ -692,7 +926,9 @@ class MaintAppController(object):
         customer.loadFromDictionary(self.__userValues)
         self.__view.configureCustomerContent(customer)
         
-        vehicleList = self.__model.getVehicleList(self.__activeCustomerId)
+        vehicleList = self.__loadActiveRecord(self.__getVehicleTabs(),
+                                              self.__activeVehicleId,
+                                              self.__model.getVehicle)
         vehicleList.append(Vehicle())
         self.__view.configureVehicleContent(vehicleList)
         
@@ -713,7 +949,9 @@ class MaintAppController(object):
             The View is then requested to refresh.
         """
         self.__configureWorkorderCustomerVehicleInfo()
-        workorders = self.__model.getWorkorderList(self.__activeVehicleId)
+        workorders = self.__getWorkorderPage("same")
+        self.__loadActiveRecord(workorders, self.__activeWorkorderId,
+                                self.__model.getWorkorder)
         if self.__activeWorkorderId == "-1":  # Creating a new work order.
             workorders.insert(0, Workorder())
         self.__view.configureWorkorderContent(workorders)
@@ -767,34 +1005,24 @@ class MaintAppController(object):
         workorder = Workorder()
         workorder.loadFromDictionary(self.__userValues)
         
-        workorders = self.__model.getWorkorderList(self.__activeVehicleId)
+        workorders = self.__getWorkorderPage("same")
+        self.__loadActiveRecord(workorders, self.__activeWorkorderId,
+                                self.__model.getWorkorder)
         if self.__activeWorkorderId == "-1":
             # User is entering a new work order.
             workorders.insert(0, workorder)
         else:
             # Replace entry in list with the active one whose values were
             #   loaded from the form fields.
-            workorderIndex = self.__findActiveWorkorder(workorders)
-            workorders.pop(workorderIndex)
-            workorders.insert(workorderIndex, workorder)
+            self.__replaceActiveRecord(workorders, self.__activeWorkorderId,
+                                       workorder)
             
         self.__configureWorkorderCustomerVehicleInfo()
         self.__view.configureWorkorderContent(workorders)
         return None
 
-    # The following methods will be used to determine if the user edited values
-    # in any of the form fields to help decide if the save dialog needs to be
-    # presented.
-    
-    def __fieldsNeedSaving(self):
-        """ Compare the form fields on the screen with the version saved in the
-            database (or against an empty record if creating a new item).  Return
-            True if any field has changed.  False otherwise.
-        """
-        # return self.__customerFieldsChanged() or \
-        #        self.__vehicleFieldsChanged() or \
-        #        self.__workorderFieldsChanged()
-        return False # Stub this out so we don't go through the save dialog path for now.
+    # The following methods determine if the user edited values in any of the
+    # form fields, for handle_dialog_event to save only what was edited.
     
     def __customerFieldsChanged(self):
         """ Compares the form fields for the customer section against the 
@@ -810,7 +1038,7 @@ class MaintAppController(object):
                 compCust = self.__model.getCustomer(self.__activeCustomerId)
             activeCust = Customer()
             activeCust.loadFromDictionary(self.__userValues)
-            retVal = (compCust == activeCust)
+            retVal = bool(self.__model.editedFields(compCust, activeCust))
         else:
             retVal = False
             
@@ -828,10 +1056,11 @@ class MaintAppController(object):
             if self.__activeVehicleId == "-1":
                 compVehicle = Vehicle()
             else:
-                compVehicle = self.__model.getCustomer(self.__activeVehicleId)
+                compVehicle = self.__model.getVehicle(self.__activeVehicleId)
             activeVehicle = Vehicle()
             activeVehicle.loadFromDictionary(self.__userValues)
-            retVal = (compVehicle == activeVehicle)
+            activeVehicle.setCustomerId(self.__activeCustomerId)
+            retVal = bool(self.__model.editedFields(compVehicle, activeVehicle))
         else:
             retVal = False
             
@@ -848,10 +1077,10 @@ class MaintAppController(object):
             if self.__activeWorkorderId == "-1":
                 compWorkorder = Workorder()
             else:
-                compWorkorder = self.__model.getCustomer(self.__activeWorkorderId)
+                compWorkorder = self.__model.getWorkorder(self.__activeWorkorderId)
             activeWorkorder = Workorder()
             activeWorkorder.loadFromDictionary(self.__userValues)
-            retVal = (compWorkorder == activeWorkorder)
+            retVal = bool(self.__model.editedFields(compWorkorder, activeWorkorder))
         else:
             retVal = False
             
@@ -914,14 +1143,144 @@ class MaintAppController(object):
             self.handle_button_events(reqhandler, whichButton, tag)
         else: # response == "Cancel"
             self.__regenerateCurrentView()
+
         
-    def run(self):
-        run_wsgi_app(self.__app)
+class TestConcurrentRequests(object):
+    """ Serves requests for different customers from several threads at once
+        and checks that every page shows its own customer and nobody else's.
+        Run with:  python dermico.py --test
+    """
+    
+    class FakeRequestHandler(object):
+        """ Just enough of a webapp.RequestHandler for the Controller. """
+        def __init__(self, values):
+            self.request = self
+            self.response = self
+            self.out = StringIO()
+            self.__values = values
+        def arguments(self):
+            return self.__values.keys()
+        def get(self, name):
+            return self.__values.get(name, "")
+    
+    def __init__(self):
+        from MaintAppModel import TestMaintAppModel
+        TestMaintAppModel()     # sets up the datastore and memcache stubs
+        return None
+    
+    def testIsolation(self, threadCount=8, rounds=20):
+        print "** testing concurrent requests..."
+        model = MaintAppModel()
+        customerIds = []
+        for i in range(threadCount):
+            customer = Customer(id='-1', last_name='Isolation%02d' % i,
+                                address1='%d Main St' % i, city='San Jose',
+                                state='CA', zip='95110', phone1='408-555-01%02d' % i)
+            customerIds.append(model.saveCustomerInfo(customer))
+        controller = MaintAppController.theController()
+        failures = []
+        
+        def serve(i):
+            for r in range(rounds):
+                handler = TestConcurrentRequests.FakeRequestHandler({'cid': customerIds[i]})
+                controller.handle_button_events(handler, "showcust", customerIds[i])
+                page = handler.out.getvalue()
+                for j in range(threadCount):
+                    if (('Isolation%02d' % j) in page) != (i == j):
+                        failures.append((i, r, j))
+        
+        # Switch threads as often as possible to give requests every chance
+        # to run into each other.
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            threads = [threading.Thread(target=serve, args=(i,)) for i in range(threadCount)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setcheckinterval(interval)
+        print "%d threads x %d requests: %d pages showed the wrong customer" % \
+              (threadCount, rounds, len(failures))
+        return len(failures) == 0
 
+
+class TestRequestController(object):
+    """ Submits forms to the Controller the way the browser does and checks
+        the pages served.  Run with:  python dermico.py --test
+    """
+    
+    def __init__(self):
+        from MaintAppModel import TestMaintAppModel
+        TestMaintAppModel()     # sets up the datastore and memcache stubs
+        return None
+    
+    def __submit(self, button, values):
+        handler = TestConcurrentRequests.FakeRequestHandler(values)
+        MaintAppController.theController().handle_button_events(handler, button, "0")
+        return handler.out.getvalue()
+    
+    def testInvalidInput(self):
+        """ Invalid new and edited vehicles and work orders are shown again,
+            with the values entered and the errors found in them.
+        """
+        print "** testing invalid vehicle and work order submissions..."
+        model = MaintAppModel()
+        customerId = model.saveCustomerInfo(Customer(first_name='Ima', last_name='Tester',
+                                                     address1='1 Test Way', city='San Jose',
+                                                     state='CA', zip='95110',
+                                                     phone1='408-555-0100'))
+        vehicleId = model.saveVehicleInfo(Vehicle(customer_id=customerId, make='Honda',
+                                                  model='Civic', year=2004, license='TEST01',
+                                                  vin='', notes=''))
+        workorder = Workorder(vehicle_id=vehicleId, mileage=40000, mechanic='Lee',
+                              customer_request='brakes squeal')
+        workorder.setDateCreated()
+        workorderId = model.saveWorkorder(workorder)
         
+        results = []
+        for vid in ("-1", vehicleId):
+            page = self.__submit("savevhcl", {
+                'customer_id': customerId, 'vehicle_id': vid, 'workorder_id': "-1",
+                'first_name': 'Ima', 'last_name': 'Tester', 'address1': '1 Test Way',
+                'city': 'San Jose', 'state': 'CA', 'zip': '95110', 'phone1': '408-555-0100',
+                'comments': '', 'make': 'Honda', 'model': 'Civic', 'year': '04',
+                'license': 'TEST01', 'vin': '', 'notes': '', 'mileage': ''})
+            results.append(("%s vehicle" % ("new", "saved")[vid != "-1"],
+                            "4-digit" in page))
+        for woid in ("-1", workorderId):
+            page = self.__submit("savewo", {
+                'customer_id': customerId, 'vehicle_id': vehicleId, 'workorder_id': woid,
+                'customer_request': 'brakes squeal', 'mileage': '45,000',
+                'date_created': workorder.getDateCreated() if woid != "-1" else "",
+                'mechanic': 'Lee', 'status': 'Open', 'task_list': '',
+                'work_performed': '', 'notes': ''})
+            results.append(("%s work order" % ("new", "saved")[woid != "-1"],
+                            "whole number" in page and "45,000" in page))
+        for name, ok in results:
+            print "invalid %s shown with its errors: %s" % (name, ok)
+        return False not in [ok for name, ok in results]
+
+
+# The shared part of the Controller is set up on import, so a WSGI server can
+# import 'application' and call it from as many threads as it likes.
+application = MaintAppController().wsgiApplication()
+
+
 def main():
-    MaintAppController().run()
+    """ Serve under App Engine.  MaintAppServer serves the same application
+        outside it, on a pool of threads.
+    """
+    MaintAppController.theController().run()
     
     
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if "--test" in sys.argv:
+        passed = TestConcurrentRequests().testIsolation()
+        passed = TestRequestController().testInvalidInput() and passed
+        if not passed:
+            print "FAILED"
+            sys.exit(1)
+    else:
+        main()
\ No newline at end of file